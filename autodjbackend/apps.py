@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class AutodjbackendConfig(AppConfig):
+    name = 'autodjbackend'
+
+    def ready(self):
+        from autodjbackend import query_tracing
+
+        query_tracing.instrument_neomodel()
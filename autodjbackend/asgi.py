@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'autodjbackend.settings')
 
 application = get_asgi_application()
+
+# Load the track cache snapshot, if configured, before serving requests.
+from autodjbackend.track_cache import TrackCache  # noqa: E402
+
+TrackCache.get_instance()
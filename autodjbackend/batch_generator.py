@@ -0,0 +1,103 @@
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+import django
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Returns the process pool shared by every batch, creating it if needed.
+
+    Workers are spawned rather than forked, so they don't inherit the
+    server's threads or open Neo4j connections. Each sets up Django and
+    loads the track cache and graph storage once, when it starts, mapping
+    the catalog file if one is configured, which is then shared between
+    workers through the page cache. Without a catalog file, each worker
+    holds its own copy of the tracks it loads.
+    """
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=settings.PLAYLIST_BATCH_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker
+            )
+
+    return _executor
+
+
+def run_batch(function, items, executor=None, timeout=None):
+    """
+    Calls function on every item in parallel, keeping the results in order.
+
+    The calling thread is blocked until every result is in, or the timeout
+    has passed. Items still waiting for a worker then are cancelled, but
+    those already running can't be stopped, and keep their worker until
+    they finish.
+
+    Args:
+        function (callable): A module level function, so that it can be
+            sent to the worker processes, returning a dict() for each item.
+        items (list): The argument of each call.
+        executor (concurrent.futures.Executor): Optional executor to use
+            instead of the shared process pool.
+        timeout (float): Seconds to wait for the whole batch, by default
+            PLAYLIST_BATCH_TIMEOUT, where 0 waits for every result.
+
+    Returns:
+        list(dict()): The result of each call, or {'status': 500,
+            'detail': message} for each call that raised, and
+            {'status': 504, 'detail': message} for each call that didn't
+            finish in time, in the order of items.
+    """
+    if executor is None:
+        executor = get_executor()
+    if timeout is None:
+        timeout = settings.PLAYLIST_BATCH_TIMEOUT
+    deadline = time.monotonic() + timeout if timeout else None
+
+    futures = [executor.submit(function, item) for item in items]
+    results = []
+    for index, future in enumerate(futures):
+        remaining = None
+        if deadline is not None:
+            remaining = max(0, deadline - time.monotonic())
+        try:
+            results.append(future.result(remaining))
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            logger.error(f'Batch item {index} timed out.')
+            results.append({
+                'status': 504,
+                'detail': f'Timed out after {timeout} seconds.'
+            })
+        except Exception as err:
+            # One failed item shouldn't fail the rest of the batch.
+            logger.error(f'Batch item {index} failed: {err!r}')
+            results.append({'status': 500, 'detail': str(err)})
+
+    return results
+
+
+def _init_worker():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'autodjbackend.settings')
+    django.setup()
+
+    from autodjbackend.graph_storage import GraphStorage
+    from autodjbackend.track_cache import TrackCache
+
+    TrackCache.get_instance()
+    GraphStorage.get_instance()
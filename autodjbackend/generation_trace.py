@@ -0,0 +1,93 @@
+import collections
+import contextlib
+import contextvars
+import json
+import logging
+import random
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+# Where the track added at a step came from.
+SEED = 'seed'
+USER = 'user'
+GRAPH = 'graph'
+
+STEP_FIELDS = (
+    'step', 'source', 'uuid', 'candidates', 'best_h_value', 'bucket_size',
+)
+
+_current_recorder = contextvars.ContextVar('generation_trace', default=None)
+
+# Kept apart from the random module, so that sampling never changes which
+# playlist an unseeded request generates.
+_sampler = random.Random()
+
+
+class GenerationTrace:
+    """
+    The most recent steps of a playlist's generation, in a ring buffer.
+
+    Each step is kept as a tuple of STEP_FIELDS, and only turned into a
+    dict when the trace is read, so recording does no formatting.
+    """
+
+    def __init__(self, capacity):
+        self.steps = collections.deque(maxlen=capacity)
+        self.step_count = 0
+
+    def record(
+        self, source, uuid, candidates=None, best_h_value=None,
+        bucket_size=None
+    ):
+        self.steps.append(
+            (self.step_count, source, uuid, candidates, best_h_value,
+             bucket_size)
+        )
+        self.step_count += 1
+
+    def as_dict(self):
+        return {
+            'step_count': self.step_count,
+            'dropped': self.step_count - len(self.steps),
+            'steps': [dict(zip(STEP_FIELDS, step)) for step in self.steps],
+        }
+
+
+def current():
+    """
+    Returns the recorder of the playlist being generated, or None when its
+    generation isn't being traced.
+    """
+    return _current_recorder.get()
+
+
+@contextlib.contextmanager
+def record_steps(requested=False):
+    """
+    Traces the generation of a playlist within the block, if requested, or
+    if sampled at GENERATION_TRACE_SAMPLE_RATE. Sampled traces are logged
+    when the block ends.
+
+    Yields:
+        GenerationTrace: The recorder of the steps, or None if the
+            generation isn't traced.
+    """
+    sample_rate = settings.GENERATION_TRACE_SAMPLE_RATE
+    sampled = (
+        not requested and sample_rate > 0 and _sampler.random() < sample_rate
+    )
+    if not (requested or sampled):
+        yield None
+        return
+
+    recorder = GenerationTrace(settings.GENERATION_TRACE_CAPACITY)
+    token = _current_recorder.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _current_recorder.reset(token)
+        if sampled:
+            logger.info(f'Generation trace: {json.dumps(recorder.as_dict())}')
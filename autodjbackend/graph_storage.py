@@ -0,0 +1,517 @@
+import abc
+import collections
+import logging
+import numbers
+import random
+import threading
+import uuid
+
+import neomodel
+import numpy as np
+from django.conf import settings
+
+from autodjbackend import timing, utils
+from autodjbackend.models import Track
+from autodjbackend.track_cache import TrackCache
+from autodjbackend.track_catalog import (
+    LINK_NODE_RELATIONSHIPS, NULL_ID, TrackCatalog
+)
+
+
+logger = logging.getLogger(__name__)
+
+REL_TYPE_TO_LABEL = {
+    rel_type: label for label, rel_type in LINK_NODE_RELATIONSHIPS.values()
+}
+
+LINK_REL_TYPES = '|'.join(REL_TYPE_TO_LABEL)
+
+# Only the properties needed to score and serialize a track are returned.
+TRACK_PROJECTION = (
+    '{.uuid, .title, .artist, .album, .year, .position, .duration, '
+    '.original_artist}'
+)
+
+GET_NEIGHBORHOOD_QUERY = (
+    f'MATCH (t:Track {{uuid: $uuid}})-[r:{LINK_REL_TYPES}]->(l) '
+    f'OPTIONAL MATCH (l)-[:{LINK_REL_TYPES}]->(c:Track) '
+    'WHERE NOT l.uuid IN $cached '
+    'RETURN type(r), l.uuid, l.uuid IN $cached, '
+    f'collect(c {TRACK_PROJECTION})'
+)
+
+GET_LINK_NODE_TRACKS_QUERY = (
+    'MATCH (l:{label} {{uuid: $uuid}})-[:{rel_type}]->(c:Track) '
+    'RETURN c {projection}'
+)
+
+GET_TRACKS_QUERY = (
+    'UNWIND $uuids AS uuid '
+    'OPTIONAL MATCH (c:Track {uuid: uuid}) '
+    f'RETURN c {TRACK_PROJECTION}'
+)
+
+# Track properties held in catalog columns, with the string table of those
+# which are stored as dictionary ids.
+STRING_PROPERTY_COLUMNS = {
+    'title': ('title_ids', 'title_names'),
+    'album': ('album_ids', 'album_names'),
+    'artist': ('artist_ids', 'artist_names'),
+    'original_artist': ('original_artist_ids', 'artist_names'),
+}
+INTEGER_PROPERTY_COLUMNS = {
+    'year': 'years',
+    'position': 'positions',
+    'duration': 'durations',
+}
+
+MBDUMP_FIELD_COUNT = 7
+# Track properties parsed by the import script, in track row order.
+MBDUMP_ROW_FIELDS = (
+    'title', 'artist', 'album', 'year', 'position', 'duration',
+    'original_artist',
+)
+
+
+class GraphStorage(abc.ABC):
+    """
+    The graph operations playlist generation needs, independent of where
+    the graph is stored.
+
+    Neo4jGraphStorage queries the database, and InMemoryGraphStorage holds
+    the whole graph in a TrackCatalog, so that playlists can be generated,
+    and profiled, without a database. GRAPH_STORAGE_BACKEND picks which one
+    a deployment uses.
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_instance(cls):
+        """
+        Returns the storage configured by GRAPH_STORAGE_BACKEND, creating it
+        the first time it is requested.
+        """
+        with cls._lock:
+            if GraphStorage._instance is None:
+                backend = settings.GRAPH_STORAGE_BACKEND
+                if backend == 'neo4j':
+                    GraphStorage._instance = Neo4jGraphStorage()
+                elif backend == 'memory':
+                    GraphStorage._instance = InMemoryGraphStorage.from_mbdump(
+                        settings.GRAPH_STORAGE_MBDUMP_PATH
+                    )
+                else:
+                    raise ValueError(f'Unknown graph storage: {backend}')
+
+        return GraphStorage._instance
+
+    @property
+    def catalog(self):
+        """
+        The catalog to score candidates from in bulk, or None.
+        """
+        return None
+
+    @abc.abstractmethod
+    def get_neighbors(
+        self, track, candidate_budget=None, rng=random, played=None
+    ):
+        """
+        Returns every track sharing a link node with the given track, other
+        than those already played.
+
+        Args:
+            track (Track): The track to get the neighbors of.
+            candidate_budget (int): Optional limit on the tracks returned,
+                split between link nodes by allocate_candidate_budget, after
+                played tracks are left out.
+            rng (random.Random): Source of the samples taken.
+            played (PlayedTracks): Optional tracks to leave out.
+
+        Returns:
+            list(Track): The deduplicated neighbors.
+        """
+
+    @abc.abstractmethod
+    def get_tracks(self, uuids):
+        """
+        Returns the track with each uuid, or None where there isn't one.
+        """
+
+    @abc.abstractmethod
+    def get_random_seed_node(self, criteria_to_search, rng=random):
+        """
+        Returns a list of one track matching the criteria, picked uniformly
+        at random, or an empty list if none match.
+        """
+
+    @abc.abstractmethod
+    def resolve_user_tracks(self, user_tracks_list):
+        """
+        Returns the first track matching each user request, or None where
+        nothing matched.
+
+        Raises:
+            ValueError: If a request searches on a property tracks don't have.
+        """
+
+
+class Neo4jGraphStorage(GraphStorage):
+    """
+    Graph storage backed by Neo4j, with link nodes cached in the TrackCache.
+    """
+
+    @property
+    def catalog(self):
+        return TrackCatalog.get_instance()
+
+    def get_neighbors(
+        self, track, candidate_budget=None, rng=random, played=None
+    ):
+        related_tracks = _get_related_tracks(
+            track, candidate_budget, rng, played
+        )
+
+        return related_tracks
+
+    def get_tracks(self, uuids):
+        results, _ = neomodel.db.cypher_query(
+            GET_TRACKS_QUERY, {'uuids': list(uuids)}
+        )
+
+        return [
+            Track(**row[0]) if row[0] is not None else None
+            for row in results
+        ]
+
+    def get_random_seed_node(self, criteria_to_search, rng=random):
+        return utils.get_random_seed_node(criteria_to_search, rng)
+
+    def resolve_user_tracks(self, user_tracks_list):
+        return utils.resolve_user_tracks(user_tracks_list)
+
+
+class InMemoryGraphStorage(GraphStorage):
+    """
+    Graph storage held entirely in memory, as a TrackCatalog.
+
+    Args:
+        catalog (TrackCatalog): The tracks and their link nodes.
+    """
+
+    def __init__(self, catalog):
+        self._catalog = catalog
+        self._title_keyword_masks = _title_keyword_masks(catalog)
+
+    @classmethod
+    def from_mbdump(cls, path):
+        """
+        Builds the graph from a scrubbed MusicBrainz dump, as written by
+        scripts/strip_unneeded_tracks.py.
+
+        Tracks are filtered, and linked, by the same rules as the import
+        scripts, and given uuids derived from their line, so that the same
+        dump always gives the same graph.
+        """
+        with open(path, 'r') as file:
+            track_rows = read_mbdump_tracks(file)
+        logger.info(f'{len(track_rows)} tracks read from {path}.')
+
+        return cls(
+            TrackCatalog.from_rows(track_rows, build_memberships(track_rows))
+        )
+
+    @property
+    def catalog(self):
+        return self._catalog
+
+    def get_neighbors(
+        self, track, candidate_budget=None, rng=random, played=None
+    ):
+        exclude = None
+        if played is not None:
+            exclude = np.zeros(len(self._catalog), dtype=bool)
+            for track_uuid in played.uuids:
+                index = self._catalog.uuids.find(track_uuid)
+                if index != -1:
+                    exclude[index] = True
+        neighbors = self._catalog.neighbors(
+            self._catalog.index_of(track.uuid), candidate_budget, rng,
+            exclude
+        )
+
+        return [self._catalog.track(index) for index in neighbors.tolist()]
+
+    def get_tracks(self, uuids):
+        indices = [self._catalog.uuids.find(uuid) for uuid in uuids]
+
+        return [
+            self._catalog.track(index) if index != -1 else None
+            for index in indices
+        ]
+
+    def get_random_seed_node(self, criteria_to_search, rng=random):
+        matches = np.flatnonzero(self._match(criteria_to_search))
+        if not len(matches):
+            return []
+
+        return [self._catalog.track(int(rng.choice(matches)))]
+
+    def resolve_user_tracks(self, user_tracks_list):
+        track_properties = Track.defined_properties(aliases=False, rels=False)
+        user_tracks = []
+        for track_criteria in user_tracks_list:
+            if not track_criteria or set(track_criteria) - set(
+                track_properties
+            ):
+                raise ValueError(
+                    f'Invalid track to include: {track_criteria}'
+                )
+            matches = np.flatnonzero(self._match(track_criteria))
+            user_tracks.append(
+                self._catalog.track(int(matches[0])) if len(matches) else None
+            )
+
+        return user_tracks
+
+    def _match(self, criteria):
+        matches = np.ones(len(self._catalog), dtype=bool)
+        for key, value in criteria.items():
+            matches &= _property_matches(
+                self._catalog, self._title_keyword_masks, key, value
+            )
+
+        return matches
+
+
+def read_mbdump_tracks(lines):
+    """
+    Parses the lines of a scrubbed MusicBrainz dump into track rows.
+
+    Lines are title, duration, artist, album, year, position and original
+    artist, comma separated. Duplicate lines, malformed lines, and tracks
+    the import script would skip, are left out.
+
+    Returns:
+        list(tuple): Rows of (uuid, title, artist, album, year, position,
+            duration, original_artist).
+    """
+    track_rows = {}
+    for line in lines:
+        split_line = line.split(',')
+        if len(split_line) != MBDUMP_FIELD_COUNT:
+            continue
+        try:
+            track_params = utils.split_line_to_dict(split_line)
+        except ValueError:
+            continue
+        if not utils.should_convert(track_params):
+            continue
+
+        track_uuid = uuid.uuid5(uuid.NAMESPACE_OID, line).hex
+        track_rows[track_uuid] = (track_uuid,) + tuple(
+            track_params[field] for field in MBDUMP_ROW_FIELDS
+        )
+
+    return list(track_rows.values())
+
+
+def build_memberships(track_rows):
+    """
+    Groups track rows into link nodes, by the same rules as the relation
+    scripts.
+
+    Returns:
+        dict(): Maps each Track relationship name to a list of (link node
+            uuid, [track uuid]) pairs.
+    """
+    link_nodes = {rel: collections.defaultdict(list) for rel in (
+        LINK_NODE_RELATIONSHIPS
+    )}
+    for track_uuid, title, _, _, year, position, _, original_artist in (
+        track_rows
+    ):
+        link_nodes['same_year'][f'year:{year}'].append(track_uuid)
+        link_nodes['same_track_number'][f'position:{position}'].append(
+            track_uuid
+        )
+        link_nodes['same_original_artist'][
+            f'original_artist:{original_artist}'
+        ].append(track_uuid)
+        mask = _title_keyword_mask(title)
+        for bit, keyword in enumerate(utils.KEYWORDS):
+            if mask & 1 << bit:
+                link_nodes['keyword_in_title'][f'keyword:{keyword}'].append(
+                    track_uuid
+                )
+
+    return {
+        rel: list(members.items()) for rel, members in link_nodes.items()
+    }
+
+
+def _title_keyword_mask(title):
+    # Keywords are matched ignoring case, as the relation scripts match them
+    # in Neo4j. The masks in the catalog are case sensitive, as the
+    # heuristic has always scored them.
+    return utils.get_keyword_mask(title.lower())
+
+
+def _title_keyword_masks(catalog):
+    title_masks = np.array(
+        [
+            _title_keyword_mask(catalog.title_names[title_id])
+            for title_id in range(len(catalog.title_names))
+        ],
+        dtype=np.uint32
+    )
+    masks = np.zeros(len(catalog), dtype=np.uint32)
+    has_title = catalog.title_ids != NULL_ID
+    masks[has_title] = title_masks[catalog.title_ids[has_title]]
+
+    return masks
+
+
+def _property_matches(catalog, title_keyword_masks, key, value):
+    if key == 'uuid':
+        matches = np.zeros(len(catalog), dtype=bool)
+        index = catalog.uuids.find(value)
+        if index != -1:
+            matches[index] = True
+        return matches
+
+    if key in STRING_PROPERTY_COLUMNS:
+        column, table = STRING_PROPERTY_COLUMNS[key]
+        string_id = (
+            NULL_ID if value is None else getattr(catalog, table).find(value)
+        )
+        return getattr(catalog, column) == string_id
+
+    if key in INTEGER_PROPERTY_COLUMNS:
+        if not isinstance(value, numbers.Integral):
+            return np.zeros(len(catalog), dtype=bool)
+        return getattr(catalog, INTEGER_PROPERTY_COLUMNS[key]) == value
+
+    if key == 'keyword_in_title' and value in utils.KEYWORDS:
+        bit = 1 << utils.KEYWORDS.index(value)
+        return (title_keyword_masks & bit) != 0
+
+    return np.zeros(len(catalog), dtype=bool)
+
+
+def _get_related_tracks(
+    current_track, candidate_budget=None, rng=random, played=None
+):
+    """
+    Gets every track sharing a link node with the current track.
+
+    If the link nodes of the current track are cached, and so are their
+    tracks, no query is made. Otherwise both hops of the traversal are made
+    in a single query, which only returns tracks for link nodes not already
+    in the track cache, and only with the properties the generator needs.
+
+    Played tracks are left out first, and then if a candidate budget is
+    given, link nodes larger than their share of it are sampled.
+
+    Args:
+        current_track (Track): The track to get the neighborhood of.
+        candidate_budget (int): Optional limit on the tracks returned.
+        rng (random.Random): Source of the samples taken.
+        played (PlayedTracks): Optional tracks to leave out.
+
+    Returns:
+        list(Track): The deduplicated related tracks.
+    """
+    track_cache = TrackCache.get_instance()
+
+    try:
+        track_links = track_cache.get_link_nodes_of_track(current_track.uuid)
+    except KeyError:
+        results = _query_neighborhood(track_cache, current_track)
+    else:
+        results = [
+            (rel_type, link_uuid, True, [])
+            for rel_type, link_uuid in track_links
+        ]
+
+    linked_track_lists = [
+        _get_linked_tracks(
+            track_cache, rel_type, link_uuid, is_cached, members
+        )
+        for rel_type, link_uuid, is_cached, members in results
+    ]
+    if played is not None:
+        linked_track_lists = [
+            [track for track in linked_tracks if track not in played]
+            for linked_tracks in linked_track_lists
+        ]
+    if candidate_budget:
+        linked_track_lists = utils.sample_link_nodes(
+            linked_track_lists, candidate_budget, rng
+        )
+
+    related_tracks = {}
+    for linked_tracks in linked_track_lists:
+        for track in linked_tracks:
+            related_tracks.setdefault(track.uuid, track)
+
+    return list(related_tracks.values())
+
+
+def _query_neighborhood(track_cache, current_track):
+    # The largest link nodes save the most when they aren't returned again,
+    # and the list is bounded so it doesn't outgrow what it saves.
+    cached_uuids = track_cache.get_link_node_uuids(
+        settings.TRACK_CACHE_MAX_QUERY_UUIDS
+    )
+    with timing.phase(timing.NEIGHBORS_NEO4J):
+        results, _ = neomodel.db.cypher_query(
+            GET_NEIGHBORHOOD_QUERY,
+            {'uuid': current_track.uuid, 'cached': cached_uuids}
+        )
+
+    # Neo4j returns rows and collected tracks in no particular order, so
+    # they are sorted by uuid for a seeded generator to sample the same
+    # candidates each time. The track cache then keeps them in that order.
+    results.sort(key=lambda row: row[1])
+
+    # Cached even when empty, so tracks without link nodes aren't requeried.
+    track_cache.add_link_nodes_of_track(
+        current_track.uuid,
+        [(rel_type, link_uuid) for rel_type, link_uuid, _, _ in results]
+    )
+
+    return results
+
+
+def _get_linked_tracks(track_cache, rel_type, link_uuid, is_cached, members):
+    if is_cached:
+        try:
+            return track_cache.get_tracks_from_link_node(link_uuid)
+        except KeyError:
+            # Expired after the neighborhood query was sent.
+            logger.debug(f'Link node expired from cache: {link_uuid}')
+            members = _fetch_link_node_members(rel_type, link_uuid)
+
+    linked_tracks = sorted(
+        (Track(**properties) for properties in members),
+        key=lambda track: track.uuid
+    )
+    track_cache.add_result_to_cache(link_uuid, linked_tracks)
+
+    return linked_tracks
+
+
+def _fetch_link_node_members(rel_type, link_uuid):
+    with timing.phase(timing.NEIGHBORS_NEO4J):
+        results, _ = neomodel.db.cypher_query(
+            GET_LINK_NODE_TRACKS_QUERY.format(
+                label=REL_TYPE_TO_LABEL[rel_type], rel_type=rel_type,
+                projection=TRACK_PROJECTION
+            ),
+            {'uuid': link_uuid}
+        )
+
+    return [row[0] for row in results]
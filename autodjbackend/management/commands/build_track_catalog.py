@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from autodjbackend.track_catalog import TrackCatalog, load_graph_rows
+
+
+class Command(BaseCommand):
+    help = (
+        'Writes every track and link node membership to a catalog file, '
+        'which workers memory map through TRACK_CATALOG_PATH.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Path to write the catalog to.')
+
+    def handle(self, *args, **options):
+        self.stdout.write('Loading tracks from Neo4j.')
+        track_rows, memberships = load_graph_rows()
+
+        catalog = TrackCatalog.from_rows(track_rows, memberships)
+        catalog.save(options['path'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Catalog of {len(catalog)} tracks written to {options["path"]}.'
+        ))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from autodjbackend.track_cache import TrackCache
+from autodjbackend.track_catalog import TrackCatalog, load_graph_rows
+
+
+class Command(BaseCommand):
+    help = (
+        'Preloads every link node membership into the track cache. With the '
+        'django backend this warms the cache shared by every worker. With '
+        '--snapshot, the memberships are also written to a catalog file '
+        'workers map at startup through TRACK_CACHE_SNAPSHOT_PATH.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--snapshot',
+            help='Path to write a catalog of the memberships to.',
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write('Loading link node memberships from Neo4j.')
+        track_rows, memberships = load_graph_rows()
+
+        TrackCache.get_instance().warm(track_rows, memberships)
+
+        if options['snapshot']:
+            TrackCatalog.from_rows(track_rows, memberships).save(
+                options['snapshot']
+            )
+            self.stdout.write(f'Snapshot written to {options["snapshot"]}.')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Track cache warmed with {len(track_rows)} tracks.'
+        ))
@@ -0,0 +1,222 @@
+import bisect
+import collections
+import math
+import threading
+
+from autodjbackend.track_cache import TrackCache
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds, in minutes, of the requested playlist runtimes that
+# generation latency is grouped by.
+REQUESTED_MINUTES_BOUNDS = (15, 30, 60, 120, 240)
+
+
+class Counter:
+    """
+    A process-local Prometheus counter, with a series for each label value.
+    """
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values = collections.defaultdict(float)
+
+    def inc(self, amount=1, labels=()):
+        with self._lock:
+            self._values[labels] += amount
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} counter',
+        ]
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            lines.append(
+                f'{self.name}{_format_labels(self.labelnames, labels)} '
+                f'{_format_value(value)}'
+            )
+
+        return lines
+
+
+class Histogram:
+    """
+    A process-local Prometheus histogram, with a series for each label
+    value. Each observation only increments its own bucket, and the buckets
+    are made cumulative when rendered.
+    """
+
+    def __init__(self, name, documentation, buckets, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            try:
+                counts, total = self._series[labels]
+            except KeyError:
+                counts, total = [0] * (len(self.buckets) + 1), 0
+            counts[index] += 1
+            self._series[labels] = counts, total + value
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} histogram',
+        ]
+        with self._lock:
+            series = sorted(
+                (labels, list(counts), total)
+                for labels, (counts, total) in self._series.items()
+            )
+        for labels, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                bucket_labels = _format_labels(
+                    self.labelnames + ('le',),
+                    labels + (_format_value(bound),)
+                )
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            series_labels = _format_labels(self.labelnames, labels)
+            lines.append(
+                f'{self.name}_sum{series_labels} {_format_value(total)}'
+            )
+            lines.append(f'{self.name}_count{series_labels} {cumulative}')
+
+        return lines
+
+
+GENERATION_SECONDS = Histogram(
+    'autodj_generation_seconds',
+    'Time taken to generate a playlist, by requested runtime in minutes.',
+    (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+    ('requested_minutes',)
+)
+PLAYLIST_STEPS = Histogram(
+    'autodj_playlist_steps',
+    'Tracks chosen from the graph for each playlist.',
+    (1, 5, 10, 25, 50, 100, 250, 500)
+)
+CANDIDATES_SCORED = Histogram(
+    'autodj_candidates_scored',
+    'Candidate tracks scored at each step of generation.',
+    (10, 100, 1000, 10000, 100000, 1000000)
+)
+NEO4J_QUERIES = Counter(
+    'autodj_neo4j_queries_total', 'Queries sent to Neo4j.'
+)
+NEO4J_QUERIES_PER_REQUEST = Histogram(
+    'autodj_neo4j_queries_per_request',
+    'Queries sent to Neo4j for each playlist request.',
+    (0, 1, 2, 5, 10, 25, 50, 100, 250)
+)
+USER_TRACK_FALLBACKS = Counter(
+    'autodj_user_track_fallbacks_total',
+    'Requested tracks to include which matched no track, and were left out.'
+)
+
+METRICS = (
+    GENERATION_SECONDS, PLAYLIST_STEPS, CANDIDATES_SCORED, NEO4J_QUERIES,
+    NEO4J_QUERIES_PER_REQUEST, USER_TRACK_FALLBACKS,
+)
+
+# Track cache counters, read from TrackCache.get_stats() when rendered.
+TRACK_CACHE_COUNTERS = (
+    ('hits', 'Track cache lookups which found an entry.'),
+    ('misses', 'Track cache lookups which found no entry.'),
+    ('expirations', 'Track cache entries found expired when looked up.'),
+    ('evictions', 'Track cache entries evicted to stay within its limits.'),
+)
+
+
+def requested_minutes_label(total_duration):
+    """
+    Returns the smallest of REQUESTED_MINUTES_BOUNDS holding a requested
+    runtime, given in milliseconds, as a label value.
+    """
+    minutes = total_duration / 60000
+    index = bisect.bisect_left(REQUESTED_MINUTES_BOUNDS, minutes)
+    if index == len(REQUESTED_MINUTES_BOUNDS):
+        return '+Inf'
+
+    return str(REQUESTED_MINUTES_BOUNDS[index])
+
+
+def observe_generation(total_duration, seconds, steps):
+    GENERATION_SECONDS.observe(
+        seconds, (requested_minutes_label(total_duration),)
+    )
+    PLAYLIST_STEPS.observe(steps)
+
+
+def render():
+    """
+    Returns every metric of this process in the Prometheus text format.
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    lines.extend(_render_track_cache())
+
+    return '\n'.join(lines) + '\n'
+
+
+def _render_track_cache():
+    # Only read once a request has created the cache, rather than loading
+    # it to be scraped.
+    track_cache = TrackCache._instance
+    if track_cache is None:
+        return []
+
+    stats = track_cache.get_stats()
+    lines = []
+    for counter, documentation in TRACK_CACHE_COUNTERS:
+        name = f'autodj_track_cache_{counter}_total'
+        lines.append(f'# HELP {name} {documentation}')
+        lines.append(f'# TYPE {name} counter')
+        for tier, tier_stats in sorted(stats.items()):
+            lines.append(
+                f'{name}{_format_labels(("tier",), (tier,))} '
+                f'{_format_value(tier_stats[counter])}'
+            )
+
+    return lines
+
+
+def _format_labels(labelnames, labels):
+    if not labelnames:
+        return ''
+
+    pairs = ','.join(
+        f'{name}="{_escape_label(value)}"'
+        for name, value in zip(labelnames, labels)
+    )
+    return f'{{{pairs}}}'
+
+
+def _escape_label(value):
+    return (
+        str(value).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n')
+    )
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+
+    return repr(float(value))
@@ -1,51 +1,97 @@
 import logging
+import numbers
 import random
+import time
 
-from autodjbackend.models import Track
-from autodjbackend.track_cache import TrackCache
+import numpy as np
+from asgiref.sync import sync_to_async
+
+from autodjbackend import generation_trace, metrics, timing
+from autodjbackend.graph_storage import GraphStorage
 from autodjbackend.utils import (
-    minutes_to_milliseconds, milliseconds_to_minutes
+    get_track_keyword_mask, minutes_to_milliseconds, milliseconds_to_minutes
 )
 
 
 logger = logging.getLogger(__name__)
 
 
-KEYWORDS = [
-    'river',
-    'love',
-    'blues',
-    'party',
-    'time',
-    'tonight',
-    'rain',
-    'morning',
-    'breathe',
-    'fire',
-    'woman',
-    'disco',
-    'rock',
-    'music',
-    'dancin',
-    'baby',
-    'twist',
-    'lonely',
-    'stop',
-    'boogie',
-    'christmas',
-    'moon',
-]
-
-ATTR_TO_REL = {
-    'position': 'same_track_number',
-    'original_artist': 'same_original_artist',
-    'year': 'same_year',
-    'keyword_in_title': 'keyword_in_title',
+# Events yielded by the main generate loop.
+TRACK_ADDED = 'track_added'
+CHOOSE_NEXT_TRACK = 'choose_next_track'
+
+# Number of set bits in every byte value, used to count shared keywords.
+POPCOUNT_TABLE = np.array(
+    [bin(value).count('1') for value in range(256)], dtype=np.int64
+)
+
+# Criteria which map directly onto a numeric catalog column.
+CATALOG_COLUMNS = {
+    'position': 'positions',
+    'year': 'years',
 }
 
 
+class PlayedTracks:
+    """
+    The tracks already in a playlist, for constant time exclusion checks.
+
+    Tracks are held as a set of uuids, and when generating from a catalog,
+    also as a boolean mask over catalog indices so that whole candidate
+    arrays can be filtered at once.
+    """
+
+    def __init__(self, catalog=None):
+        self.uuids = set()
+        self.mask = None
+        if catalog is not None:
+            self.mask = np.zeros(len(catalog), dtype=bool)
+
+    def __contains__(self, track):
+        return track.uuid in self.uuids
+
+    def add(self, track):
+        self.uuids.add(track.uuid)
+        if self.mask is not None:
+            self.mask[track.catalog_index] = True
+
+
+class BestCandidate:
+    """
+    Keeps the best scoring candidate offered so far, in a single pass.
+
+    Ties are broken by reservoir sampling: the n-th candidate to tie the best
+    score replaces the pick with probability 1/n. This leaves every one of
+    the best scoring candidates equally likely to be picked, without keeping
+    the other candidates or their scores.
+    """
+
+    def __init__(self, rng=random):
+        self.rng = rng
+        self.h_value = None
+        self.candidate = None
+        self.ties = 0
+
+    def offer(self, candidate, h_value):
+        if self.ties == 0 or h_value > self.h_value:
+            self.h_value = h_value
+            self.candidate = candidate
+            self.ties = 1
+        elif h_value == self.h_value:
+            self.ties += 1
+            if self.rng.randrange(self.ties) == 0:
+                self.candidate = candidate
+
+    def pick(self):
+        if self.ties == 0:
+            raise ValueError('No candidates were offered.')
+
+        return self.candidate
+
+
 def generate(
-    seed_nodes, criteria, total_duration, user_tracks, user_time_window=1
+    seed_nodes, criteria, total_duration, user_tracks, user_time_window=1,
+    catalog=None, candidate_budget=None, rng=random, storage=None
 ):
     """
     Generates a playlist using user criteria, and the given seed nodes.
@@ -59,26 +105,199 @@ def generate(
     to these link nodes. This emulates retreiving all of the related nodes from
     a graph where the tracks are directly connected.
 
-    Next, each potential track is assigned a heuristic value. THey are then
-    bucketed according to their heurstic value. The algorithm then picks one of
-    the highest scoring tracks at random, and adds that to the playlist.
+    Next, each potential track is assigned a heuristic value, while the best
+    value seen so far is tracked. The algorithm then picks one of the highest
+    scoring tracks at random, and adds that to the playlist.
 
     This process repeats until the runtime of the playlist is at least 30
     seconds less than the user-specified runtime.
 
+    If a catalog is given, related tracks are read from it rather than from
+    the graph, and no queries are made while the playlist is generated.
+
+    If a candidate budget is given, at most that many related tracks are
+    scored at each step. Tracks already played are left out before the
+    budget is split, so they never use it up. Link nodes smaller than their
+    share of the budget are scored in full, and larger ones are sampled
+    uniformly without replacement. The next track is then picked uniformly
+    from the best scoring sampled tracks. Every track in the true best
+    bucket remains equally likely to be picked, but a sampled link node of
+    n tracks, b of which are in the best bucket, only contributes one of
+    them with probability 1 - C(n - b, k) / C(n, k) for a quota of k, and a
+    lower scoring track is picked otherwise.
+
     Args:
         seed_nodes (list(Track)): A list of tracks that meets user criteria
         criteria (dict()): The users criteria, used by the heuritsic function
         total_duration (int): User-specified runtime in milliseconds.
+        catalog (TrackCatalog): Optional in-memory catalog to generate from.
+        candidate_budget (int): Optional limit on candidates scored per step.
+        rng (random.Random): Source of every random choice made, so that a
+            seeded generator reproduces a playlist from the same catalog.
+        storage (GraphStorage): Where related tracks are read from when
+            there is no catalog, by default the configured graph storage.
 
     Returns:
         dict(): A dict containing serialized tracks, and the total runtime
             in minutes.
     """
-    heuristic_dict = {}
+    records = list(iter_generate(
+        seed_nodes, criteria, total_duration, user_tracks, user_time_window,
+        catalog, candidate_budget, rng, storage
+    ))
+    response = {
+        'tracks': [record['track'] for record in records[:-1]],
+        'total_duration': records[-1]['total_duration']
+    }
+
+    return response
+
+
+def iter_generate(
+    seed_nodes, criteria, total_duration, user_tracks, user_time_window=1,
+    catalog=None, candidate_budget=None, rng=random, storage=None
+):
+    """
+    Generates a playlist in the same way as generate, one track at a time.
+
+    Each track is yielded as soon as it is added to the playlist, so the
+    first is available before any others are chosen.
+
+    Args are the same as generate.
+
+    Yields:
+        dict(): {'track': serialized track} for each track in order, and
+            lastly {'total_duration': runtime in minutes}.
+    """
+    started = time.perf_counter()
+    catalog, seed_nodes, user_tracks = _to_catalog(
+        catalog, seed_nodes, user_tracks
+    )
+    if catalog is None and storage is None:
+        storage = GraphStorage.get_instance()
+    steps = _generate_steps(
+        seed_nodes, total_duration, user_tracks, user_time_window, catalog,
+        rng
+    )
+    next_track = None
+    step_count = 0
+    try:
+        while True:
+            event = steps.send(next_track)
+            next_track = None
+            if event[0] == TRACK_ADDED:
+                with timing.phase(timing.SERIALIZATION):
+                    record = {'track': event[1].serialize}
+                yield record
+                continue
+
+            _, current_track, played, current_total = event
+            step_count += 1
+            if catalog is None:
+                next_track = _choose_next_track(
+                    criteria, current_track, played, total_duration,
+                    current_total, candidate_budget, rng, storage
+                )
+            else:
+                next_track = _choose_next_catalog_track(
+                    catalog, criteria, current_track, played,
+                    total_duration, current_total, candidate_budget, rng
+                )
+    except StopIteration as stop:
+        metrics.observe_generation(
+            total_duration, time.perf_counter() - started, step_count
+        )
+        yield {'total_duration': milliseconds_to_minutes(stop.value)}
+
+
+async def agenerate(
+    seed_nodes, criteria, total_duration, user_tracks, user_time_window=1,
+    catalog=None, candidate_budget=None, rng=random, storage=None
+):
+    """
+    Generates a playlist in the same way as generate, without blocking the
+    event loop.
+
+    Each step of a generation from the graph, fetching the neighborhood and
+    scoring its candidates, is awaited in one thread of the event loop's
+    default executor. A thread is only held for a step at a time, rather
+    than for the whole of the generation, and the event loop is never
+    blocked by scoring. That executor has min(32, cpu_count + 4) threads,
+    shared by every request of the process, so no more steps than that run
+    at once, and the rest wait for a thread. Generating from a catalog makes
+    no queries, and so never leaves the event loop.
+
+    Args and Returns are the same as generate.
+    """
+    started = time.perf_counter()
+    catalog, seed_nodes, user_tracks = _to_catalog(
+        catalog, seed_nodes, user_tracks
+    )
+    if catalog is None and storage is None:
+        storage = GraphStorage.get_instance()
+    steps = _generate_steps(
+        seed_nodes, total_duration, user_tracks, user_time_window, catalog,
+        rng
+    )
+    playlist = []
+    next_track = None
+    step_count = 0
+    try:
+        while True:
+            event = steps.send(next_track)
+            next_track = None
+            if event[0] == TRACK_ADDED:
+                playlist.append(event[1])
+                continue
+
+            _, current_track, played, current_total = event
+            step_count += 1
+            if catalog is None:
+                next_track = await sync_to_async(
+                    _choose_next_track, thread_sensitive=False
+                )(
+                    criteria, current_track, played, total_duration,
+                    current_total, candidate_budget, rng, storage
+                )
+            else:
+                next_track = _choose_next_catalog_track(
+                    catalog, criteria, current_track, played,
+                    total_duration, current_total, candidate_budget, rng
+                )
+    except StopIteration as stop:
+        current_total = stop.value
+    metrics.observe_generation(
+        total_duration, time.perf_counter() - started, step_count
+    )
 
+    with timing.phase(timing.SERIALIZATION):
+        response = {
+            'tracks': [track.serialize for track in playlist],
+            'total_duration': milliseconds_to_minutes(current_total)
+        }
+
+    return response
+
+
+def _generate_steps(
+    seed_nodes, total_duration, user_tracks, user_time_window, catalog, rng
+):
+    """
+    Runs the main loop of generate, without choosing tracks itself.
+
+    This yields (TRACK_ADDED, track) as each track is added to the playlist.
+    Whenever the next track has to be chosen from the graph, it yields
+    (CHOOSE_NEXT_TRACK, current track, played tracks, current runtime), and
+    expects the chosen track to be sent back. This lets each form of
+    generate share the loop, while fetching related tracks differently.
+
+    Returns:
+        int: The runtime of the playlist in milliseconds, as the value of
+            StopIteration.
+    """
     time_window = minutes_to_milliseconds(user_time_window)
 
+    recorder = generation_trace.current()
     just_added_user_track = False
     if user_tracks:
         current_track = user_tracks[0]
@@ -87,19 +306,23 @@ def generate(
             total_duration / len(user_tracks)
         )
         just_added_user_track = True
+        source, candidates = generation_trace.USER, None
     else:
-        current_track = random.choice(seed_nodes)
+        current_track = rng.choice(seed_nodes)
+        source, candidates = generation_trace.SEED, len(seed_nodes)
+    if recorder is not None:
+        recorder.record(source, current_track.uuid, candidates)
 
     current_total = current_track.duration
-    playlist = [current_track]
+    track_count = 1
+    played = PlayedTracks(catalog)
+    played.add(current_track)
     logger.info(
         f'Starting track: {current_track.artist}: {current_track.title}'
     )
+    yield TRACK_ADDED, current_track
     time_left = True
     while time_left:
-        # Clear existing heuristic values
-        heuristic_dict.clear()
-
         if (
             user_tracks and (
                 (
@@ -114,52 +337,155 @@ def generate(
                 )
             )
         ):
-            logger.info('Using user requested track.')
             next_track = user_tracks[0]
             user_tracks.remove(next_track)
             just_added_user_track = True
+            if recorder is not None:
+                recorder.record(generation_trace.USER, next_track.uuid)
         else:
             just_added_user_track = False
-            # Get link nodes which connect to all related tracks.
-            logger.info('Getting related tracks.')
-            related_tracks = _get_related_tracks(current_track)
-
-            # Main loop
-            logger.info('Calculating heuristic values.')
-            for track in related_tracks:
-                if (
-                    not _h_value_exists(heuristic_dict, track.uuid) and
-                    track not in playlist
-                ):
-                    heuristic_dict[track.uuid] = _calculate_heuristic_value(
+            next_track = yield (
+                CHOOSE_NEXT_TRACK, current_track, played, current_total
+            )
+
+        track_count += 1
+        played.add(next_track)
+        current_total += next_track.duration
+        yield TRACK_ADDED, next_track
+
+        # Checked first, so nothing is formatted unless it will be logged.
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                f'Next track: {next_track.artist}: {next_track.title}, '
+                f'track count: {track_count}, runtime: '
+                f'{milliseconds_to_minutes(current_total)}'
+            )
+
+        time_left = _is_time_remaining(
+            total_duration, current_total, time_window
+        )
+
+    return current_total
+
+
+def _to_catalog(catalog, seed_nodes, user_tracks):
+    """
+    Returns the catalog, with the seed nodes and user tracks as catalog
+    tracks.
+
+    Seeds and user tracks are found in the graph, which may have tracks
+    added since the catalog was loaded. If any of them are missing from the
+    catalog, None is returned in its place, with the tracks unchanged, so
+    that the playlist is generated from the graph instead.
+    """
+    if catalog is None:
+        return catalog, seed_nodes, user_tracks
+
+    try:
+        return (
+            catalog, _to_catalog_tracks(catalog, seed_nodes),
+            _to_catalog_tracks(catalog, user_tracks)
+        )
+    except KeyError as err:
+        logger.warning(
+            f'Track {err} is not in the catalog, generating from the graph.'
+        )
+        return None, seed_nodes, user_tracks
+
+
+def _to_catalog_tracks(catalog, tracks):
+    if not tracks:
+        return tracks
+
+    return [catalog.track(catalog.index_of(track.uuid)) for track in tracks]
+
+
+def _choose_next_track(
+    criteria, current_track, played, total_duration, current_total,
+    candidate_budget=None, rng=random, storage=None
+):
+    if storage is None:
+        storage = GraphStorage.get_instance()
+
+    # Get all tracks which share a link node with the current track.
+    logger.debug('Getting related tracks.')
+    with timing.phase(timing.NEIGHBORS_CACHE):
+        related_tracks = storage.get_neighbors(
+            current_track, candidate_budget, rng, played
+        )
+
+    return _pick_next_track(
+        criteria, current_track, related_tracks, played, total_duration,
+        current_total, rng
+    )
+
+
+def _pick_next_track(
+    criteria, current_track, related_tracks, played, total_duration,
+    current_total, rng=random
+):
+    # Main loop. Candidates are scored and offered in a single pass, so
+    # selection is timed as part of scoring.
+    logger.debug('Calculating heuristic values.')
+    best_candidate = BestCandidate(rng)
+    candidate_count = 0
+    with timing.phase(timing.SCORING):
+        for track in related_tracks:
+            if track not in played:
+                candidate_count += 1
+                best_candidate.offer(
+                    track,
+                    _calculate_heuristic_value(
                         criteria, current_track, track,
                         total_duration, current_total
                     )
+                )
+    metrics.CANDIDATES_SCORED.observe(candidate_count)
 
-            # Bucket tracks accoriding to H-Value
-            h_buckets = _bucket_tracks_by_h_value(heuristic_dict)
+    # Pick next track randomly from those with best H-Value
+    next_track = best_candidate.pick()
 
-            next_track = _get_next_track(h_buckets)
+    recorder = generation_trace.current()
+    if recorder is not None:
+        recorder.record(
+            generation_trace.GRAPH, next_track.uuid, candidate_count,
+            best_candidate.h_value, best_candidate.ties
+        )
 
-        playlist.append(next_track)
-        current_total += next_track.duration
+    return next_track
 
-        logger.info(f'Next track: {next_track.artist}: {next_track.title}')
-        logger.info(f'Current track count: {len(playlist)}')
-        logger.info(
-            f'Current runtime: {milliseconds_to_minutes(current_total)}'
+
+def _choose_next_catalog_track(
+    catalog, criteria, current_track, played, total_duration, current_total,
+    candidate_budget=None, rng=random
+):
+    with timing.phase(timing.NEIGHBORS_CACHE):
+        candidates = catalog.neighbors(
+            current_track.catalog_index, candidate_budget, rng, played.mask
         )
+    metrics.CANDIDATES_SCORED.observe(len(candidates))
 
-        time_left = _is_time_remaining(
-            total_duration, current_total, time_window
+    logger.debug('Calculating heuristic values.')
+    with timing.phase(timing.SCORING):
+        h_values = _calculate_heuristic_values(
+            catalog, criteria, current_track.catalog_index, candidates,
+            total_duration, current_total
         )
 
-    response = {
-        'tracks': [track.serialize for track in playlist],
-        'total_duration': milliseconds_to_minutes(current_total)
-    }
+    # Pick next track randomly from those with best H-Value
+    with timing.phase(timing.SELECTION):
+        best_h_value = h_values.max()
+        best_candidates = candidates[h_values == best_h_value].tolist()
+        next_track = catalog.track(rng.choice(best_candidates))
+
+    recorder = generation_trace.current()
+    if recorder is not None:
+        recorder.record(
+            generation_trace.GRAPH, next_track.uuid, len(candidates),
+            int(best_h_value), len(best_candidates)
+        )
 
-    return response
+    return next_track
 
 
 def _in_user_track_interval(
@@ -171,15 +497,6 @@ def _in_user_track_interval(
     )
 
 
-def _h_value_exists(heurstic_dict, uuid):
-    try:
-        heurstic_dict[uuid]
-    except KeyError:
-        return False
-    else:
-        return True
-
-
 def _is_time_remaining(total_duration, current_total, time_window):
     time_left = True
     time_remaining = total_duration - current_total
@@ -189,27 +506,6 @@ def _is_time_remaining(total_duration, current_total, time_window):
     return time_left
 
 
-def _get_next_track(h_buckets):
-    best_h_value = max(h_buckets.keys())
-
-    # Pick next track randomly from those with best H-Value
-    next_track_uuid = random.choice(h_buckets[best_h_value])
-    next_track = Track.nodes.get(uuid=next_track_uuid)
-    return next_track
-
-
-def _bucket_tracks_by_h_value(heuristic_dict):
-    h_buckets = {}
-
-    for uuid, h_value in heuristic_dict.items():
-        try:
-            h_buckets[h_value].append(uuid)
-        except KeyError:
-            h_buckets[h_value] = [uuid]
-
-    return h_buckets
-
-
 def _calculate_heuristic_value(
     criteria, current_track, track, total_duration, current_total
 ):
@@ -224,6 +520,121 @@ def _calculate_heuristic_value(
     return h_value
 
 
+def _calculate_heuristic_values(
+    catalog, criteria, current_index, candidates, total_duration,
+    current_total
+):
+    """
+    Calculates the heuristic value of every candidate at once.
+
+    This is the batch form of `_calculate_heuristic_value`, working on the
+    catalog columns for the candidate indices. Each term gives the same
+    result as its scalar counterpart.
+
+    Args:
+        catalog (TrackCatalog): The catalog holding the tracks.
+        criteria (dict()): The users criteria.
+        current_index (int): Catalog index of the current track.
+        candidates (numpy.ndarray): Catalog indices of the tracks to score.
+        total_duration (int): User-specified runtime in milliseconds.
+        current_total (int): Current runtime in milliseconds.
+
+    Returns:
+        numpy.ndarray: The heuristic value of each candidate, in order.
+    """
+    h_values = np.zeros(len(candidates), dtype=np.int64)
+
+    h_values += _matches_user_criteria_batch(catalog, criteria, candidates)
+    h_values += _original_performance_batch(catalog, criteria, candidates)
+    h_values += _matches_current_track_batch(
+        catalog, current_index, candidates
+    )
+    h_values += _contains_keywords_batch(catalog, current_index, candidates)
+    h_values += _check_remaining_time_batch(
+        catalog, candidates, total_duration, current_total
+    )
+
+    return h_values
+
+
+def _check_remaining_time_batch(
+    catalog, candidates, total_duration, current_total
+):
+    three_minutes_in_milliseconds = minutes_to_milliseconds(3)
+
+    time_remaining = total_duration - current_total
+    if time_remaining >= three_minutes_in_milliseconds:
+        return 0
+
+    tmp_totals = current_total + catalog.durations[candidates]
+    distance_from_zero = np.abs(total_duration - tmp_totals)
+    return np.where(distance_from_zero < three_minutes_in_milliseconds, 5, 0)
+
+
+def _contains_keywords_batch(catalog, current_index, candidates):
+    shared_keywords = (
+        catalog.keyword_masks[candidates] &
+        catalog.keyword_masks[current_index]
+    )
+    return 5 * _popcount(shared_keywords)
+
+
+def _popcount(masks):
+    bytes_per_mask = masks.dtype.itemsize
+    return POPCOUNT_TABLE[
+        np.ascontiguousarray(masks).view(np.uint8)
+    ].reshape(-1, bytes_per_mask).sum(axis=1)
+
+
+def _matches_current_track_batch(catalog, current_index, candidates):
+    h_values = np.zeros(len(candidates), dtype=np.int64)
+
+    for column in (
+        catalog.positions, catalog.original_artist_ids, catalog.years
+    ):
+        h_values += np.where(
+            column[candidates] == column[current_index], 5, 0
+        )
+
+    return h_values
+
+
+def _original_performance_batch(catalog, criteria, candidates):
+    if 'original_artist' not in criteria.keys():
+        return 0
+
+    is_original = (
+        catalog.artist_ids[candidates] ==
+        catalog.original_artist_ids[candidates]
+    )
+    return np.where(is_original, -5, 0)
+
+
+def _matches_user_criteria_batch(catalog, criteria, candidates):
+    h_values = np.zeros(len(candidates), dtype=np.int64)
+
+    for key, value in criteria.items():
+        try:
+            column, value = _criteria_column(catalog, key, value)
+        except KeyError:
+            # Mirrors getattr(track, key) == value never matching, such as
+            # a relationship manager compared against a keyword.
+            continue
+
+        h_values += np.where(column[candidates] == value, 10, 0)
+
+    return h_values
+
+
+def _criteria_column(catalog, key, value):
+    if key == 'original_artist' and isinstance(value, (str, type(None))):
+        return catalog.original_artist_ids, catalog.artist_id(value)
+    if key in CATALOG_COLUMNS and isinstance(value, numbers.Number):
+        return getattr(catalog, CATALOG_COLUMNS[key]), value
+
+    raise KeyError(key)
+
+
 def _check_remaining_time(track, total_duration, current_total):
     h_value = 0
 
@@ -240,13 +651,12 @@ def _check_remaining_time(track, total_duration, current_total):
 
 
 def _contains_keywords(current_track, track):
-    h_value = 0
-
-    for keyword in KEYWORDS:
-        if keyword in track.title and keyword in current_track.title:
-            h_value += 5
+    shared_keywords = (
+        get_track_keyword_mask(track) &
+        get_track_keyword_mask(current_track)
+    )
 
-    return h_value
+    return 5 * bin(shared_keywords).count('1')
 
 
 def _matches_current_track(current_track, track):
@@ -281,26 +691,3 @@ def _matches_user_criteria(criteria, track):
             h_value += 10
 
     return h_value
-
-
-def _get_related_tracks(current_track):
-    related_tracks = []
-    track_cache = TrackCache.get_instance()
-
-    for rel in ATTR_TO_REL.values():
-        try:
-            link_node = getattr(current_track, rel).all()[0]
-        except IndexError:
-            logger.debug(f'Missing key: {rel}')
-        else:
-            try:
-                linked_tracks = track_cache.get_tracks_from_link_node(
-                    link_node.uuid
-                )
-            except KeyError:
-                linked_tracks = getattr(link_node, rel).all()
-                track_cache.add_result_to_cache(link_node.uuid, linked_tracks)
-
-            related_tracks.extend(linked_tracks)
-
-    return related_tracks
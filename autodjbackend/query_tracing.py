@@ -0,0 +1,165 @@
+import contextlib
+import contextvars
+import functools
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+import neomodel.util
+from django.conf import settings
+
+from autodjbackend import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Longest statement kept in a trace, in characters.
+MAX_STATEMENT_LENGTH = 500
+
+_current_trace = contextvars.ContextVar('query_trace', default=None)
+
+
+class QueryBudgetExceeded(RuntimeError):
+    """
+    Raised when a request makes more queries than its budget allows, and
+    NEO4J_QUERY_BUDGET_ACTION is 'raise'.
+    """
+
+
+class QueryTrace:
+    """
+    The Neo4j queries made by one request: how many, their total latency,
+    and the slowest statements.
+
+    A budget of 0 allows any number of queries. Otherwise, the query which
+    goes over it is logged, or with an action of 'raise', is never sent and
+    raises QueryBudgetExceeded.
+    """
+
+    def __init__(self, budget=0, action='log', slowest_count=5):
+        self.budget = budget
+        self.action = action
+        self.slowest_count = slowest_count
+        self.count = 0
+        self.seconds = 0.0
+        self._slowest = []
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+
+    def start_query(self, statement):
+        with self._lock:
+            self.count += 1
+            count = self.count
+        if not self.budget or count != self.budget + 1:
+            return
+
+        message = (
+            f'Query budget of {self.budget} exceeded by: '
+            f'{_truncate(statement)}'
+        )
+        if self.action == 'raise':
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
+
+    def finish_query(self, statement, seconds):
+        # Ties are broken by order, so statements are never compared.
+        entry = (seconds, next(self._order), statement)
+        with self._lock:
+            self.seconds += seconds
+            if len(self._slowest) < self.slowest_count:
+                heapq.heappush(self._slowest, entry)
+            elif self._slowest and entry > self._slowest[0]:
+                heapq.heapreplace(self._slowest, entry)
+
+    def slowest(self):
+        """
+        Returns (seconds, statement) for the slowest queries, slowest first.
+        """
+        with self._lock:
+            entries = sorted(self._slowest, reverse=True)
+
+        return [
+            (seconds, _truncate(statement))
+            for seconds, _, statement in entries
+        ]
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total_ms': round(self.seconds * 1000, 3),
+            'slowest': [
+                {'statement': statement, 'ms': round(seconds * 1000, 3)}
+                for seconds, statement in self.slowest()
+            ],
+        }
+
+
+@contextlib.contextmanager
+def trace_queries(budget=None, action=None):
+    """
+    Traces every Neo4j query made within the block, including in threads
+    started from it with sync_to_async, which copy the context.
+
+    The budget and action default to NEO4J_QUERY_BUDGET and
+    NEO4J_QUERY_BUDGET_ACTION. When the block ends, the query count is
+    recorded in the per request metric, and the trace is logged.
+
+    Yields:
+        QueryTrace: The trace the queries are recorded in.
+    """
+    trace = QueryTrace(
+        settings.NEO4J_QUERY_BUDGET if budget is None else budget,
+        settings.NEO4J_QUERY_BUDGET_ACTION if action is None else action,
+        settings.NEO4J_SLOWEST_QUERIES
+    )
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        metrics.NEO4J_QUERIES_PER_REQUEST.observe(trace.count)
+        logger.debug(
+            f'Neo4j queries: {trace.count}, total: '
+            f'{trace.seconds * 1000:.3f}ms, slowest: {trace.slowest()}'
+        )
+
+
+def instrument_neomodel():
+    """
+    Wraps Database.cypher_query to count and trace queries. Every neomodel
+    query goes through it, including those of NodeSets and relationship
+    managers. Called once, when the app is ready.
+
+    neomodel.db is thread local, so the method is wrapped on its class
+    rather than on neomodel.db, which would only cover the calling thread.
+    """
+    cypher_query = neomodel.util.Database.cypher_query
+    if getattr(cypher_query, 'instrumented', False) is True:
+        return
+
+    @functools.wraps(cypher_query)
+    def traced_cypher_query(self, query, *args, **kwargs):
+        metrics.NEO4J_QUERIES.inc()
+        trace = _current_trace.get()
+        if trace is None:
+            return cypher_query(self, query, *args, **kwargs)
+
+        trace.start_query(query)
+        start = time.perf_counter()
+        try:
+            return cypher_query(self, query, *args, **kwargs)
+        finally:
+            trace.finish_query(query, time.perf_counter() - start)
+
+    traced_cypher_query.instrumented = True
+    neomodel.util.Database.cypher_query = traced_cypher_query
+
+
+def _truncate(statement):
+    statement = ' '.join(str(statement).split())
+    if len(statement) <= MAX_STATEMENT_LENGTH:
+        return statement
+
+    return statement[:MAX_STATEMENT_LENGTH] + '...'
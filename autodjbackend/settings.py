@@ -39,6 +39,101 @@ NEOMODEL_NEO4J_BOLT_URL = os.environ.get(
     'NEO4J_BOLT_URL', 'bolt://neo4j:test@db:7687'
 )
 
+# Load every track into memory at startup, and generate playlists from it.
+TRACK_CATALOG_ENABLED = (
+    os.environ.get('TRACK_CATALOG_ENABLED', 'False') == 'True'
+)
+# Catalog file written by `manage.py build_track_catalog`. When set, the
+# catalog is memory mapped from it instead of loaded from Neo4j, and the
+# track cache reads link nodes from it.
+TRACK_CATALOG_PATH = os.environ.get('TRACK_CATALOG_PATH')
+
+# Link node cache. The backend is 'local' for a per-process cache, or
+# 'django' to share one memcached or Redis cache between workers, as
+# configured with TRACK_CACHE_DJANGO_BACKEND and TRACK_CACHE_LOCATION below.
+# The TTL is in seconds. The size limits only apply to the local backend,
+# with TRACK_CACHE_MAX_ENTRIES counting link nodes and TRACK_CACHE_MAX_TRACKS
+# counting tracks whose link nodes are cached.
+TRACK_CACHE_BACKEND = os.environ.get('TRACK_CACHE_BACKEND', 'local')
+TRACK_CACHE_ALIAS = os.environ.get('TRACK_CACHE_ALIAS', 'track_cache')
+TRACK_CACHE_TTL = int(os.environ.get('TRACK_CACHE_TTL', 3600))
+TRACK_CACHE_MAX_ENTRIES = int(
+    os.environ.get('TRACK_CACHE_MAX_ENTRIES', 4096)
+)
+TRACK_CACHE_MAX_BYTES = int(
+    os.environ.get('TRACK_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+)
+TRACK_CACHE_STRIPES = int(os.environ.get('TRACK_CACHE_STRIPES', 16))
+TRACK_CACHE_MAX_TRACKS = int(
+    os.environ.get('TRACK_CACHE_MAX_TRACKS', 2000000)
+)
+# The most cached link node uuids sent with a neighborhood query, so that
+# Neo4j doesn't return their tracks again.
+TRACK_CACHE_MAX_QUERY_UUIDS = int(
+    os.environ.get('TRACK_CACHE_MAX_QUERY_UUIDS', 1000)
+)
+# Catalog file written by `manage.py warm_track_cache --snapshot`, memory
+# mapped by each worker at startup, when TRACK_CATALOG_PATH isn't set.
+TRACK_CACHE_SNAPSHOT_PATH = os.environ.get('TRACK_CACHE_SNAPSHOT_PATH')
+
+# The most candidate tracks scored at each step of playlist generation, or 0
+# to score every related track. The budget is split between the current
+# track's link nodes, and only link nodes larger than their share are
+# sampled.
+PLAYLIST_CANDIDATE_BUDGET = int(
+    os.environ.get('PLAYLIST_CANDIDATE_BUDGET', 0)
+)
+
+# Web server processes on each host, as set for gunicorn.
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+# Worker processes shared by every request to /api/generate/batch/ of one
+# web server process. Each web server process starts its own pool, so by
+# default the CPUs are divided between them. Workers only share the
+# catalog's memory when it is mapped from TRACK_CATALOG_PATH, and otherwise
+# each loads its own copy. Also the most playlists a single batch may ask
+# for, and the seconds a batch waits for them, or 0 to wait until they are
+# all generated.
+PLAYLIST_BATCH_WORKERS = int(
+    os.environ.get(
+        'PLAYLIST_BATCH_WORKERS',
+        max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)
+    )
+)
+PLAYLIST_BATCH_MAX_SIZE = int(os.environ.get('PLAYLIST_BATCH_MAX_SIZE', 100))
+PLAYLIST_BATCH_TIMEOUT = float(os.environ.get('PLAYLIST_BATCH_TIMEOUT', 0))
+
+# Cache of playlists generated for seeded requests, with the TTL in seconds.
+PLAYLIST_CACHE_ALIAS = os.environ.get('PLAYLIST_CACHE_ALIAS', 'default')
+PLAYLIST_CACHE_TTL = int(os.environ.get('PLAYLIST_CACHE_TTL', 3600))
+
+# Where the track graph is read from: 'neo4j', or 'memory' to build it in
+# memory from the scrubbed MusicBrainz dump at GRAPH_STORAGE_MBDUMP_PATH.
+GRAPH_STORAGE_BACKEND = os.environ.get('GRAPH_STORAGE_BACKEND', 'neo4j')
+GRAPH_STORAGE_MBDUMP_PATH = os.environ.get(
+    'GRAPH_STORAGE_MBDUMP_PATH', './mbdump/scrubbed_data.csv'
+)
+
+# Most Neo4j queries a single playlist request may make, or 0 for no limit.
+# The query going over the budget is logged, or with
+# NEO4J_QUERY_BUDGET_ACTION set to 'raise', fails the request. The slowest
+# NEO4J_SLOWEST_QUERIES statements of each request are kept in its trace.
+NEO4J_QUERY_BUDGET = int(os.environ.get('NEO4J_QUERY_BUDGET', 0))
+NEO4J_QUERY_BUDGET_ACTION = os.environ.get(
+    'NEO4J_QUERY_BUDGET_ACTION', 'log'
+)
+NEO4J_SLOWEST_QUERIES = int(os.environ.get('NEO4J_SLOWEST_QUERIES', 5))
+
+# Fraction of playlist requests whose generation is traced step by step, and
+# logged, and the most steps kept in each trace. A trace can also be
+# requested with ?debug=trace.
+GENERATION_TRACE_SAMPLE_RATE = float(
+    os.environ.get('GENERATION_TRACE_SAMPLE_RATE', 0)
+)
+GENERATION_TRACE_CAPACITY = int(
+    os.environ.get('GENERATION_TRACE_CAPACITY', 256)
+)
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -49,7 +144,7 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'django_neomodel',
-    'autodjbackend',
+    'autodjbackend.apps.AutodjbackendConfig',
 ]
 
 MIDDLEWARE = [
@@ -94,6 +189,26 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+}
+
+# Cache holding the track cache with the django backend, shared by every
+# worker. It has to be memcached or Redis, so it is only configured when
+# TRACK_CACHE_DJANGO_BACKEND and TRACK_CACHE_LOCATION are set.
+if os.environ.get('TRACK_CACHE_DJANGO_BACKEND'):
+    CACHES[TRACK_CACHE_ALIAS] = {
+        'BACKEND': os.environ['TRACK_CACHE_DJANGO_BACKEND'],
+        'LOCATION': os.environ.get('TRACK_CACHE_LOCATION'),
+        'TIMEOUT': TRACK_CACHE_TTL,
+    }
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -0,0 +1,70 @@
+import concurrent.futures
+import math
+import threading
+import unittest
+
+from django.test import override_settings
+
+from autodjbackend import batch_generator
+
+
+class TestBatchGenerator(unittest.TestCase):
+
+    def test_run_batch_in_order(self):
+        expected_value = [2.0, 3.0, 4.0]
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            actual_value = batch_generator.run_batch(
+                math.sqrt, [4, 9, 16], executor
+            )
+
+        self.assertListEqual(expected_value, actual_value)
+
+    def test_run_batch_item_error(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            actual_value = batch_generator.run_batch(
+                math.sqrt, [4, -1, 9], executor
+            )
+
+        assert actual_value[0] == 2.0
+        assert actual_value[1]['status'] == 500
+        assert actual_value[2] == 3.0
+
+    def test_run_batch_timeout(self):
+        release = threading.Event()
+
+        def wait(item):
+            release.wait(5)
+            return item
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            try:
+                actual_value = batch_generator.run_batch(
+                    wait, [1, 2], executor, timeout=0.01
+                )
+            finally:
+                release.set()
+
+        assert actual_value[0]['status'] == 504
+        assert actual_value[1]['status'] == 504
+
+    @override_settings(PLAYLIST_BATCH_TIMEOUT=5)
+    def test_run_batch_timeout_setting(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            actual_value = batch_generator.run_batch(
+                math.sqrt, [4, 9], executor
+            )
+
+        self.assertListEqual([2.0, 3.0], actual_value)
+
+    @override_settings(PLAYLIST_BATCH_WORKERS=2)
+    def test_run_batch_process_pool(self):
+        expected_value = [2.0, 3.0]
+
+        try:
+            actual_value = batch_generator.run_batch(math.sqrt, [4, 9])
+        finally:
+            batch_generator.get_executor().shutdown()
+            batch_generator._executor = None
+
+        self.assertListEqual(expected_value, actual_value)
@@ -0,0 +1,78 @@
+import unittest
+from unittest import mock
+
+from django.test import override_settings
+
+from autodjbackend import generation_trace
+
+
+class TestGenerationTrace(unittest.TestCase):
+
+    def test_ring_buffer(self):
+        recorder = generation_trace.GenerationTrace(2)
+        recorder.record(generation_trace.SEED, 'a', 1)
+        recorder.record(generation_trace.USER, 'b')
+        recorder.record(generation_trace.GRAPH, 'c', 10, 15, 2)
+
+        expected_value = {
+            'step_count': 3,
+            'dropped': 1,
+            'steps': [
+                {
+                    'step': 1, 'source': 'user', 'uuid': 'b',
+                    'candidates': None, 'best_h_value': None,
+                    'bucket_size': None,
+                },
+                {
+                    'step': 2, 'source': 'graph', 'uuid': 'c',
+                    'candidates': 10, 'best_h_value': 15, 'bucket_size': 2,
+                },
+            ],
+        }
+
+        self.assertDictEqual(expected_value, recorder.as_dict())
+
+
+class TestRecordSteps(unittest.TestCase):
+
+    @override_settings(GENERATION_TRACE_SAMPLE_RATE=0)
+    def test_record_steps_disabled(self):
+        with mock.patch.object(
+            generation_trace._sampler, 'random'
+        ) as mocked_random:
+            with generation_trace.record_steps() as recorder:
+                assert generation_trace.current() is None
+
+        assert recorder is None
+        mocked_random.assert_not_called()
+
+    @override_settings(GENERATION_TRACE_CAPACITY=5)
+    def test_record_steps_requested(self):
+        with generation_trace.record_steps(True) as recorder:
+            assert generation_trace.current() is recorder
+
+        assert recorder.steps.maxlen == 5
+        assert generation_trace.current() is None
+
+    @override_settings(GENERATION_TRACE_SAMPLE_RATE=0.5)
+    def test_record_steps_sampled(self):
+        with mock.patch.object(
+            generation_trace._sampler, 'random', return_value=0.25
+        ):
+            with self.assertLogs(
+                'autodjbackend.generation_trace', 'INFO'
+            ) as logs:
+                with generation_trace.record_steps() as recorder:
+                    recorder.record(generation_trace.SEED, 'a', 1)
+
+        assert '"uuid": "a"' in logs.output[0]
+
+    @override_settings(GENERATION_TRACE_SAMPLE_RATE=0.5)
+    def test_record_steps_not_sampled(self):
+        with mock.patch.object(
+            generation_trace._sampler, 'random', return_value=0.75
+        ):
+            with generation_trace.record_steps() as recorder:
+                pass
+
+        assert recorder is None
@@ -0,0 +1,315 @@
+import io
+import random
+import unittest
+from unittest import mock
+
+from django.test import override_settings
+
+from autodjbackend import graph_storage
+from autodjbackend.graph_storage import InMemoryGraphStorage
+from autodjbackend.models import Track
+from autodjbackend.playlist_generator import PlayedTracks
+from autodjbackend.tests.test_track_catalog import build_test_catalog
+from autodjbackend.track_cache import TrackCache
+
+
+MBDUMP_LINES = [
+    'Love River,180000,Artist A,Album,1990,1,Artist A\n',
+    'Love River,180000,Artist A,Album,1990,1,Artist A\n',
+    'Hello,200000,Artist B,Album,1990,2,Artist A\n',
+    'Old Song,200000,Artist C,Album,1950,1,Artist C\n',
+    'Bad Line,abc,Artist D,Album,1990,1,Artist D\n',
+    'Short,Line\n',
+]
+
+
+class TestGraphStorage(unittest.TestCase):
+
+    def test_incomplete_storage(self):
+        class IncompleteGraphStorage(graph_storage.GraphStorage):
+            def get_tracks(self, uuids):
+                return []
+
+        with self.assertRaises(TypeError):
+            IncompleteGraphStorage()
+
+
+class TestNeo4jGraphStorage(unittest.TestCase):
+
+    def test_get_related_tracks_single_query(self):
+        track_a = {'uuid': 'a', 'title': 'a'}
+        track_b = {'uuid': 'b', 'title': 'b'}
+        test_results = [
+            ('SAME_YEAR', 'y1990', False, [track_a, track_b]),
+            ('SAME_NUMBER', 'n1', False, [track_b]),
+        ]
+
+        with mock.patch.object(
+            TrackCache, 'get_instance', return_value=TrackCache()
+        ):
+            with mock.patch(
+                'neomodel.db.cypher_query', return_value=(test_results, None)
+            ) as mocked_cypher_query:
+                related_tracks = graph_storage._get_related_tracks(
+                    Track(uuid='a')
+                )
+
+        mocked_cypher_query.assert_called_once()
+        self.assertListEqual(
+            ['b', 'a'], [track.uuid for track in related_tracks]
+        )
+
+    def test_get_related_tracks_result_order(self):
+        tracks = [{'uuid': uuid} for uuid in 'abcdef']
+        test_results = [
+            ('SAME_YEAR', 'y1990', False, tracks[:4]),
+            ('SAME_NUMBER', 'n1', False, tracks[2:]),
+        ]
+        reversed_results = [
+            (rel_type, link_uuid, is_cached, members[::-1])
+            for rel_type, link_uuid, is_cached, members in test_results[::-1]
+        ]
+        related_uuids = []
+
+        for results in [test_results, reversed_results]:
+            with mock.patch.object(
+                TrackCache, 'get_instance', return_value=TrackCache()
+            ):
+                with mock.patch(
+                    'neomodel.db.cypher_query', return_value=(results, None)
+                ):
+                    related_tracks = graph_storage._get_related_tracks(
+                        Track(uuid='a'), 4, random.Random(1)
+                    )
+            related_uuids.append([track.uuid for track in related_tracks])
+
+        self.assertListEqual(related_uuids[0], related_uuids[1])
+
+    def test_get_related_tracks_played_excluded_before_budget(self):
+        tracks = [{'uuid': uuid} for uuid in 'abcd']
+        test_results = [('SAME_YEAR', 'y1990', False, tracks)]
+        played = PlayedTracks()
+        for uuid in 'abc':
+            played.add(Track(uuid=uuid))
+
+        with mock.patch.object(
+            TrackCache, 'get_instance', return_value=TrackCache()
+        ):
+            with mock.patch(
+                'neomodel.db.cypher_query', return_value=(test_results, None)
+            ):
+                related_tracks = graph_storage._get_related_tracks(
+                    Track(uuid='a'), 1, random.Random(1), played
+                )
+
+        self.assertListEqual(['d'], [track.uuid for track in related_tracks])
+
+    @override_settings(TRACK_CACHE_MAX_QUERY_UUIDS=1)
+    def test_get_related_tracks_bounds_cached_uuids(self):
+        track_cache = TrackCache()
+        track_cache.add_result_to_cache('n1', [Track(uuid='c')])
+        track_cache.add_result_to_cache(
+            'y1990', [Track(uuid='d'), Track(uuid='e')]
+        )
+
+        with mock.patch.object(
+            TrackCache, 'get_instance', return_value=track_cache
+        ):
+            with mock.patch(
+                'neomodel.db.cypher_query', return_value=([], None)
+            ) as mocked_cypher_query:
+                graph_storage._get_related_tracks(Track(uuid='a'))
+
+        _, params = mocked_cypher_query.call_args[0]
+        self.assertListEqual(['y1990'], params['cached'])
+
+    def test_get_related_tracks_uses_cache(self):
+        track_cache = TrackCache()
+        cached_tracks = [Track(uuid='c')]
+        track_cache.add_result_to_cache('y1990', cached_tracks)
+        test_results = [('SAME_YEAR', 'y1990', True, [])]
+
+        with mock.patch.object(
+            TrackCache, 'get_instance', return_value=track_cache
+        ):
+            with mock.patch(
+                'neomodel.db.cypher_query', return_value=(test_results, None)
+            ) as mocked_cypher_query:
+                related_tracks = graph_storage._get_related_tracks(
+                    Track(uuid='a')
+                )
+
+        _, params = mocked_cypher_query.call_args[0]
+        self.assertListEqual(['y1990'], params['cached'])
+        self.assertListEqual(cached_tracks, related_tracks)
+
+    def test_get_related_tracks_warm_cache_no_queries(self):
+        track_cache = TrackCache()
+        cached_tracks = [Track(uuid='b'), Track(uuid='c')]
+        track_cache.add_result_to_cache('y1990', cached_tracks)
+        track_cache.add_link_nodes_of_track('a', [('SAME_YEAR', 'y1990')])
+
+        with mock.patch.object(
+            TrackCache, 'get_instance', return_value=track_cache
+        ):
+            with mock.patch(
+                'neomodel.db.cypher_query'
+            ) as mocked_cypher_query:
+                related_tracks = graph_storage._get_related_tracks(
+                    Track(uuid='a')
+                )
+
+        mocked_cypher_query.assert_not_called()
+        self.assertListEqual(cached_tracks, related_tracks)
+
+    def test_get_related_tracks_caches_missing_link_nodes(self):
+        track_cache = TrackCache()
+
+        with mock.patch.object(
+            TrackCache, 'get_instance', return_value=track_cache
+        ):
+            with mock.patch(
+                'neomodel.db.cypher_query', return_value=([], None)
+            ) as mocked_cypher_query:
+                graph_storage._get_related_tracks(Track(uuid='a'))
+                related_tracks = graph_storage._get_related_tracks(
+                    Track(uuid='a')
+                )
+
+        mocked_cypher_query.assert_called_once()
+        self.assertListEqual([], related_tracks)
+
+    def test_get_related_tracks_candidate_budget(self):
+        hub_tracks = [{'uuid': str(index)} for index in range(100)]
+        test_results = [
+            ('SAME_YEAR', 'y1990', False, hub_tracks),
+            ('SAME_ORIGINAL_ARTIST', 'oa', False, [{'uuid': 'cover'}]),
+        ]
+
+        with mock.patch.object(
+            TrackCache, 'get_instance', return_value=TrackCache()
+        ):
+            with mock.patch(
+                'neomodel.db.cypher_query', return_value=(test_results, None)
+            ):
+                related_tracks = graph_storage._get_related_tracks(
+                    Track(uuid='a'), candidate_budget=10
+                )
+
+        related_uuids = [track.uuid for track in related_tracks]
+        assert len(related_uuids) == 10
+        assert 'cover' in related_uuids
+
+    def test_get_tracks(self):
+        test_results = [[{'uuid': 'a', 'title': 'a'}], [None]]
+
+        with mock.patch(
+            'neomodel.db.cypher_query', return_value=(test_results, None)
+        ) as mocked_cypher_query:
+            actual_value = graph_storage.Neo4jGraphStorage().get_tracks(
+                ['a', 'missing']
+            )
+
+        mocked_cypher_query.assert_called_once()
+        assert actual_value[0].uuid == 'a'
+        assert actual_value[1] is None
+
+
+class TestInMemoryGraphStorage(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = InMemoryGraphStorage(build_test_catalog())
+
+    def test_get_neighbors(self):
+        expected_value = ['a', 'b', 'c']
+
+        actual_value = self.storage.get_neighbors(Track(uuid='a'))
+
+        self.assertListEqual(
+            expected_value, [track.uuid for track in actual_value]
+        )
+
+    def test_get_tracks(self):
+        actual_value = self.storage.get_tracks(['c', 'missing'])
+
+        assert actual_value[0].title == 'hello'
+        assert actual_value[1] is None
+
+    def test_get_random_seed_node(self):
+        seeds = {
+            self.storage.get_random_seed_node({'year': 1990})[0].uuid
+            for _ in range(50)
+        }
+
+        self.assertSetEqual({'a', 'b'}, seeds)
+
+    def test_get_random_seed_node_criteria(self):
+        criteria_list = [
+            ({'original_artist': 'Artist C'}, ['c']),
+            ({'keyword_in_title': 'love', 'position': 2}, ['b']),
+            ({'year': 1990, 'position': 3}, []),
+            ({'year': 'not a year'}, []),
+            ({'original_artist': 'Unknown'}, []),
+        ]
+
+        for criteria, expected_value in criteria_list:
+            actual_value = self.storage.get_random_seed_node(criteria)
+
+            self.assertListEqual(
+                expected_value, [track.uuid for track in actual_value]
+            )
+
+    def test_resolve_user_tracks(self):
+        actual_value = self.storage.resolve_user_tracks([
+            {'title': 'world', 'artist': 'Artist D'},
+            {'title': 'world', 'artist': 'Artist A'},
+            {'uuid': 'b'},
+        ])
+
+        self.assertListEqual(
+            ['d', None, 'b'],
+            [track.uuid if track else None for track in actual_value]
+        )
+
+    def test_resolve_user_tracks_invalid_property(self):
+        with self.assertRaises(ValueError):
+            self.storage.resolve_user_tracks([{'bad': 'property'}])
+
+    def test_read_mbdump_tracks(self):
+        track_rows = graph_storage.read_mbdump_tracks(MBDUMP_LINES)
+
+        self.assertListEqual(
+            [
+                ('Love River', 'Artist A', 'Album', 1990, 1, 180000,
+                 'Artist A'),
+                ('Hello', 'Artist B', 'Album', 1990, 2, 200000, 'Artist A'),
+            ],
+            [row[1:] for row in track_rows]
+        )
+        assert track_rows == graph_storage.read_mbdump_tracks(MBDUMP_LINES)
+
+    def test_from_mbdump(self):
+        with mock.patch(
+            'builtins.open', return_value=io.StringIO(''.join(MBDUMP_LINES))
+        ):
+            storage = InMemoryGraphStorage.from_mbdump('scrubbed_data.csv')
+
+        love_river = storage.resolve_user_tracks([{'title': 'Love River'}])[0]
+        neighbors = storage.get_neighbors(love_river)
+        link_nodes = storage.catalog.get_link_nodes_of_track(love_river.uuid)
+
+        assert len(neighbors) == 2
+        assert ('KEYWORD_IN_TITLE', 'keyword:love') in link_nodes
+        assert ('KEYWORD_IN_TITLE', 'keyword:river') in link_nodes
+
+    def test_from_mbdump_keyword_criteria_match_link_nodes(self):
+        with mock.patch(
+            'builtins.open', return_value=io.StringIO(''.join(MBDUMP_LINES))
+        ):
+            storage = InMemoryGraphStorage.from_mbdump('scrubbed_data.csv')
+
+        seeds = storage.get_random_seed_node({'keyword_in_title': 'love'})
+        link_nodes = storage.catalog.get_link_nodes_of_track(seeds[0].uuid)
+
+        assert seeds[0].title == 'Love River'
+        assert ('KEYWORD_IN_TITLE', 'keyword:love') in link_nodes
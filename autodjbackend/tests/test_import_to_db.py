@@ -0,0 +1,90 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from scripts import import_to_db
+
+
+DUMP_LINES = [
+    'Love River,180000,Artist A,Album,1990,1,Artist A\n',
+    'Love River,180000,Artist A,Album,1990,1,Artist A\n',
+    'Old Song,200000,Artist C,Album,1950,1,Artist C\n',
+    'No Duration,0,Artist D,Album,1990,1,Artist D\n',
+    'Short,Line\n',
+]
+
+
+class TestImportToDb(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'scrubbed_data.csv')
+        with open(self.path, 'w') as file:
+            file.writelines(DUMP_LINES)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_read_rows(self):
+        expected_value = [{
+            'title': 'Love River',
+            'duration': 180000,
+            'artist': 'Artist A',
+            'album': 'Album',
+            'year': 1990,
+            'position': 1,
+            'original_artist': 'Artist A',
+        }]
+
+        actual_value = import_to_db.read_rows(self.path)
+
+        uuids = [row.pop('uuid') for row in actual_value]
+        self.assertListEqual(expected_value, actual_value)
+        assert len(uuids[0]) == 32
+        int(uuids[0], 16)
+
+    def test_read_rows_unique_uuids(self):
+        with open(self.path, 'a') as file:
+            file.write('Hello,200000,Artist B,Album,1990,2,Artist A\n')
+
+        actual_value = import_to_db.read_rows(self.path)
+
+        assert len({row['uuid'] for row in actual_value}) == 2
+
+    def test_bulk_load_batches(self):
+        rows = [{'uuid': str(i)} for i in range(25)]
+        driver = mock.MagicMock()
+        session = driver.session.return_value.__enter__.return_value
+
+        with mock.patch('builtins.print'):
+            actual_value = import_to_db.bulk_load(driver, rows, 10, 3)
+
+        assert actual_value == 25
+        assert driver.session.call_count == 3
+        batches = [
+            call[0][1] for call in session.write_transaction.call_args_list
+        ]
+        self.assertCountEqual([10, 10, 5], [len(batch) for batch in batches])
+        self.assertCountEqual(
+            rows, [row for batch in batches for row in batch]
+        )
+
+    def test_create_tracks(self):
+        rows = [{'uuid': 'a'}, {'uuid': 'b'}]
+        tx = mock.Mock()
+
+        import_to_db._create_tracks(tx, rows)
+
+        tx.run.assert_called_once_with(
+            import_to_db.CREATE_TRACKS_QUERY, rows=rows
+        )
+        tx.run.return_value.consume.assert_called_once_with()
+        assert import_to_db.CREATE_TRACKS_QUERY.startswith(
+            'UNWIND $rows AS row CREATE (:Track {'
+        )
+        for key in [
+            'uuid', 'title', 'artist', 'album', 'year', 'position',
+            'duration', 'original_artist',
+        ]:
+            assert f'{key}: row.{key}' in import_to_db.CREATE_TRACKS_QUERY
@@ -0,0 +1,111 @@
+import threading
+import unittest
+from unittest import mock
+
+import neomodel
+
+from autodjbackend import metrics, query_tracing
+
+
+class TestCounter(unittest.TestCase):
+
+    def test_render(self):
+        counter = metrics.Counter('test_total', 'Test.', ('tier',))
+        counter.inc(labels=('b',))
+        counter.inc(2, labels=('a',))
+        counter.inc(0.5, labels=('a',))
+
+        expected_value = [
+            '# HELP test_total Test.',
+            '# TYPE test_total counter',
+            'test_total{tier="a"} 2.5',
+            'test_total{tier="b"} 1',
+        ]
+
+        self.assertListEqual(expected_value, counter.render())
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_render(self):
+        histogram = metrics.Histogram('test', 'Test.', (1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.observe(value)
+
+        expected_value = [
+            '# HELP test Test.',
+            '# TYPE test histogram',
+            'test_bucket{le="1"} 2',
+            'test_bucket{le="10"} 3',
+            'test_bucket{le="+Inf"} 4',
+            'test_sum 56.5',
+            'test_count 4',
+        ]
+
+        self.assertListEqual(expected_value, histogram.render())
+
+    def test_render_labels(self):
+        histogram = metrics.Histogram('test', 'Test.', (1,), ('minutes',))
+        histogram.observe(2, ('30',))
+
+        actual_value = histogram.render()
+
+        assert 'test_bucket{minutes="30",le="+Inf"} 1' in actual_value
+        assert 'test_count{minutes="30"} 1' in actual_value
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_requested_minutes_label(self):
+        durations = [
+            (0, '15'), (15 * 60000, '15'), (15 * 60000 + 1, '30'),
+            (240 * 60000, '240'), (241 * 60000, '+Inf'),
+        ]
+
+        for total_duration, expected_value in durations:
+            actual_value = metrics.requested_minutes_label(total_duration)
+
+            assert actual_value == expected_value
+
+    def test_neo4j_queries_counted_in_any_thread(self):
+        def cypher_query(db, query, params=None):
+            return [], None
+
+        with mock.patch.object(
+            neomodel.util.Database, 'cypher_query', cypher_query
+        ):
+            query_tracing.instrument_neomodel()
+            with mock.patch.object(metrics.NEO4J_QUERIES, 'inc') as mocked_inc:
+                thread = threading.Thread(
+                    target=neomodel.db.cypher_query, args=('RETURN 1',)
+                )
+                thread.start()
+                thread.join()
+
+        mocked_inc.assert_called_once_with()
+
+    def test_render_track_cache(self):
+        stats = {
+            'hits': 3, 'misses': 1, 'expirations': 0, 'evictions': 2,
+            'entries': 4, 'bytes': 100,
+        }
+        track_cache = mock.Mock()
+        track_cache.get_stats.return_value = {
+            'link_nodes': stats, 'track_links': stats,
+        }
+
+        with mock.patch(
+            'autodjbackend.track_cache.TrackCache._instance', track_cache
+        ):
+            actual_value = metrics.render()
+
+        assert (
+            'autodj_track_cache_hits_total{tier="link_nodes"} 3'
+            in actual_value
+        )
+        assert (
+            'autodj_track_cache_evictions_total{tier="track_links"} 2'
+            in actual_value
+        )
+        assert '# TYPE autodj_generation_seconds histogram' in actual_value
+        assert actual_value.endswith('\n')
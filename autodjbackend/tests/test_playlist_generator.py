@@ -1,32 +1,41 @@
+import collections
+import math
+import random
+import threading
 import unittest
 from unittest import mock
 
-from autodjbackend import playlist_generator
+import numpy as np
+from asgiref.sync import async_to_sync
+from django.test import override_settings
+
+from autodjbackend import generation_trace, playlist_generator
 from autodjbackend.models import Track
+from autodjbackend.track_catalog import TrackCatalog
+from autodjbackend.graph_storage import GraphStorage, InMemoryGraphStorage
+from autodjbackend.tests.test_track_catalog import build_test_catalog
 from autodjbackend.utils import minutes_to_milliseconds
 
 
-class TestPlaylistGenerator(unittest.TestCase):
-
-    def test_h_value_exists_true(self):
-        expected_value = True
-
-        key = 'key'
-        test_dict = {key: 1}
-
-        actual_value = playlist_generator._h_value_exists(test_dict, key)
-        assert expected_value == actual_value
-
-    def test_h_value_exists_faise(self):
-        expected_value = False
+def build_two_link_node_catalog():
+    # 50 tracks of 3 minutes, all in one year, and half of them in one
+    # track number.
+    track_rows = [
+        (f't{index}', f'title {index}', 'Artist', 'Album', 1990, 1, 180000,
+         'Artist')
+        for index in range(50)
+    ]
+    memberships = {
+        'same_year': [('y1990', [row[0] for row in track_rows])],
+        'same_track_number': [('n1', [row[0] for row in track_rows[:25]])],
+        'same_original_artist': [],
+        'keyword_in_title': [],
+    }
 
-        key = 'key'
-        test_dict = {key: 1}
+    return TrackCatalog.from_rows(track_rows, memberships)
 
-        bad_key = 'bad key'
 
-        actual_value = playlist_generator._h_value_exists(test_dict, bad_key)
-        assert expected_value == actual_value
+class TestPlaylistGenerator(unittest.TestCase):
 
     def test_is_time_remaining_true(self):
         expected_value = True
@@ -52,24 +61,55 @@ class TestPlaylistGenerator(unittest.TestCase):
 
         assert expected_value == actual_value
 
-    def test_bucket_tracks_by_h_value(self):
-        test_heuristic_dict = {
-            '123': 10,
-            '456': 5,
-            '789': 10,
-            '012': 5,
-        }
-
-        expected_value = {
-            10: ['123', '789'],
-            5: ['456', '012'],
-        }
-
-        actual_value = playlist_generator._bucket_tracks_by_h_value(
-            test_heuristic_dict
+    def test_best_candidate(self):
+        test_track = Track(uuid='123')
+        best_candidate = playlist_generator.BestCandidate()
+
+        best_candidate.offer(Track(uuid='456'), 5)
+        best_candidate.offer(test_track, 10)
+        best_candidate.offer(Track(uuid='789'), 5)
+
+        assert test_track is best_candidate.pick()
+
+    def test_best_candidate_empty(self):
+        best_candidate = playlist_generator.BestCandidate()
+
+        with self.assertRaises(ValueError):
+            best_candidate.pick()
+
+    def test_best_candidate_uniform_among_ties(self):
+        trials = 6000
+        rng = random.Random(0)
+        picks = collections.Counter()
+        for _ in range(trials):
+            best_candidate = playlist_generator.BestCandidate(rng)
+            for uuid, h_value in [('a', 10), ('b', 5), ('c', 10), ('d', 10)]:
+                best_candidate.offer(uuid, h_value)
+            picks[best_candidate.pick()] += 1
+
+        assert 'b' not in picks
+        for uuid in 'acd':
+            assert abs(picks[uuid] / trials - 1 / 3) < 0.03
+
+    @mock.patch('neomodel.db.cypher_query')
+    def test_choose_next_track_no_queries(self, mocked_cypher_query):
+        catalog = build_test_catalog()
+        current_track = catalog.track(0)
+        related_tracks = [catalog.track(index) for index in range(4)]
+        played = playlist_generator.PlayedTracks()
+        played.add(current_track)
+
+        storage = mock.Mock(spec=GraphStorage)
+        storage.get_neighbors.return_value = related_tracks
+
+        actual_value = playlist_generator._choose_next_track(
+            {'year': 1990}, current_track, played,
+            minutes_to_milliseconds(60), current_track.duration,
+            storage=storage
         )
 
-        self.assertDictEqual(expected_value, actual_value)
+        assert related_tracks[1] is actual_value
+        mocked_cypher_query.assert_not_called()
 
     @mock.patch(
         'autodjbackend.playlist_generator._matches_user_criteria',
@@ -298,3 +338,292 @@ class TestPlaylistGenerator(unittest.TestCase):
         )
 
         assert expected_value == actual_value
+
+    @mock.patch('neomodel.db.cypher_query')
+    def test_generate_from_catalog(self, mocked_cypher_query):
+        catalog = build_test_catalog()
+        seed_nodes = [Track(uuid='a')]
+
+        actual_value = playlist_generator.generate(
+            seed_nodes, {'year': 1990}, minutes_to_milliseconds(6), None,
+            catalog=catalog
+        )
+
+        actual_uuids = [track['uuid'] for track in actual_value['tracks']]
+        self.assertListEqual(['a', 'b'], actual_uuids)
+        mocked_cypher_query.assert_not_called()
+
+    @mock.patch('neomodel.db.cypher_query')
+    def test_iter_generate_from_catalog(self, mocked_cypher_query):
+        catalog = build_test_catalog()
+
+        records = playlist_generator.iter_generate(
+            [Track(uuid='a')], {'year': 1990}, minutes_to_milliseconds(6),
+            None, catalog=catalog
+        )
+
+        assert next(records) == {'track': catalog.serialize(0)}
+        self.assertListEqual(
+            [
+                {'track': catalog.serialize(1)},
+                {'total_duration': 380000 / 60000},
+            ],
+            list(records)
+        )
+
+    @override_settings(GENERATION_TRACE_CAPACITY=10)
+    def test_generate_trace_from_catalog(self):
+        catalog = build_test_catalog()
+
+        with generation_trace.record_steps(requested=True) as recorder:
+            playlist_generator.generate(
+                [Track(uuid='a')], {'year': 1990},
+                minutes_to_milliseconds(6), None, catalog=catalog
+            )
+
+        self.assertListEqual(
+            [
+                (0, generation_trace.SEED, 'a', 1, None, None),
+                (1, generation_trace.GRAPH, 'b', 2, 25, 1),
+            ],
+            list(recorder.steps)
+        )
+
+    @override_settings(GENERATION_TRACE_CAPACITY=10)
+    def test_generate_trace_from_graph(self):
+        catalog = build_test_catalog()
+        related_tracks = [catalog.track(index) for index in range(4)]
+        storage = mock.Mock(spec=GraphStorage)
+        storage.get_neighbors.return_value = related_tracks
+
+        with generation_trace.record_steps(requested=True) as recorder:
+            playlist_generator.generate(
+                related_tracks[:1], {'year': 1990},
+                minutes_to_milliseconds(6), None, storage=storage
+            )
+
+        step = recorder.as_dict()['steps'][1]
+        assert step['source'] == generation_trace.GRAPH
+        assert step['uuid'] == 'b'
+        assert step['candidates'] == 3
+        assert step['bucket_size'] == 1
+
+    def test_generate_track_missing_from_catalog(self):
+        catalog = build_test_catalog()
+        seed_node = Track(uuid='new', title='new', duration=120000)
+        related_tracks = [catalog.track(index) for index in range(2)]
+        storage = mock.Mock(spec=GraphStorage)
+        storage.get_neighbors.return_value = related_tracks
+
+        actual_value = playlist_generator.generate(
+            [seed_node], {'year': 1990}, minutes_to_milliseconds(5), None,
+            catalog=catalog, storage=storage
+        )
+
+        actual_uuids = [track['uuid'] for track in actual_value['tracks']]
+        assert actual_uuids[0] == 'new'
+        assert actual_uuids[1] in ['a', 'b']
+        storage.get_neighbors.assert_called_once_with(
+            seed_node, None, random, mock.ANY
+        )
+
+    def test_generate_seeded(self):
+        catalog = build_test_catalog()
+
+        playlists = [
+            playlist_generator.generate(
+                [Track(uuid='a'), Track(uuid='c')], {},
+                minutes_to_milliseconds(6), None, catalog=catalog,
+                candidate_budget=2, rng=random.Random(42)
+            )
+            for _ in range(2)
+        ]
+
+        self.assertDictEqual(playlists[0], playlists[1])
+
+    def test_generate_long_playlist_small_budget(self):
+        catalog = build_two_link_node_catalog()
+        storage = InMemoryGraphStorage(catalog)
+        seed_nodes = storage.get_tracks(['t0'])
+
+        for candidate_budget in [1, 4]:
+            for seed in range(20):
+                for kwargs in [{'catalog': catalog}, {'storage': storage}]:
+                    actual_value = playlist_generator.generate(
+                        seed_nodes, {}, minutes_to_milliseconds(60),
+                        None, candidate_budget=candidate_budget,
+                        rng=random.Random(seed), **kwargs
+                    )
+
+                    uuids = [track['uuid'] for track in actual_value['tracks']]
+                    assert len(uuids) == 20
+                    assert len(set(uuids)) == len(uuids)
+
+    def test_agenerate_matches_generate(self):
+        catalog = build_test_catalog()
+
+        random.seed(1)
+        expected_value = playlist_generator.generate(
+            [Track(uuid='a')], {}, minutes_to_milliseconds(6), None,
+            catalog=catalog
+        )
+        random.seed(1)
+        actual_value = async_to_sync(playlist_generator.agenerate)(
+            [Track(uuid='a')], {}, minutes_to_milliseconds(6), None,
+            catalog=catalog
+        )
+
+        self.assertDictEqual(expected_value, actual_value)
+
+    def test_agenerate_awaits_related_tracks(self):
+        catalog = build_test_catalog()
+        related_tracks = [catalog.track(index) for index in range(4)]
+
+        storage = mock.Mock(spec=GraphStorage)
+        storage.get_neighbors.return_value = related_tracks
+
+        actual_value = async_to_sync(playlist_generator.agenerate)(
+            related_tracks[:1], {'year': 1990},
+            minutes_to_milliseconds(6), None, storage=storage
+        )
+
+        actual_uuids = [track['uuid'] for track in actual_value['tracks']]
+        self.assertListEqual(['a', 'b'], actual_uuids)
+        storage.get_neighbors.assert_called_once_with(
+            related_tracks[0], None, random, mock.ANY
+        )
+        played = storage.get_neighbors.call_args[0][3]
+        assert related_tracks[0] in played
+
+    def test_agenerate_scores_in_fetch_thread(self):
+        catalog = build_test_catalog()
+        related_tracks = [catalog.track(index) for index in range(4)]
+        fetch_threads = []
+        scoring_threads = []
+
+        def get_neighbors(current_track, candidate_budget, rng, played):
+            fetch_threads.append(threading.current_thread())
+            return related_tracks
+
+        def calculate_heuristic_value(*args):
+            scoring_threads.append(
+                (fetch_threads[-1], threading.current_thread())
+            )
+            return 0
+
+        storage = mock.Mock(spec=GraphStorage)
+        storage.get_neighbors.side_effect = get_neighbors
+
+        with mock.patch.object(
+            playlist_generator, '_calculate_heuristic_value',
+            side_effect=calculate_heuristic_value
+        ):
+            async_to_sync(playlist_generator.agenerate)(
+                related_tracks[:1], {}, minutes_to_milliseconds(6), None,
+                storage=storage
+            )
+
+        assert scoring_threads
+        for fetch_thread, scoring_thread in scoring_threads:
+            assert scoring_thread is fetch_thread
+
+    def test_calculate_heuristic_values_matches_scalar(self):
+        catalog = build_test_catalog()
+        candidates = np.arange(len(catalog))
+        criteria_list = [
+            {},
+            {'year': 1990},
+            {'original_artist': 'Artist A'},
+            {'original_artist': 'Unknown'},
+            {'position': 1, 'keyword_in_title': 'river'},
+        ]
+        totals = [(600000, 0), (600000, 500000), (600000, 590000)]
+
+        for criteria in criteria_list:
+            for total_duration, current_total in totals:
+                for current_index in range(len(catalog)):
+                    current_track = catalog.track(current_index)
+                    expected_value = [
+                        playlist_generator._calculate_heuristic_value(
+                            criteria, current_track, catalog.track(index),
+                            total_duration, current_total
+                        )
+                        for index in candidates
+                    ]
+
+                    actual_value = (
+                        playlist_generator._calculate_heuristic_values(
+                            catalog, criteria, current_index, candidates,
+                            total_duration, current_total
+                        )
+                    )
+
+                    self.assertListEqual(
+                        expected_value, actual_value.tolist()
+                    )
+
+    def test_played_tracks_contains(self):
+        played = playlist_generator.PlayedTracks()
+        played.add(Track(uuid='a'))
+
+        assert Track(uuid='a') in played
+        assert Track(uuid='b') not in played
+
+    def test_played_tracks_mask(self):
+        expected_value = [False, True, False, False]
+
+        catalog = build_test_catalog()
+        played = playlist_generator.PlayedTracks(catalog)
+        played.add(catalog.track(1))
+
+        actual_value = played.mask.tolist()
+
+        self.assertListEqual(expected_value, actual_value)
+
+    def test_candidate_budget_best_bucket_statistics(self):
+        """
+        Sampling only finds the best bucket as often as the hypergeometric
+        distribution allows, and picks uniformly within it when it does.
+        """
+        track_count, best_count, budget, trials = 1000, 5, 100, 2000
+        best_uuids = {str(index) for index in range(1, best_count + 1)}
+        catalog = TrackCatalog.from_rows(
+            [
+                (
+                    str(index), 'title', 'Artist', 'Album', 1990,
+                    7 if str(index) in best_uuids else 2, 1000, None
+                )
+                for index in range(track_count)
+            ],
+            {
+                'same_year': [
+                    ('y1990', [str(index) for index in range(track_count)])
+                ],
+                'same_original_artist': [('oa', ['0', '999'])],
+            }
+        )
+        current_track = catalog.track(0)
+        played = playlist_generator.PlayedTracks(catalog)
+        played.add(current_track)
+
+        random.seed(0)
+        picks = collections.Counter(
+            playlist_generator._choose_next_catalog_track(
+                catalog, {'position': 7}, current_track, played,
+                minutes_to_milliseconds(60), 0, budget
+            ).uuid
+            for _ in range(trials)
+        )
+
+        # The small link node takes 2 of the budget, leaving 98 for the hub.
+        quota = budget - 2
+        expected_hit_rate = 1 - (
+            math.comb(track_count - best_count, quota) /
+            math.comb(track_count, quota)
+        )
+        best_picks = [picks[uuid] for uuid in best_uuids]
+        actual_hit_rate = sum(best_picks) / trials
+        assert abs(expected_hit_rate - actual_hit_rate) < 0.05
+        mean_picks = sum(best_picks) / best_count
+        for count in best_picks:
+            assert 0.6 * mean_picks < count < 1.4 * mean_picks
@@ -0,0 +1,129 @@
+import contextvars
+import threading
+import unittest
+from unittest import mock
+
+import neomodel
+from asgiref.sync import async_to_sync, sync_to_async
+from django.test import override_settings
+
+from autodjbackend import graph_storage, query_tracing
+from autodjbackend.models import Track
+from autodjbackend.track_cache import TrackCache
+
+
+class TestQueryTrace(unittest.TestCase):
+
+    def test_slowest(self):
+        trace = query_tracing.QueryTrace(slowest_count=2)
+        for seconds, statement in [(0.2, 'a'), (0.1, 'b'), (0.3, 'c')]:
+            trace.start_query(statement)
+            trace.finish_query(statement, seconds)
+
+        self.assertListEqual([(0.3, 'c'), (0.2, 'a')], trace.slowest())
+        self.assertDictEqual(
+            {
+                'count': 3,
+                'total_ms': 600.0,
+                'slowest': [
+                    {'statement': 'c', 'ms': 300.0},
+                    {'statement': 'a', 'ms': 200.0},
+                ],
+            },
+            trace.as_dict()
+        )
+
+    def test_slowest_truncated(self):
+        trace = query_tracing.QueryTrace()
+        trace.finish_query('MATCH  (n)\n' + 'x' * 1000, 0.1)
+
+        [(_, statement)] = trace.slowest()
+
+        assert statement.startswith('MATCH (n) xxx')
+        assert len(statement) == query_tracing.MAX_STATEMENT_LENGTH + 3
+
+    def test_budget_log(self):
+        trace = query_tracing.QueryTrace(budget=1)
+
+        with self.assertLogs('autodjbackend.query_tracing', 'WARNING') as logs:
+            for _ in range(3):
+                trace.start_query('RETURN 1')
+
+        assert len(logs.output) == 1
+        assert trace.count == 3
+
+    def test_budget_raise(self):
+        trace = query_tracing.QueryTrace(budget=1, action='raise')
+        trace.start_query('RETURN 1')
+
+        with self.assertRaises(query_tracing.QueryBudgetExceeded):
+            trace.start_query('RETURN 2')
+
+
+class TestTraceQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.queries = []
+
+        def cypher_query(db, query, params=None):
+            self.queries.append(query)
+            return [], None
+
+        patcher = mock.patch.object(
+            neomodel.util.Database, 'cypher_query', cypher_query
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        query_tracing.instrument_neomodel()
+
+    def test_trace_queries(self):
+        query_tracing.instrument_neomodel()
+
+        with mock.patch.object(
+            query_tracing.metrics.NEO4J_QUERIES_PER_REQUEST, 'observe'
+        ) as mocked_observe:
+            with query_tracing.trace_queries() as trace:
+                neomodel.db.cypher_query('RETURN 1')
+                neomodel.db.cypher_query('RETURN 2')
+            neomodel.db.cypher_query('RETURN 3')
+
+        mocked_observe.assert_called_once_with(2)
+        assert trace.count == 2
+        self.assertListEqual(['RETURN 1', 'RETURN 2', 'RETURN 3'], self.queries)
+
+    def test_trace_queries_other_threads(self):
+        with query_tracing.trace_queries() as trace:
+            # Threads started here copy the context, as sync_to_async does.
+            context = contextvars.copy_context()
+            thread = threading.Thread(
+                target=context.run,
+                args=(neomodel.db.cypher_query, 'RETURN 1')
+            )
+            thread.start()
+            thread.join()
+            async_to_sync(
+                sync_to_async(neomodel.db.cypher_query, thread_sensitive=False)
+            )('RETURN 2')
+
+        assert trace.count == 2
+        self.assertListEqual(['RETURN 1', 'RETURN 2'], self.queries)
+
+    @override_settings(
+        NEO4J_QUERY_BUDGET=1, NEO4J_QUERY_BUDGET_ACTION='raise'
+    )
+    def test_trace_queries_budget_from_settings(self):
+        with self.assertRaises(query_tracing.QueryBudgetExceeded):
+            with query_tracing.trace_queries():
+                neomodel.db.cypher_query('RETURN 1')
+                neomodel.db.cypher_query('RETURN 2')
+
+        self.assertListEqual(['RETURN 1'], self.queries)
+
+    def test_related_tracks_query_budget(self):
+        with mock.patch.object(
+            TrackCache, 'get_instance', return_value=TrackCache()
+        ):
+            with query_tracing.trace_queries(budget=1, action='raise'):
+                graph_storage._get_related_tracks(Track(uuid='a'))
+
+        assert len(self.queries) == 1
@@ -0,0 +1,59 @@
+import unittest
+from unittest import mock
+
+from autodjbackend import timing
+
+
+class TestPhaseTimer(unittest.TestCase):
+
+    def test_phase_cumulative(self):
+        timer = timing.PhaseTimer()
+
+        with mock.patch('time.perf_counter', side_effect=[0, 2, 5, 6]):
+            with timer.phase(timing.SCORING):
+                pass
+            with timer.phase(timing.SCORING):
+                pass
+
+        assert timer.durations[timing.SCORING] == 3
+
+    def test_phase_nested(self):
+        timer = timing.PhaseTimer()
+
+        with mock.patch('time.perf_counter', side_effect=[0, 1, 4, 10]):
+            with timer.phase(timing.NEIGHBORS_CACHE):
+                with timer.phase(timing.NEIGHBORS_NEO4J):
+                    pass
+
+        self.assertDictEqual(
+            {timing.NEIGHBORS_CACHE: 7, timing.NEIGHBORS_NEO4J: 3},
+            dict(timer.durations)
+        )
+
+    def test_server_timing(self):
+        with mock.patch('time.perf_counter', side_effect=[0, 0.003]):
+            timer = timing.PhaseTimer()
+            timer.durations[timing.SEED_LOOKUP] = 0.0015
+
+            actual_value = timer.server_timing()
+
+        assert actual_value == 'seed_lookup;dur=1.5, total;dur=3.0'
+
+
+class TestRecordPhases(unittest.TestCase):
+
+    def test_record_phases(self):
+        with timing.record_phases() as timer:
+            with timing.phase(timing.SELECTION):
+                pass
+
+        with timing.phase(timing.SERIALIZATION):
+            pass
+
+        self.assertListEqual([timing.SELECTION], list(timer.durations))
+
+    def test_phase_not_recording(self):
+        with timing.phase(timing.SELECTION):
+            pass
+
+        assert timing._current_timer.get() is None
@@ -0,0 +1,419 @@
+import io
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test import override_settings
+
+from autodjbackend.models import Track
+from autodjbackend.tests.test_track_catalog import (
+    MEMBERSHIPS, TRACK_ROWS, build_test_catalog
+)
+from autodjbackend.track_cache import (
+    DjangoTrackCacheBackend, LocalTrackCacheBackend, TrackCache
+)
+from autodjbackend.track_catalog import TrackCatalog
+from autodjbackend.utils import get_keyword_mask
+
+
+class TestTrackCache(unittest.TestCase):
+
+    def setUp(self):
+        self.track_cache = TrackCache(
+            LocalTrackCacheBackend(
+                max_entries=2, max_bytes=1024 * 1024, ttl=60, stripes=1
+            )
+        )
+
+    def test_get_tracks_from_link_node(self):
+        expected_value = [Track(uuid='a', title='a')]
+
+        self.track_cache.add_result_to_cache('link', expected_value)
+
+        actual_value = self.track_cache.get_tracks_from_link_node('link')
+
+        assert expected_value is actual_value
+
+    def test_keyword_masks_set_on_entry(self):
+        self.track_cache.add_result_to_cache(
+            'link', [Track(uuid='a', title='love river')]
+        )
+
+        with mock.patch('autodjbackend.utils.get_keyword_mask') as mocked:
+            tracks = self.track_cache.get_tracks_from_link_node('link')
+
+        assert get_keyword_mask('love river') == tracks[0].keyword_mask
+        mocked.assert_not_called()
+
+    def test_get_tracks_from_link_node_missing(self):
+        with self.assertRaises(KeyError):
+            self.track_cache.get_tracks_from_link_node('link')
+
+    def test_get_tracks_from_link_node_expired(self):
+        self.track_cache.add_result_to_cache('link', [])
+
+        with mock.patch(
+            'autodjbackend.track_cache.time.monotonic',
+            return_value=float('inf')
+        ):
+            with self.assertRaises(KeyError):
+                self.track_cache.get_tracks_from_link_node('link')
+
+        assert self.track_cache.get_stats()['link_nodes']['expirations'] == 1
+        assert self.track_cache.get_stats()['link_nodes']['entries'] == 0
+
+    def test_lru_eviction(self):
+        self.track_cache.add_result_to_cache('a', [])
+        self.track_cache.add_result_to_cache('b', [])
+        self.track_cache.get_tracks_from_link_node('a')
+        self.track_cache.add_result_to_cache('c', [])
+
+        self.assertCountEqual(
+            ['a', 'c'], self.track_cache.get_link_node_uuids()
+        )
+        assert self.track_cache.get_stats()['link_nodes']['evictions'] == 1
+
+    def test_link_node_uuids_limit(self):
+        track_cache = TrackCache(
+            LocalTrackCacheBackend(
+                max_entries=100, max_bytes=1000, ttl=60, stripes=4,
+                size_of=len
+            )
+        )
+        track_cache.add_result_to_cache('a', [Track(uuid='a')])
+        track_cache.add_result_to_cache('b', [Track(uuid='b')] * 3)
+        track_cache.add_result_to_cache('c', [Track(uuid='c')] * 2)
+
+        self.assertListEqual(['b', 'c'], track_cache.get_link_node_uuids(2))
+        self.assertCountEqual(
+            ['a', 'b', 'c'], track_cache.get_link_node_uuids()
+        )
+
+    def test_byte_limit_eviction(self):
+        track_cache = TrackCache(
+            LocalTrackCacheBackend(
+                max_entries=100, max_bytes=6000, ttl=60, stripes=1
+            )
+        )
+        tracks = [Track(uuid='a', title='a' * 1024) for _ in range(2)]
+
+        track_cache.add_result_to_cache('a', tracks)
+        track_cache.add_result_to_cache('b', tracks)
+
+        self.assertListEqual(['b'], track_cache.get_link_node_uuids())
+
+    def test_byte_limit_shared_between_stripes(self):
+        backend = LocalTrackCacheBackend(
+            max_entries=100, max_bytes=10000, ttl=60, stripes=4,
+            size_of=len
+        )
+        for uuid in 'abcdefgh':
+            backend.set(uuid, 'x' * 1000)
+
+        # Larger than a stripe's share of the bytes, but not of the cache.
+        backend.set('hub', 'x' * 6000)
+
+        assert backend.get('hub') == 'x' * 6000
+        assert backend.get_stats()['bytes'] <= 10000
+        assert backend.get_stats()['evictions'] == 4
+
+    def test_oversized_entry_not_cached(self):
+        backend = LocalTrackCacheBackend(
+            max_entries=100, max_bytes=10000, ttl=60, stripes=1,
+            size_of=len
+        )
+        backend.set('a', 'x' * 1000)
+        backend.set('b', 'x' * 1000)
+
+        backend.set('b', 'x' * 20000)
+
+        self.assertListEqual(['a'], backend.keys())
+        assert backend.get_stats()['evictions'] == 0
+        assert backend.size == 1000
+
+    def test_get_stats(self):
+        expected_value = {
+            'entries': 1,
+            'hits': 1,
+            'misses': 1,
+            'evictions': 0,
+            'expirations': 0,
+        }
+
+        self.track_cache.add_result_to_cache('a', [])
+        self.track_cache.get_tracks_from_link_node('a')
+        with self.assertRaises(KeyError):
+            self.track_cache.get_tracks_from_link_node('b')
+
+        actual_value = self.track_cache.get_stats()['link_nodes']
+        del actual_value['bytes']
+
+        self.assertDictEqual(expected_value, actual_value)
+
+    def test_concurrent_access(self):
+        track_cache = TrackCache(
+            LocalTrackCacheBackend(
+                max_entries=64, max_bytes=1024 * 1024, ttl=60, stripes=4
+            )
+        )
+
+        def worker(offset):
+            for i in range(500):
+                uuid = str((offset + i) % 128)
+                track_cache.add_result_to_cache(uuid, [])
+                try:
+                    track_cache.get_tracks_from_link_node(uuid)
+                except KeyError:
+                    pass
+
+        threads = [
+            threading.Thread(target=worker, args=(i,)) for i in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        stats = track_cache.get_stats()['link_nodes']
+        assert stats['entries'] <= 64
+        assert stats['hits'] + stats['misses'] == 8 * 500
+
+    def test_link_nodes_of_track(self):
+        expected_value = (('SAME_YEAR', 'y1990'),)
+
+        self.track_cache.add_link_nodes_of_track('a', [('SAME_YEAR', 'y1990')])
+
+        actual_value = self.track_cache.get_link_nodes_of_track('a')
+
+        self.assertTupleEqual(expected_value, actual_value)
+
+    def test_link_nodes_of_track_negative(self):
+        expected_value = ()
+
+        self.track_cache.add_link_nodes_of_track('a', [])
+
+        actual_value = self.track_cache.get_link_nodes_of_track('a')
+
+        self.assertTupleEqual(expected_value, actual_value)
+
+    def test_link_nodes_of_track_missing(self):
+        with self.assertRaises(KeyError):
+            self.track_cache.get_link_nodes_of_track('a')
+
+    def test_warm(self):
+        track_cache = TrackCache()
+        track_cache.warm(TRACK_ROWS + [('e', 'e', 'E', 'E', 0, 0, 0, 'E')], {
+            'same_year': MEMBERSHIPS['same_year'],
+        })
+
+        self.assertListEqual(
+            ['a', 'b'],
+            [
+                track.uuid
+                for track in track_cache.get_tracks_from_link_node('y1990')
+            ]
+        )
+        self.assertTupleEqual(
+            (('SAME_YEAR', 'y1990'),),
+            track_cache.get_link_nodes_of_track('a')
+        )
+        self.assertTupleEqual((), track_cache.get_link_nodes_of_track('e'))
+
+    def test_warm_in_batches(self):
+        link_node_backend = mock.Mock()
+        track_links_backend = mock.Mock()
+        track_cache = TrackCache(link_node_backend, track_links_backend)
+
+        with mock.patch('autodjbackend.track_cache.WARM_BATCH_SIZE', 2):
+            track_cache.warm(TRACK_ROWS, {
+                'same_year': MEMBERSHIPS['same_year'],
+            })
+
+        assert link_node_backend.set_many.call_count == 2
+        assert track_links_backend.set_many.call_count == 2
+        link_node_backend.set.assert_not_called()
+        track_links_backend.set.assert_not_called()
+        self.assertTupleEqual(
+            ('a', (('SAME_YEAR', 'y1990'),)),
+            track_links_backend.set_many.call_args_list[0][0][0][0]
+        )
+
+    def test_catalog_fallback(self):
+        track_cache = TrackCache(catalog=build_test_catalog())
+
+        self.assertTupleEqual(
+            (
+                ('SAME_NUMBER', 'n3'), ('SAME_ORIGINAL_ARTIST', 'od'),
+                ('SAME_YEAR', 'y1992'),
+            ),
+            track_cache.get_link_nodes_of_track('d')
+        )
+        self.assertListEqual(
+            ['d'],
+            [
+                track.uuid
+                for track in track_cache.get_tracks_from_link_node('y1992')
+            ]
+        )
+        self.assertListEqual(['y1992'], track_cache.get_link_node_uuids())
+
+
+class TestTrackCacheSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'snapshot.bin')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_get_instance_from_snapshot(self):
+        build_test_catalog().save(self.path)
+
+        with override_settings(
+            TRACK_CATALOG_PATH=None, TRACK_CACHE_SNAPSHOT_PATH=self.path
+        ):
+            with mock.patch.object(TrackCache, '_instance', None):
+                with mock.patch.object(
+                    TrackCatalog, 'from_rows'
+                ) as mocked_from_rows:
+                    track_cache = TrackCache.get_instance()
+
+        mocked_from_rows.assert_not_called()
+
+        assert len(track_cache.catalog) == len(TRACK_ROWS)
+        assert track_cache.get_stats()['link_nodes']['entries'] == 0
+        self.assertListEqual(
+            ['a', 'b'],
+            [
+                track.uuid
+                for track in track_cache.get_tracks_from_link_node('y1990')
+            ]
+        )
+
+    def test_get_instance_without_snapshot(self):
+        with override_settings(
+            TRACK_CATALOG_PATH=None, TRACK_CACHE_SNAPSHOT_PATH=self.path
+        ):
+            with mock.patch.object(TrackCache, '_instance', None):
+                track_cache = TrackCache.get_instance()
+
+        assert track_cache.catalog is None
+
+    def test_warm_track_cache_command(self):
+        track_cache = TrackCache()
+
+        with mock.patch(
+            'autodjbackend.management.commands.warm_track_cache.'
+            'load_graph_rows',
+            return_value=(TRACK_ROWS, MEMBERSHIPS)
+        ):
+            with mock.patch.object(
+                TrackCache, 'get_instance', return_value=track_cache
+            ):
+                call_command(
+                    'warm_track_cache', snapshot=self.path,
+                    stdout=io.StringIO()
+                )
+
+        self.assertCountEqual(
+            ['y1990', 'y1991', 'y1992', 'n1', 'n2', 'n3', 'oa', 'oc', 'od',
+             'river', 'love'],
+            track_cache.get_link_node_uuids()
+        )
+        catalog = TrackCatalog.open(self.path)
+        self.assertListEqual(
+            [row[0] for row in TRACK_ROWS],
+            [catalog.serialize(index)['uuid'] for index in range(len(catalog))]
+        )
+
+
+class TestDjangoTrackCacheBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = DjangoTrackCacheBackend('default', ttl=60)
+        self.backend.cache.clear()
+
+    def test_round_trip(self):
+        expected_value = [
+            Track(uuid='a', title='a', artist='b', year=1990).serialize,
+            Track(uuid='c', title='c', artist='d', year=1991).serialize,
+        ]
+
+        self.backend.set(
+            'link', [Track(**track) for track in expected_value]
+        )
+
+        actual_value = [
+            track.serialize for track in self.backend.get('link')
+        ]
+
+        self.assertListEqual(expected_value, actual_value)
+
+    def test_stored_as_columns(self):
+        expected_value = (['a'], ['title'])
+
+        self.backend.set('link', [Track(uuid='a', title='title')])
+
+        actual_value = self.backend.cache.get('track_cache:link_node:link')
+
+        self.assertTupleEqual(expected_value, actual_value[:2])
+
+    def test_keyword_masks_stored(self):
+        expected_value = get_keyword_mask('love river')
+
+        self.backend.set('link', [Track(uuid='a', title='love river')])
+
+        actual_value = self.backend.get('link')[0].keyword_mask
+
+        assert expected_value == actual_value
+
+    def test_get_missing(self):
+        with self.assertRaises(KeyError):
+            self.backend.get('link')
+
+    def test_set_many(self):
+        with mock.patch.object(
+            self.backend.cache, 'set_many', wraps=self.backend.cache.set_many
+        ) as mocked_set_many:
+            self.backend.set_many([
+                ('a', [Track(uuid='a')]), ('b', [Track(uuid='b')]),
+            ])
+
+        mocked_set_many.assert_called_once()
+        assert self.backend.get('b')[0].uuid == 'b'
+        self.assertCountEqual(['a', 'b'], self.backend.keys())
+
+    @override_settings(TRACK_CACHE_BACKEND='django', CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        'track_cache': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': '/tmp/autodjbackend_track_cache',
+        },
+    })
+    def test_file_based_cache_rejected(self):
+        with self.assertRaises(ImproperlyConfigured):
+            TrackCache()
+
+    @override_settings(TRACK_CACHE_BACKEND='django', CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    })
+    def test_missing_cache_rejected(self):
+        with self.assertRaises(ImproperlyConfigured):
+            TrackCache()
+
+    def test_keys_shared_between_backends(self):
+        other_backend = DjangoTrackCacheBackend('default', ttl=60)
+
+        self.backend.set('link', [])
+        other_backend.get('link')
+
+        self.assertListEqual(['link'], other_backend.keys())
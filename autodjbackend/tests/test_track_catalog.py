@@ -0,0 +1,220 @@
+import os
+import tempfile
+import unittest
+
+from autodjbackend.track_catalog import NULL_ID, TrackCatalog
+from autodjbackend.utils import get_keyword_mask
+
+
+TRACK_ROWS = [
+    ('a', 'river song', 'Artist A', 'Album', 1990, 1, 180000, 'Artist A'),
+    ('b', 'love river', 'Artist B', 'Album', 1990, 2, 200000, 'Artist A'),
+    ('c', 'hello', 'Artist C', 'Album', 1991, 1, 220000, 'Artist C'),
+    ('d', 'world', 'Artist D', 'Album', 1992, 3, 240000, 'Artist D'),
+]
+
+MEMBERSHIPS = {
+    'same_year': [('y1990', ['a', 'b']), ('y1991', ['c']), ('y1992', ['d'])],
+    'same_track_number': [('n1', ['a', 'c']), ('n2', ['b']), ('n3', ['d'])],
+    'same_original_artist': [('oa', ['a', 'b']), ('oc', ['c']), ('od', ['d'])],
+    'keyword_in_title': [('river', ['a', 'b']), ('love', ['b'])],
+}
+
+
+def build_test_catalog():
+    return TrackCatalog.from_rows(TRACK_ROWS, MEMBERSHIPS)
+
+
+class TestTrackCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.catalog = build_test_catalog()
+
+    def test_len(self):
+        expected_value = 4
+
+        actual_value = len(self.catalog)
+
+        assert expected_value == actual_value
+
+    def test_index_of(self):
+        expected_value = 2
+
+        actual_value = self.catalog.index_of('c')
+
+        assert expected_value == actual_value
+
+    def test_artist_dictionary_shared(self):
+        index = self.catalog.index_of('a')
+
+        assert (
+            self.catalog.artist_ids[index] ==
+            self.catalog.original_artist_ids[index]
+        )
+
+    def test_artist_id_unknown(self):
+        expected_value = -1
+
+        actual_value = self.catalog.artist_id('Unknown')
+
+        assert expected_value == actual_value
+
+    def test_neighbors(self):
+        expected_value = [0, 1, 2]
+
+        actual_value = self.catalog.neighbors(0).tolist()
+
+        self.assertListEqual(expected_value, actual_value)
+
+    def test_neighbors_only_self(self):
+        expected_value = [3]
+
+        actual_value = self.catalog.neighbors(3).tolist()
+
+        self.assertListEqual(expected_value, actual_value)
+
+    def test_neighbors_candidate_budget(self):
+        catalog = TrackCatalog.from_rows(
+            [
+                (str(index), 'title', 'Artist', 'Album', 1990, 1, 0, None)
+                for index in range(20)
+            ],
+            {
+                'same_year': [('y1990', [str(index) for index in range(20)])],
+                'same_original_artist': [('oa', ['0', '19'])],
+            }
+        )
+
+        actual_value = catalog.neighbors(0, candidate_budget=6).tolist()
+
+        assert 0 in actual_value
+        assert 19 in actual_value
+        assert 4 <= len(actual_value) <= 6
+
+    def test_links_of_multiple_keywords(self):
+        expected_value = ['river', 'love']
+
+        link_index = self.catalog.link_indexes['keyword_in_title']
+        actual_value = [
+            link_index.link_uuids[link]
+            for link in link_index.links_of(self.catalog.index_of('b'))
+        ]
+
+        self.assertListEqual(expected_value, actual_value)
+
+    def test_serialize(self):
+        expected_value = {
+            'uuid': 'b',
+            'title': 'love river',
+            'artist': 'Artist B',
+            'album': 'Album',
+            'year': 1990,
+            'position': 2,
+            'duration': 200000,
+            'original_artist': 'Artist A',
+        }
+
+        actual_value = self.catalog.serialize(1)
+
+        self.assertDictEqual(expected_value, actual_value)
+
+    def test_track(self):
+        track = self.catalog.track(2)
+
+        assert track.uuid == 'c'
+        assert track.catalog_index == 2
+        assert track.duration == 220000
+        assert track.keyword_mask == get_keyword_mask('hello')
+
+    def test_keyword_masks(self):
+        expected_value = [get_keyword_mask(row[1]) for row in TRACK_ROWS]
+
+        actual_value = self.catalog.keyword_masks.tolist()
+
+        self.assertListEqual(expected_value, actual_value)
+
+    def test_index_of_missing(self):
+        with self.assertRaises(KeyError):
+            self.catalog.index_of('missing')
+
+    def test_null_original_artist(self):
+        catalog = TrackCatalog.from_rows(
+            [('e', 'title', 'Artist', 'Album', 0, 0, 0, None)], {}
+        )
+
+        assert catalog.original_artist_ids[0] == NULL_ID
+        assert catalog.artist_id(None) == NULL_ID
+        assert catalog.serialize(0)['original_artist'] is None
+
+    def test_get_link_nodes_of_track(self):
+        expected_value = (
+            ('SAME_NUMBER', 'n2'),
+            ('SAME_ORIGINAL_ARTIST', 'oa'),
+            ('SAME_YEAR', 'y1990'),
+            ('KEYWORD_IN_TITLE', 'river'),
+            ('KEYWORD_IN_TITLE', 'love'),
+        )
+
+        actual_value = self.catalog.get_link_nodes_of_track('b')
+
+        self.assertTupleEqual(expected_value, actual_value)
+
+    def test_get_tracks_from_link_node(self):
+        expected_value = ['a', 'c']
+
+        actual_value = [
+            track.uuid
+            for track in self.catalog.get_tracks_from_link_node('n1')
+        ]
+
+        self.assertListEqual(expected_value, actual_value)
+
+    def test_get_tracks_from_link_node_missing(self):
+        with self.assertRaises(KeyError):
+            self.catalog.get_tracks_from_link_node('missing')
+
+
+class TestTrackCatalogFile(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'catalog.bin')
+        self.catalog = build_test_catalog()
+        self.catalog.save(self.path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        mapped_catalog = TrackCatalog.open(self.path)
+
+        self.assertListEqual(
+            [self.catalog.serialize(index) for index in range(4)],
+            [mapped_catalog.serialize(index) for index in range(4)]
+        )
+        for index in range(4):
+            self.assertListEqual(
+                self.catalog.neighbors(index).tolist(),
+                mapped_catalog.neighbors(index).tolist()
+            )
+
+    def test_arrays_are_mapped(self):
+        mapped_catalog = TrackCatalog.open(self.path)
+
+        assert not mapped_catalog.durations.flags.owndata
+        assert not mapped_catalog.durations.flags.writeable
+
+    def test_lookups(self):
+        mapped_catalog = TrackCatalog.open(self.path)
+
+        assert mapped_catalog.index_of('c') == 2
+        assert mapped_catalog.artist_id('Artist D') == (
+            self.catalog.artist_id('Artist D')
+        )
+
+    def test_unsupported_version(self):
+        with open(self.path, 'wb') as file:
+            file.write(b'NOTACATALOG!')
+
+        with self.assertRaises(ValueError):
+            TrackCatalog.open(self.path)
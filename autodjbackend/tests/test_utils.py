@@ -1,6 +1,7 @@
 import unittest
+from unittest import mock
 
-from autodjbackend import utils
+from autodjbackend import models, utils
 
 
 class TestUtils(unittest.TestCase):
@@ -33,3 +34,182 @@ class TestUtils(unittest.TestCase):
         actual_output = utils.get_criteria_to_search(criteria)
 
         self.assertDictEqual(expected_output, actual_output)
+
+    def test_get_keyword_mask_none(self):
+        expected_output = 0
+
+        actual_output = utils.get_keyword_mask('Hello')
+
+        assert expected_output == actual_output
+
+    def test_get_keyword_mask(self):
+        expected_output = (
+            1 << utils.KEYWORDS.index('river') |
+            1 << utils.KEYWORDS.index('love')
+        )
+
+        actual_output = utils.get_keyword_mask('love river')
+
+        assert expected_output == actual_output
+
+    def test_get_track_keyword_mask(self):
+        track = models.Track(title='love river')
+
+        expected_output = utils.get_keyword_mask('love river')
+
+        actual_output = utils.get_track_keyword_mask(track)
+
+        assert expected_output == actual_output
+        assert expected_output == track.keyword_mask
+
+    def test_get_track_keyword_mask_stored(self):
+        track = models.Track(title='love river')
+        track.keyword_mask = 0
+
+        actual_output = utils.get_track_keyword_mask(track)
+
+        assert 0 == actual_output
+
+    def test_split_line_to_dict(self):
+        expected_output = {
+            'title': 'Love River',
+            'duration': 180000,
+            'artist': 'Artist A',
+            'album': 'Album',
+            'year': 1990,
+            'position': 1,
+            'original_artist': 'Artist A',
+        }
+
+        actual_output = utils.split_line_to_dict(
+            'Love River,180000,Artist A,Album,1990,1,Artist A\n'.split(',')
+        )
+
+        self.assertDictEqual(expected_output, actual_output)
+
+    def test_should_convert(self):
+        track_params = utils.split_line_to_dict(
+            'Old Song,200000,Artist C,Album,1950,1,Artist C'.split(',')
+        )
+
+        assert not utils.should_convert(track_params)
+
+        track_params['year'] = 1990
+
+        assert utils.should_convert(track_params)
+
+    def test_allocate_candidate_budget(self):
+        expected_output = [2, 4, 4]
+
+        actual_output = utils.allocate_candidate_budget([2, 100, 50], 10)
+
+        self.assertListEqual(expected_output, actual_output)
+
+    def test_allocate_candidate_budget_under_budget(self):
+        expected_output = [2, 3]
+
+        actual_output = utils.allocate_candidate_budget([2, 3], 10)
+
+        self.assertListEqual(expected_output, actual_output)
+
+    def test_sample_link_nodes(self):
+        member_lists = [['a'], list(range(100))]
+
+        actual_output = utils.sample_link_nodes(member_lists, 1)
+
+        self.assertListEqual([], actual_output[0])
+        assert len(actual_output[1]) == 1
+
+    def test_sample_link_nodes_nothing_sampled(self):
+        member_lists = [['a'], ['b', 'c']]
+
+        actual_output = utils.sample_link_nodes(member_lists, 0)
+
+        assert actual_output is member_lists
+
+    def test_sample_candidates_under_quota(self):
+        candidates = ['a', 'b']
+
+        actual_output = utils.sample_candidates(candidates, 5)
+
+        assert candidates is actual_output
+
+    def test_sample_candidates(self):
+        candidates = list(range(100))
+
+        actual_output = utils.sample_candidates(candidates, 10)
+
+        assert len(set(actual_output)) == 10
+        self.assertListEqual(sorted(actual_output), actual_output)
+        assert set(actual_output) <= set(candidates)
+
+    def test_get_random_seed_node(self):
+        expected_output = [models.Track(uuid='b')]
+
+        with mock.patch(
+            'neomodel.db.cypher_query',
+            side_effect=[([[3]], None), ([expected_output], None)]
+        ) as mocked_cypher_query:
+            with mock.patch('random.randrange', return_value=1):
+                actual_output = utils.get_random_seed_node({'year': 1990})
+
+        self.assertListEqual(expected_output, actual_output)
+        count_query = mocked_cypher_query.call_args_list[0][0][0]
+        pick_query = mocked_cypher_query.call_args_list[1][0][0]
+        assert count_query.endswith('RETURN count(track)')
+        assert pick_query.endswith('ORDER BY track.uuid SKIP 1 LIMIT 1')
+
+    def test_get_random_seed_node_no_matches(self):
+        with mock.patch(
+            'neomodel.db.cypher_query', return_value=([[0]], None)
+        ) as mocked_cypher_query:
+            actual_output = utils.get_random_seed_node({'year': 1990})
+
+        self.assertListEqual([], actual_output)
+        mocked_cypher_query.assert_called_once()
+
+    def test_resolve_user_tracks(self):
+        test_track = models.Track(uuid='a')
+        user_tracks_list = [
+            {'title': 'river song', 'artist': 'Artist A'},
+            {'title': 'missing', 'artist': 'Nobody'},
+        ]
+
+        with mock.patch(
+            'neomodel.db.cypher_query',
+            return_value=([[0, test_track], [1, None]], None)
+        ) as mocked_cypher_query:
+            actual_output = utils.resolve_user_tracks(user_tracks_list)
+
+        self.assertListEqual([test_track, None], actual_output)
+        mocked_cypher_query.assert_called_once()
+        query, params = mocked_cypher_query.call_args[0]
+        assert (
+            'track.artist = entry.criteria.artist AND '
+            'track.title = entry.criteria.title'
+        ) in query
+        self.assertListEqual(
+            [0, 1], [entry['index'] for entry in params['entries']]
+        )
+
+    def test_resolve_user_tracks_groups_by_properties(self):
+        user_tracks_list = [
+            {'title': 'a', 'artist': 'A'},
+            {'uuid': 'b'},
+            {'artist': 'C', 'title': 'c'},
+        ]
+
+        with mock.patch(
+            'neomodel.db.cypher_query', return_value=([], None)
+        ) as mocked_cypher_query:
+            actual_output = utils.resolve_user_tracks(user_tracks_list)
+
+        self.assertListEqual([None, None, None], actual_output)
+        assert mocked_cypher_query.call_count == 2
+
+    def test_resolve_user_tracks_invalid_property(self):
+        with mock.patch('neomodel.db.cypher_query') as mocked_cypher_query:
+            with self.assertRaises(ValueError):
+                utils.resolve_user_tracks([{'title': 'a', 'bad': 'b'}])
+
+        mocked_cypher_query.assert_not_called()
@@ -1,10 +1,23 @@
-from autodjbackend.views import CreatePlaylistViewSet
+from autodjbackend.views import (
+    BatchPlaylistViewSet, CreatePlaylistViewSet, export_metrics,
+    generate_playlist
+)
 
+import json
+import random
 import unittest
 
+from asgiref.sync import async_to_sync
+from django.test import (
+    AsyncRequestFactory, RequestFactory, override_settings
+)
+from django.core.cache import caches
+from django.http import QueryDict
+from django.urls import resolve
+
 from unittest.mock import patch
 
-from autodjbackend import models
+from autodjbackend import generation_trace, models, query_tracing, views
 
 from rest_framework.request import HttpRequest, Request
 from rest_framework.exceptions import ParseError, UnsupportedMediaType
@@ -49,8 +62,8 @@ class TestCreatePlayListViewSet(unittest.TestCase):
             return_value=request_data['track_criteria']
         ) as mocked_get_criteria:
             with patch(
-                'autodjbackend.utils.get_seed_nodes_from_criteria',
-                return_value=expected_tracks
+                'autodjbackend.utils.get_random_seed_node',
+                return_value=expected_tracks[:1]
             ) as mocked_get_link_nodes:
                 with patch(
                     'autodjbackend.playlist_generator.generate',
@@ -70,6 +83,166 @@ class TestCreatePlayListViewSet(unittest.TestCase):
 
         self.assertDictEqual(expected_output, actual_output)
 
+    def test_create_tracks_to_include(self):
+        user_track = models.Track(uuid='a', title='title', duration=2)
+        request_data = {
+            'track_criteria': {},
+            'tracks_to_include': [
+                {'title': 'title', 'artist': 'artist'},
+                {'title': 'missing', 'artist': 'artist'},
+            ],
+            'total_duration': 4
+        }
+
+        request = Request(HttpRequest())
+        request.data.update(request_data)
+
+        with patch(
+            'autodjbackend.utils.resolve_user_tracks',
+            return_value=[user_track, None]
+        ):
+            with patch(
+                'autodjbackend.playlist_generator.generate',
+                return_value={'tracks': [], 'total_duration': 0}
+            ) as mocked_generate:
+                with patch.object(self.view_set, '_raise_if_not_json'):
+                    response = self.view_set.create(request)
+
+        self.assertListEqual([user_track], mocked_generate.call_args[0][3])
+        self.assertListEqual(
+            [
+                {'matched': True, 'uuid': 'a'},
+                {'matched': False, 'uuid': None},
+            ],
+            response.data['tracks_to_include']
+        )
+
+    def test_create_invalid_tracks_to_include(self):
+        request_data = {
+            'track_criteria': {},
+            'tracks_to_include': [{'bad': 'property'}],
+            'total_duration': 4
+        }
+
+        request = Request(HttpRequest())
+        request.data.update(request_data)
+
+        with patch.object(self.view_set, '_raise_if_not_json'):
+            with self.assertRaises(ParseError):
+                self.view_set.create(request)
+
+    def _stream(self, stream_format, records=None, http_request=None):
+        if http_request is None:
+            http_request = HttpRequest()
+            http_request.GET = QueryDict(f'stream={stream_format}')
+        request = Request(http_request)
+        request.data.update({
+            'track_criteria': {},
+            'tracks_to_include': [{'title': 'title'}],
+            'total_duration': 4
+        })
+        if records is None:
+            records = iter([
+                {'track': {'uuid': 'a'}},
+                {'total_duration': 4},
+            ])
+
+        with patch(
+            'autodjbackend.utils.resolve_user_tracks',
+            return_value=[models.Track(uuid='a')]
+        ):
+            with patch(
+                'autodjbackend.playlist_generator.iter_generate',
+                return_value=records
+            ):
+                with patch.object(self.view_set, '_raise_if_not_json'):
+                    return self.view_set.create(request)
+
+    def test_create_stream_ndjson(self):
+        response = self._stream('ndjson')
+
+        assert response['Content-Type'] == 'application/x-ndjson'
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertListEqual(
+            [
+                {'track': {'uuid': 'a'}},
+                {
+                    'total_duration': 4,
+                    'tracks_to_include': [{'matched': True, 'uuid': 'a'}],
+                },
+            ],
+            [json.loads(line) for line in lines]
+        )
+
+    def test_create_stream_sse(self):
+        response = self._stream('sse')
+
+        assert response['Content-Type'] == 'text/event-stream'
+        events = b''.join(response.streaming_content).decode().split('\n\n')
+        assert events[0] == 'event: track\ndata: {"track": {"uuid": "a"}}'
+        assert events[1].startswith('event: summary\ndata: ')
+
+    @override_settings(GENERATION_TRACE_SAMPLE_RATE=1)
+    def test_create_stream_traced_while_consumed(self):
+        traces = []
+
+        def iter_generate():
+            traces.append(
+                (query_tracing._current_trace.get(),
+                 generation_trace.current())
+            )
+            yield {'track': {'uuid': 'a'}}
+            yield {'total_duration': 4}
+
+        response = self._stream('ndjson', iter_generate())
+        assert not traces
+        b''.join(response.streaming_content)
+
+        trace, recorder = traces[0]
+        assert trace is not None
+        assert recorder is not None
+        assert query_tracing._current_trace.get() is None
+        assert generation_trace.current() is None
+
+    def test_create_stream_unknown_format(self):
+        with self.assertRaises(ParseError):
+            self._stream('xml')
+
+    def test_create_stream_over_asgi(self):
+        http_request = AsyncRequestFactory().get('/')
+        http_request.GET = QueryDict('stream=ndjson')
+        with self.assertRaises(ParseError):
+            self._stream('ndjson', http_request=http_request)
+
+    def test_create_server_timing(self):
+        http_request = HttpRequest()
+        http_request.GET = QueryDict('debug=timing,queries,trace')
+        request = Request(http_request)
+        request.data.update({'track_criteria': {}, 'total_duration': 4})
+
+        with patch(
+            'autodjbackend.utils.get_random_seed_node',
+            return_value=[models.Track(uuid='a')]
+        ):
+            with patch(
+                'autodjbackend.playlist_generator.generate',
+                return_value={'tracks': [], 'total_duration': 4}
+            ):
+                with patch.object(self.view_set, '_raise_if_not_json'):
+                    response = self.view_set.create(request)
+
+        metrics = [
+            metric.split(';')[0]
+            for metric in response['Server-Timing'].split(', ')
+        ]
+        self.assertListEqual(['seed_lookup', 'total'], metrics)
+        self.assertSetEqual(
+            {'seed_lookup', 'total'},
+            set(response.data['debug']['timings'])
+        )
+        assert response.data['debug']['queries']['count'] == 0
+        assert response.data['debug']['trace']['step_count'] == 0
+
     def test_create_empty(self):
         request = Request(HttpRequest())
 
@@ -110,3 +283,247 @@ class TestCreatePlayListViewSet(unittest.TestCase):
 
         with self.assertRaises(UnsupportedMediaType):
             self.view_set.create(request)
+
+
+class TestSeededPlaylists(unittest.TestCase):
+
+    def setUp(self):
+        self.view_set = CreatePlaylistViewSet()
+        caches['default'].clear()
+
+    def _create(self, request_data, if_none_match=None):
+        http_request = HttpRequest()
+        if if_none_match is not None:
+            http_request.META['HTTP_IF_NONE_MATCH'] = if_none_match
+        request = Request(http_request)
+        request.data.update(request_data)
+
+        with patch.object(self.view_set, '_raise_if_not_json'):
+            return self.view_set.create(request)
+
+    def _create_with_generate(self, request_data, if_none_match=None):
+        with patch(
+            'autodjbackend.utils.get_random_seed_node',
+            return_value=[models.Track(uuid='a')]
+        ):
+            with patch(
+                'autodjbackend.playlist_generator.generate',
+                return_value={'tracks': [], 'total_duration': 4}
+            ) as mocked_generate:
+                response = self._create(request_data, if_none_match)
+
+        return response, mocked_generate
+
+    def test_seed_drives_random_generator(self):
+        response, mocked_generate = self._create_with_generate({
+            'track_criteria': {}, 'total_duration': 4, 'seed': 7,
+        })
+
+        rng = mocked_generate.call_args[0][7]
+        assert rng.random() == random.Random(7).random()
+        assert response['ETag']
+
+    def test_seeded_playlist_cached(self):
+        request_data = {
+            'track_criteria': {'year': 1990}, 'total_duration': 4, 'seed': 7,
+        }
+        first_response, _ = self._create_with_generate(request_data)
+
+        second_response, mocked_generate = self._create_with_generate({
+            'seed': 7, 'total_duration': 4,
+            'track_criteria': {'year': 1990, 'unused': 'criteria'},
+        })
+
+        mocked_generate.assert_not_called()
+        assert first_response['ETag'] == second_response['ETag']
+        self.assertDictEqual(first_response.data, second_response.data)
+
+    def test_seeded_playlist_not_modified(self):
+        request_data = {
+            'track_criteria': {}, 'total_duration': 4, 'seed': 'seed',
+        }
+        first_response, _ = self._create_with_generate(request_data)
+
+        response, _ = self._create_with_generate(
+            request_data, if_none_match=first_response['ETag']
+        )
+
+        assert response.status_code == 304
+
+    def test_unseeded_playlist_not_cached(self):
+        request_data = {'track_criteria': {}, 'total_duration': 4}
+        self._create_with_generate(request_data)
+
+        response, mocked_generate = self._create_with_generate(request_data)
+
+        mocked_generate.assert_called_once()
+        assert not response.has_header('ETag')
+
+    def test_invalid_seed(self):
+        with self.assertRaises(ParseError):
+            self._create({
+                'track_criteria': {}, 'total_duration': 4, 'seed': [1],
+            })
+
+
+class TestBatchPlaylistViewSet(unittest.TestCase):
+
+    def setUp(self):
+        self.view_set = BatchPlaylistViewSet()
+
+    def _create(self, request_data):
+        request = Request(HttpRequest())
+        request.data.update(request_data)
+
+        with patch.object(self.view_set, '_raise_if_not_json'):
+            return self.view_set.create(request)
+
+    def test_create_success(self):
+        batch = [{'track_criteria': {}, 'total_duration': 4}] * 2
+        expected_results = [
+            {'status': 200, 'playlist': {}},
+            {'status': 400, 'detail': 'Request missing data'},
+        ]
+
+        with patch(
+            'autodjbackend.batch_generator.run_batch',
+            return_value=expected_results
+        ) as mocked_run_batch:
+            response = self._create({'requests': batch})
+
+        mocked_run_batch.assert_called_once_with(
+            views._generate_batch_item, batch
+        )
+        self.assertListEqual(expected_results, response.data['results'])
+
+    def test_create_not_a_list(self):
+        with self.assertRaises(ParseError):
+            self._create({'requests': 'data'})
+
+    def test_create_too_many(self):
+        with override_settings(PLAYLIST_BATCH_MAX_SIZE=1):
+            with self.assertRaises(ParseError):
+                self._create({'requests': [{}, {}]})
+
+    def test_generate_batch_item(self):
+        expected_playlist = {'tracks': [], 'total_duration': 4}
+
+        with patch(
+            'autodjbackend.utils.get_random_seed_node',
+            return_value=[models.Track(uuid='a')]
+        ):
+            with patch(
+                'autodjbackend.playlist_generator.generate',
+                return_value=expected_playlist
+            ):
+                actual_value = views._generate_batch_item(
+                    {'track_criteria': {}, 'total_duration': 4}
+                )
+
+        self.assertDictEqual(
+            {'status': 200, 'playlist': expected_playlist}, actual_value
+        )
+
+    def test_generate_batch_item_invalid(self):
+        actual_value = views._generate_batch_item({'invalid': 'data'})
+
+        assert actual_value['status'] == 400
+
+
+class TestGeneratePlaylist(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+
+    def _post(self, data, content_type='application/json'):
+        request = self.factory.post(
+            '/api/generate/async/', data, content_type=content_type
+        )
+        return async_to_sync(generate_playlist)(request)
+
+    def test_url(self):
+        assert resolve('/api/generate/async/').func is generate_playlist
+
+    def test_generate_success(self):
+        expected_output = {'tracks': [], 'total_duration': 4}
+        seed_nodes = [models.Track(uuid='a')]
+
+        with patch(
+            'autodjbackend.utils.get_random_seed_node',
+            return_value=seed_nodes
+        ):
+            with patch(
+                'autodjbackend.playlist_generator.agenerate',
+                return_value=expected_output
+            ) as mocked_agenerate:
+                response = self._post({
+                    'track_criteria': {'year': 1990},
+                    'total_duration': 4,
+                })
+
+        assert response.status_code == 200
+        self.assertDictEqual(expected_output, json.loads(response.content))
+        assert mocked_agenerate.call_args[0][0] is seed_nodes
+
+    def test_generate_server_timing(self):
+        with patch(
+            'autodjbackend.utils.get_random_seed_node',
+            return_value=[models.Track(uuid='a')]
+        ):
+            with patch(
+                'autodjbackend.playlist_generator.agenerate',
+                return_value={'tracks': [], 'total_duration': 4}
+            ):
+                response = self._post({
+                    'track_criteria': {'year': 1990},
+                    'total_duration': 4,
+                })
+
+        assert response['Server-Timing'].startswith('seed_lookup;dur=')
+        assert 'debug' not in json.loads(response.content)
+
+    def test_generate_missing_data(self):
+        response = self._post({'invalid': 'data'})
+
+        assert response.status_code == 400
+
+    def test_generate_invalid_json(self):
+        response = self._post('{not json')
+
+        assert response.status_code == 400
+
+    def test_generate_not_json(self):
+        response = self._post('data', content_type='text/plain')
+
+        assert response.status_code == 415
+
+    def test_generate_not_post(self):
+        request = self.factory.get('/api/generate/async/')
+
+        response = async_to_sync(generate_playlist)(request)
+
+        assert response.status_code == 405
+
+
+class TestExportMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_url(self):
+        assert resolve('/metrics').func is export_metrics
+
+    def test_export_metrics(self):
+        with patch(
+            'autodjbackend.metrics.render', return_value='metric 1\n'
+        ):
+            response = export_metrics(self.factory.get('/metrics'))
+
+        assert response.status_code == 200
+        assert response['Content-Type'].startswith('text/plain')
+        assert response.content == b'metric 1\n'
+
+    def test_export_metrics_not_get(self):
+        response = export_metrics(self.factory.post('/metrics'))
+
+        assert response.status_code == 405
@@ -0,0 +1,95 @@
+import collections
+import contextlib
+import contextvars
+import time
+
+
+# Phases of a playlist request.
+SEED_LOOKUP = 'seed_lookup'
+USER_TRACKS = 'user_tracks'
+NEIGHBORS_CACHE = 'neighbors_cache'
+NEIGHBORS_NEO4J = 'neighbors_neo4j'
+SCORING = 'scoring'
+SELECTION = 'selection'
+SERIALIZATION = 'serialization'
+
+_current_timer = contextvars.ContextVar('phase_timer', default=None)
+
+
+class PhaseTimer:
+    """
+    Cumulative time spent in each phase of a request.
+
+    A phase entered while another is running is only counted against
+    itself, so the Neo4j queries made while fetching a neighborhood aren't
+    also counted as time spent reading the cache.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations = collections.defaultdict(float)
+        self._nested = []
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self._nested.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.durations[name] += elapsed - self._nested.pop()
+            if self._nested:
+                self._nested[-1] += elapsed
+
+    def as_dict(self):
+        """
+        Returns the time spent in each phase, and in total, in milliseconds.
+        """
+        timings = {
+            name: round(duration * 1000, 3)
+            for name, duration in self.durations.items()
+        }
+        timings['total'] = round(
+            (time.perf_counter() - self.started) * 1000, 3
+        )
+
+        return timings
+
+    def server_timing(self):
+        """
+        Returns the timings as the value of a Server-Timing header.
+        """
+        return ', '.join(
+            f'{name};dur={duration}'
+            for name, duration in self.as_dict().items()
+        )
+
+
+@contextlib.contextmanager
+def record_phases():
+    """
+    Times every phase entered within the block, including in threads
+    started from it with sync_to_async, which copy the context.
+
+    Yields:
+        PhaseTimer: The timer the phases are recorded in.
+    """
+    timer = PhaseTimer()
+    token = _current_timer.set(timer)
+    try:
+        yield timer
+    finally:
+        _current_timer.reset(token)
+
+
+def phase(name):
+    """
+    Returns a context manager timing a phase of the current request, which
+    does nothing outside of record_phases.
+    """
+    timer = _current_timer.get()
+    if timer is None:
+        return contextlib.nullcontext()
+
+    return timer.phase(name)
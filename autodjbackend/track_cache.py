@@ -1,31 +1,567 @@
+import collections
+import heapq
+import logging
+import os
+import sys
+import threading
 import time
 
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
+
+from autodjbackend.models import Track
+from autodjbackend.track_catalog import LINK_NODE_RELATIONSHIPS, TrackCatalog
+from autodjbackend.utils import get_track_keyword_mask
+
+
+logger = logging.getLogger(__name__)
+
+TRACK_FIELDS = (
+    'uuid', 'title', 'artist', 'album', 'year', 'position', 'duration',
+    'original_artist',
+)
+
+# Rough per-track overhead of an unsaved Track, on top of its strings.
+TRACK_SIZE_ESTIMATE = 1024
+
+# Entries written to a backend at once when the cache is warmed.
+WARM_BATCH_SIZE = 1000
+
+
+def _compact_tracks(tracks):
+    return tuple(
+        [getattr(track, field) for track in tracks] for field in TRACK_FIELDS
+    ) + ([get_track_keyword_mask(track) for track in tracks],)
+
+
+def _inflate_tracks(columns):
+    tracks = []
+    for row in zip(*columns):
+        track = Track(**dict(zip(TRACK_FIELDS, row)))
+        track.keyword_mask = row[len(TRACK_FIELDS)]
+        tracks.append(track)
+
+    return tracks
+
+
+def _set_keyword_masks(tracks):
+    for track in tracks:
+        get_track_keyword_mask(track)
+
+    return tracks
+
+
+def _approximate_size(tracks):
+    size = sys.getsizeof(tracks)
+    for track in tracks:
+        size += TRACK_SIZE_ESTIMATE + sum(
+            len(value) for value in (
+                track.title, track.artist, track.album, track.original_artist
+            )
+            if isinstance(value, str)
+        )
+
+    return size
+
+
+def _approximate_links_size(track_links):
+    return sys.getsizeof(track_links) + sum(
+        sys.getsizeof(rel_type) + sys.getsizeof(link_uuid)
+        for rel_type, link_uuid in track_links
+    )
+
+
+class _CacheEntry:
+    __slots__ = ('value', 'size', 'expires_at')
+
+    def __init__(self, value, size, expires_at):
+        self.value = value
+        self.size = size
+        self.expires_at = expires_at
+
+
+class _Stripe:
+    """
+    One independently locked segment of the cache, kept in LRU order.
+
+    Methods which drop entries return the bytes freed, so that the backend
+    can keep its total size.
+    """
+
+    def __init__(self, max_entries):
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.max_entries = max_entries
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def remove(self, uuid):
+        entry = self.entries.pop(uuid)
+        self.size -= entry.size
+        return entry.size
+
+    def evict(self):
+        freed = 0
+        while len(self.entries) > self.max_entries:
+            freed += self.evict_oldest()
+
+        return freed
+
+    def evict_oldest(self):
+        _, entry = self.entries.popitem(last=False)
+        self.size -= entry.size
+        self.evictions += 1
+        return entry.size
+
+
+class LocalTrackCacheBackend:
+    """
+    Bounded, thread-safe, in-process store for one tier of the cache.
+
+    Entries expire after the TTL, and the least recently used entries are
+    evicted once the store holds more than `max_entries` entries or
+    roughly `max_bytes`, as estimated by `size_of`. Keys are spread over
+    separately locked stripes, so concurrent requests rarely contend on the
+    same lock. Values are held as-is, with no serialization.
+
+    The entry limit is split between the stripes, but the byte limit is
+    shared by all of them, so that one large link node, such as a year
+    with tens of thousands of tracks, fits as long as it is within
+    `max_bytes`. A value larger than that is not stored at all, rather than
+    flushing the cache.
+    """
+
+    def __init__(
+        self, max_entries, max_bytes, ttl, stripes,
+        size_of=_approximate_size
+    ):
+        self.ttl = ttl
+        self.size_of = size_of
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.size_lock = threading.Lock()
+        self.stripes = [
+            _Stripe(max(1, max_entries // stripes)) for _ in range(stripes)
+        ]
+
+    def get(self, uuid):
+        stripe = self._get_stripe(uuid)
+        with stripe.lock:
+            try:
+                entry = stripe.entries[uuid]
+            except KeyError:
+                stripe.misses += 1
+                raise
+
+            if time.monotonic() > entry.expires_at:
+                self._add_size(-stripe.remove(uuid))
+                stripe.expirations += 1
+                stripe.misses += 1
+                raise KeyError(uuid)
+
+            stripe.entries.move_to_end(uuid)
+            stripe.hits += 1
+            return entry.value
+
+    def set(self, uuid, value):
+        entry = _CacheEntry(
+            value, self.size_of(value), time.monotonic() + self.ttl
+        )
+
+        stripe = self._get_stripe(uuid)
+        with stripe.lock:
+            freed = 0
+            if uuid in stripe.entries:
+                freed = stripe.remove(uuid)
+            if entry.size > self.max_bytes:
+                logger.debug(f'Too large to cache: {uuid}')
+                self._add_size(-freed)
+                return
+
+            stripe.entries[uuid] = entry
+            stripe.size += entry.size
+            freed += stripe.evict()
+        self._add_size(entry.size - freed)
+        self._evict_bytes(stripe)
+
+    def set_many(self, items):
+        for uuid, value in items:
+            self.set(uuid, value)
+
+    def keys(self, limit=None):
+        """
+        Returns the keys of unexpired entries, or with a limit, the keys of
+        at most that many of the largest entries.
+        """
+        now = time.monotonic()
+        entries = []
+        for stripe in self.stripes:
+            with stripe.lock:
+                entries.extend(
+                    (entry.size, uuid)
+                    for uuid, entry in stripe.entries.items()
+                    if now <= entry.expires_at
+                )
+        if limit is not None:
+            entries = heapq.nlargest(limit, entries)
+
+        return [uuid for _, uuid in entries]
+
+    def get_stats(self):
+        stats = collections.Counter()
+        for stripe in self.stripes:
+            with stripe.lock:
+                stats['entries'] += len(stripe.entries)
+                stats['bytes'] += stripe.size
+                stats['hits'] += stripe.hits
+                stats['misses'] += stripe.misses
+                stats['evictions'] += stripe.evictions
+                stats['expirations'] += stripe.expirations
+
+        return dict(stats)
+
+    def _get_stripe(self, uuid):
+        return self.stripes[hash(uuid) % len(self.stripes)]
+
+    def _add_size(self, delta):
+        with self.size_lock:
+            self.size += delta
+            return self.size
+
+    def _evict_bytes(self, last_stripe):
+        """
+        Evicts the least recently used entry of each stripe in turn until
+        the cache is within max_bytes, ending with the stripe just written
+        to, and never evicting the only entry of that stripe.
+
+        Only one stripe lock is held at a time.
+        """
+        start = self.stripes.index(last_stripe) + 1
+        stripes = self.stripes[start:] + self.stripes[:start]
+        evicted = True
+        while evicted:
+            evicted = False
+            for stripe in stripes:
+                if self._add_size(0) <= self.max_bytes:
+                    return
+
+                with stripe.lock:
+                    minimum = 1 if stripe is last_stripe else 0
+                    if len(stripe.entries) > minimum:
+                        self._add_size(-stripe.evict_oldest())
+                        evicted = True
+
+
+class DjangoTrackCacheBackend:
+    """
+    Stores one tier of the cache in a Django cache, shared between workers.
+
+    With a memcached or Redis cache configured under TRACK_CACHE_ALIAS,
+    every worker reads the same entries instead of loading its own. Values
+    pass through `encode` and `decode`, so that tracks are stored as a tuple
+    of property columns rather than pickled Track objects.
+
+    The cache itself can not list its keys, so this worker remembers the
+    keys it has written or read, along with when they expire, and `keys`
+    only returns those.
+    """
+
+    def __init__(
+        self, alias, ttl, prefix='link_node', encode=_compact_tracks,
+        decode=_inflate_tracks
+    ):
+        self.cache = caches[alias]
+        self.ttl = ttl
+        self.prefix = prefix
+        self.encode = encode
+        self.decode = decode
+        self.lock = threading.Lock()
+        self.known_uuids = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, uuid):
+        value = self.cache.get(self._cache_key(uuid))
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                self.known_uuids.pop(uuid, None)
+                raise KeyError(uuid)
+
+            self.hits += 1
+            self.known_uuids.setdefault(uuid, time.monotonic() + self.ttl)
+
+        return self.decode(value)
+
+    def set(self, uuid, value):
+        self.cache.set(self._cache_key(uuid), self.encode(value), self.ttl)
+        with self.lock:
+            self.known_uuids[uuid] = time.monotonic() + self.ttl
+
+    def set_many(self, items):
+        """
+        Writes many (uuid, value) pairs in one round trip.
+        """
+        items = list(items)
+        self.cache.set_many(
+            {
+                self._cache_key(uuid): self.encode(value)
+                for uuid, value in items
+            },
+            self.ttl
+        )
+        expires_at = time.monotonic() + self.ttl
+        with self.lock:
+            for uuid, _ in items:
+                self.known_uuids[uuid] = expires_at
+
+    def keys(self, limit=None):
+        """
+        Returns the keys this worker has written or read, and not seen
+        expire, or with a limit, at most that many of them, as their sizes
+        aren't known. Entries written by other workers are left out until this
+        worker reads them, so a neighborhood query may return the tracks of
+        a link node another worker has already cached, which are then
+        written again. A track whose link nodes another worker has cached
+        still makes no query, as they are looked up with get. Keys evicted
+        by the cache itself are still returned, and their tracks fetched
+        when get misses.
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.known_uuids = {
+                uuid: expires_at
+                for uuid, expires_at in self.known_uuids.items()
+                if now <= expires_at
+            }
+            return list(self.known_uuids)[:limit]
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.known_uuids),
+                'bytes': 0,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': 0,
+                'expirations': 0,
+            }
+
+    def _cache_key(self, uuid):
+        return f'track_cache:{self.prefix}:{uuid}'
+
 
 class TrackCache:
+    """
+    Two tier cache of the graph around each track.
+
+    The first tier maps each link node to its tracks. The second maps each
+    track to the (relationship type, link node uuid) pairs it belongs to,
+    including an empty result for tracks without link nodes, so with a warm
+    cache a track's neighborhood is found without querying Neo4j.
+
+    Each tier is held by the backend named in TRACK_CACHE_BACKEND: 'local'
+    for a per-process LRU cache, or 'django' for a Django cache shared by
+    every worker. Entries expire after TRACK_CACHE_TTL seconds.
+
+    Tracks get the keyword mask of their title when they enter the cache,
+    and keep it in either backend, so scoring never recomputes it.
+
+    If a memory mapped catalog is given, anything missing from the backends
+    is read from it instead of being reported as a miss.
+    """
     _instance = None
+    _instance_lock = threading.Lock()
 
-    def __init__(self):
-        self.link_node_cache = {}
+    def __init__(
+        self, link_node_backend=None, track_links_backend=None, catalog=None
+    ):
+        self.catalog = catalog
+        self.link_node_backend = (
+            link_node_backend or _get_backend_from_settings(
+                'link_node', _approximate_size, _compact_tracks,
+                _inflate_tracks, settings.TRACK_CACHE_MAX_ENTRIES
+            )
+        )
+        self.track_links_backend = (
+            track_links_backend or _get_backend_from_settings(
+                'track_links', _approximate_links_size, tuple, tuple,
+                settings.TRACK_CACHE_MAX_TRACKS
+            )
+        )
 
     @classmethod
     def get_instance(cls):
-        if cls._instance is None:
-            cls._instance = TrackCache()
+        """
+        Returns the shared cache, created the first time it is requested.
+
+        Anything missing from the cache is read from the catalog mapped from
+        TRACK_CATALOG_PATH if that is set. Otherwise, if the snapshot at
+        TRACK_CACHE_SNAPSHOT_PATH exists, it is a catalog file too, and is
+        mapped and used the same way. Nothing is built or warmed entry by
+        entry, so startup only takes the milliseconds of mapping the file.
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = TrackCache(catalog=_get_startup_catalog())
 
         return cls._instance
 
+    def warm(self, track_rows, memberships):
+        """
+        Adds every link node membership, and the link nodes of every track,
+        to the cache, writing WARM_BATCH_SIZE entries at a time.
+
+        Args:
+            track_rows (list(tuple)): Rows of (uuid, title, artist, album,
+                year, position, duration, original_artist).
+            memberships (dict()): Maps each Track relationship name to a list
+                of (link node uuid, [track uuid]) pairs.
+        """
+        tracks = {
+            row[0]: Track(**dict(zip(TRACK_FIELDS, row))) for row in track_rows
+        }
+        _set_keyword_masks(tracks.values())
+        track_links = {uuid: [] for uuid in tracks}
+        link_nodes = []
+
+        for rel, link_rows in memberships.items():
+            _, rel_type = LINK_NODE_RELATIONSHIPS[rel]
+            for link_uuid, member_uuids in link_rows:
+                link_nodes.append(
+                    (link_uuid, [tracks[uuid] for uuid in member_uuids])
+                )
+                for uuid in member_uuids:
+                    track_links[uuid].append((rel_type, link_uuid))
+
+        _set_in_batches(self.link_node_backend, link_nodes)
+        _set_in_batches(
+            self.track_links_backend,
+            ((uuid, tuple(links)) for uuid, links in track_links.items())
+        )
+
+        logger.info(
+            f'Track cache warmed. Tracks: {len(tracks)}, link nodes: '
+            f'{sum(len(link_rows) for link_rows in memberships.values())}'
+        )
+
     def get_tracks_from_link_node(self, uuid):
-        cache = self.link_node_cache[uuid]
+        try:
+            return self.link_node_backend.get(uuid)
+        except KeyError:
+            if self.catalog is None:
+                raise
 
-        now = time.time()
-        if now - cache['time'] > 3600:
-            del self.link_node_cache[uuid]
-            raise KeyError
+        tracks = self.catalog.get_tracks_from_link_node(uuid)
+        self.link_node_backend.set(uuid, tracks)
+        return tracks
 
-        return cache['tracks']
+    def get_link_node_uuids(self, limit=None):
+        """
+        Returns the uuids of the cached link nodes, or with a limit, of at
+        most that many of them, favouring the largest where their sizes are
+        known.
+        """
+        return self.link_node_backend.keys(limit)
 
     def add_result_to_cache(self, uuid, result):
-        self.link_node_cache[uuid] = {
-            'tracks': result,
-            'time': time.time()
+        self.link_node_backend.set(uuid, _set_keyword_masks(result))
+
+    def get_link_nodes_of_track(self, uuid):
+        """
+        Returns the (relationship type, link node uuid) pairs of a track.
+
+        An empty tuple means the track is known to have no link nodes, while
+        a KeyError means it is not in the cache.
+        """
+        if self.catalog is not None:
+            try:
+                return self.catalog.get_link_nodes_of_track(uuid)
+            except KeyError:
+                pass
+
+        return self.track_links_backend.get(uuid)
+
+    def add_link_nodes_of_track(self, uuid, track_links):
+        self.track_links_backend.set(uuid, tuple(track_links))
+
+    def get_stats(self):
+        """
+        Returns the entry count, approximate size, and hit, miss, eviction
+        and expiration counters of each tier.
+        """
+        return {
+            'link_nodes': self.link_node_backend.get_stats(),
+            'track_links': self.track_links_backend.get_stats(),
         }
+
+
+def _get_startup_catalog():
+    catalog = TrackCatalog.get_mapped_instance()
+    if catalog is not None:
+        return catalog
+
+    snapshot_path = settings.TRACK_CACHE_SNAPSHOT_PATH
+    if not snapshot_path or not os.path.exists(snapshot_path):
+        return None
+
+    catalog = TrackCatalog.open(snapshot_path)
+    logger.info(
+        f'Track cache snapshot mapped from {snapshot_path}. Tracks: '
+        f'{len(catalog)}'
+    )
+    return catalog
+
+
+def _set_in_batches(backend, items):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == WARM_BATCH_SIZE:
+            backend.set_many(batch)
+            batch = []
+    if batch:
+        backend.set_many(batch)
+
+
+def _check_shared_cache(alias):
+    # Of Django's own backends, only memcached is shared by every worker and
+    # keeps writes cheap. The file based and database caches cull on every
+    # write, at a cost growing with the entries held.
+    try:
+        backend = settings.CACHES[alias]['BACKEND']
+    except KeyError:
+        raise ImproperlyConfigured(
+            f'TRACK_CACHE_BACKEND is django, but no cache is configured '
+            f'under TRACK_CACHE_ALIAS {alias!r}. Set '
+            f'TRACK_CACHE_DJANGO_BACKEND and TRACK_CACHE_LOCATION to a '
+            f'memcached or Redis cache.'
+        )
+    if (
+        backend.startswith('django.core.cache.backends.') and
+        not backend.startswith('django.core.cache.backends.memcached.')
+    ):
+        raise ImproperlyConfigured(
+            f'The track cache needs a memcached or Redis cache, not '
+            f'{backend}.'
+        )
+
+
+def _get_backend_from_settings(
+    prefix, size_of, encode, decode, max_entries
+):
+    if settings.TRACK_CACHE_BACKEND == 'django':
+        _check_shared_cache(settings.TRACK_CACHE_ALIAS)
+        return DjangoTrackCacheBackend(
+            settings.TRACK_CACHE_ALIAS, settings.TRACK_CACHE_TTL, prefix,
+            encode, decode
+        )
+
+    return LocalTrackCacheBackend(
+        max_entries, settings.TRACK_CACHE_MAX_BYTES, settings.TRACK_CACHE_TTL,
+        settings.TRACK_CACHE_STRIPES, size_of
+    )
@@ -0,0 +1,606 @@
+import json
+import logging
+import mmap
+import os
+import random
+import struct
+import threading
+
+import neomodel
+import numpy as np
+from django.conf import settings
+
+from autodjbackend.models import Track
+from autodjbackend.utils import (
+    get_keyword_mask, sample_link_nodes
+)
+
+
+logger = logging.getLogger(__name__)
+
+# Track relationship name -> (link node label, relationship type).
+LINK_NODE_RELATIONSHIPS = {
+    'same_track_number': ('SameTrackNumber', 'SAME_NUMBER'),
+    'same_original_artist': ('SameOriginalArtist', 'SAME_ORIGINAL_ARTIST'),
+    'same_year': ('SameYear', 'SAME_YEAR'),
+    'keyword_in_title': ('KeywordInTitle', 'KEYWORD_IN_TITLE'),
+}
+
+GET_ALL_TRACKS_QUERY = (
+    'MATCH (t:Track) RETURN t.uuid, t.title, t.artist, t.album, t.year, '
+    't.position, t.duration, t.original_artist'
+)
+
+GET_LINK_NODE_MEMBERS_QUERY = (
+    'MATCH (l:{label})-[:{rel_type}]->(t:Track) '
+    'RETURN l.uuid, collect(t.uuid)'
+)
+
+# Dictionary id of a missing string, such as a track without an original
+# artist. Lookups of unknown strings return -1 instead.
+NULL_ID = -2
+
+CATALOG_MAGIC = b'AUTODJCT'
+CATALOG_VERSION = 1
+CATALOG_HEADER = struct.Struct('<8sII')
+CATALOG_ALIGNMENT = 64
+
+
+class StringTable:
+    """
+    An immutable sequence of strings, stored as a single UTF-8 blob.
+
+    `offsets` holds where each string starts and ends in `blob`, and `order`
+    lists the strings in sorted order, so that a string can be found by
+    binary search. All three are plain arrays, so a table can be read
+    straight out of a memory mapped catalog file.
+    """
+
+    def __init__(self, blob, offsets, order):
+        self.blob = blob
+        self.offsets = offsets
+        self.order = order
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [string.encode('utf-8') for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(
+            np.array([len(value) for value in encoded], dtype=np.int64),
+            out=offsets[1:]
+        )
+        order = sorted(range(len(encoded)), key=encoded.__getitem__)
+
+        return cls(
+            np.frombuffer(b''.join(encoded), dtype=np.uint8),
+            offsets,
+            np.array(order, dtype=np.int32),
+        )
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self._get_bytes(index).decode('utf-8')
+
+    def find(self, string):
+        """
+        Returns the index of a string, or -1 if it is not in the table.
+        """
+        if not isinstance(string, str):
+            return -1
+
+        target = string.encode('utf-8')
+        low, high = 0, len(self.order)
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_bytes(self.order[middle]) < target:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < len(self.order):
+            index = int(self.order[low])
+            if self._get_bytes(index) == target:
+                return index
+
+        return -1
+
+    def _get_bytes(self, index):
+        return self.blob[self.offsets[index]:self.offsets[index + 1]].tobytes()
+
+
+class LinkNodeIndex:
+    """
+    Link node membership for a single relation, stored in CSR form.
+
+    `link_offsets`/`link_members` map each link node to the catalog indices
+    of its tracks, and `track_offsets`/`track_links` map each track back to
+    the link nodes it belongs to.
+    """
+
+    def __init__(
+        self, link_uuids, link_offsets, link_members, track_offsets,
+        track_links
+    ):
+        self.link_uuids = link_uuids
+        self.link_offsets = link_offsets
+        self.link_members = link_members
+        self.track_offsets = track_offsets
+        self.track_links = track_links
+
+    @classmethod
+    def from_memberships(cls, memberships, track_count):
+        """
+        Builds the index from a list of (link uuid, [track index]) pairs.
+        """
+        link_uuids = StringTable.from_strings(
+            [link_uuid for link_uuid, _ in memberships]
+        )
+        sizes = np.array(
+            [len(members) for _, members in memberships], dtype=np.int64
+        )
+        link_offsets = np.zeros(len(memberships) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=link_offsets[1:])
+        link_members = np.fromiter(
+            (index for _, members in memberships for index in members),
+            dtype=np.int32, count=int(link_offsets[-1])
+        )
+
+        # Invert the membership lists to get track -> link nodes.
+        link_of_member = np.repeat(
+            np.arange(len(memberships), dtype=np.int32), sizes
+        )
+        order = np.argsort(link_members, kind='stable')
+        track_links = link_of_member[order]
+        track_offsets = np.zeros(track_count + 1, dtype=np.int64)
+        np.cumsum(
+            np.bincount(link_members, minlength=track_count),
+            out=track_offsets[1:]
+        )
+
+        return cls(
+            link_uuids, link_offsets, link_members, track_offsets,
+            track_links
+        )
+
+    def links_of(self, index):
+        start, end = self.track_offsets[index], self.track_offsets[index + 1]
+        return self.track_links[start:end]
+
+    def members_of(self, link):
+        start, end = self.link_offsets[link], self.link_offsets[link + 1]
+        return self.link_members[start:end]
+
+
+class TrackCatalog:
+    """
+    In-memory, column oriented copy of every track and link node membership.
+
+    Each track property is held in its own fixed width array, indexed by a
+    catalog index assigned at load time. Titles, albums and artists are
+    dictionary encoded, with artists and original artists sharing a single
+    dictionary so that comparing them is an integer comparison, and the
+    keywords in each title are precomputed as a bitmask. Once loaded, the
+    playlist generator can run against the catalog without any further
+    queries to Neo4j.
+
+    A catalog can be saved to a single file, and opened again with every
+    array memory mapped rather than read, so workers on the same host share
+    one copy of it in the page cache.
+    """
+    _instance = None
+    _mapped_instance = None
+    _lock = threading.Lock()
+
+    def __init__(
+        self, uuids, title_ids, title_names, album_ids, album_names,
+        artist_ids, original_artist_ids, artist_names, keyword_masks, years,
+        positions, durations, link_indexes
+    ):
+        self.uuids = uuids
+        self.title_ids = title_ids
+        self.title_names = title_names
+        self.album_ids = album_ids
+        self.album_names = album_names
+        self.artist_ids = artist_ids
+        self.original_artist_ids = original_artist_ids
+        self.artist_names = artist_names
+        self.keyword_masks = keyword_masks
+        self.years = years
+        self.positions = positions
+        self.durations = durations
+        self.link_indexes = link_indexes
+
+    def __len__(self):
+        return len(self.uuids)
+
+    @classmethod
+    def get_instance(cls):
+        """
+        Returns the shared catalog, or None if the catalog is disabled.
+
+        The catalog is mapped from TRACK_CATALOG_PATH if it is set, and
+        otherwise loaded from Neo4j, the first time it is requested.
+        """
+        if not settings.TRACK_CATALOG_ENABLED:
+            return None
+
+        if settings.TRACK_CATALOG_PATH:
+            return cls.get_mapped_instance()
+
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls.load()
+
+        return cls._instance
+
+    @classmethod
+    def get_mapped_instance(cls):
+        """
+        Returns the catalog mapped from TRACK_CATALOG_PATH, or None if no
+        path is set.
+        """
+        if not settings.TRACK_CATALOG_PATH:
+            return None
+
+        with cls._lock:
+            if cls._mapped_instance is None:
+                cls._mapped_instance = cls.open(settings.TRACK_CATALOG_PATH)
+
+        return cls._mapped_instance
+
+    @classmethod
+    def load(cls):
+        """
+        Loads the catalog from Neo4j.
+        """
+        logger.info('Loading track catalog.')
+        catalog = cls.from_rows(*load_graph_rows())
+        logger.info(f'Track catalog loaded. Total: {len(catalog)}')
+        return catalog
+
+    @classmethod
+    def from_rows(cls, track_rows, memberships):
+        """
+        Builds a catalog from raw track rows and link node memberships.
+
+        Args:
+            track_rows (list(tuple)): Rows of (uuid, title, artist, album,
+                year, position, duration, original_artist).
+            memberships (dict()): Maps each Track relationship name to a list
+                of (link node uuid, [track uuid]) pairs.
+
+        Returns:
+            TrackCatalog: The populated catalog.
+        """
+        uuids = [row[0] for row in track_rows]
+        uuid_to_index = {uuid: i for i, uuid in enumerate(uuids)}
+
+        titles, albums, artists = {}, {}, {}
+
+        link_indexes = {}
+        for rel in LINK_NODE_RELATIONSHIPS:
+            link_indexes[rel] = LinkNodeIndex.from_memberships(
+                [
+                    (
+                        link_uuid,
+                        [
+                            uuid_to_index[uuid] for uuid in member_uuids
+                            if uuid in uuid_to_index
+                        ]
+                    )
+                    for link_uuid, member_uuids in memberships.get(rel, [])
+                ],
+                len(uuids)
+            )
+
+        return cls(
+            uuids=StringTable.from_strings(uuids),
+            title_ids=_id_column(titles, track_rows, 1),
+            title_names=StringTable.from_strings(titles),
+            album_ids=_id_column(albums, track_rows, 3),
+            album_names=StringTable.from_strings(albums),
+            artist_ids=_id_column(artists, track_rows, 2),
+            original_artist_ids=_id_column(artists, track_rows, 7),
+            artist_names=StringTable.from_strings(artists),
+            keyword_masks=np.array(
+                [get_keyword_mask(row[1] or '') for row in track_rows],
+                dtype=np.uint32
+            ),
+            years=_int_column(track_rows, 4, np.int32),
+            positions=_int_column(track_rows, 5, np.int32),
+            durations=_int_column(track_rows, 6, np.int64),
+            link_indexes=link_indexes,
+        )
+
+    @classmethod
+    def open(cls, path):
+        """
+        Memory maps a catalog written by `save`.
+
+        No array is read or copied. Pages are loaded on first use and shared
+        with every other process mapping the same file.
+
+        Raises:
+            ValueError: If the file is not a catalog of the current version.
+        """
+        with open(path, 'rb') as file:
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(buffer) < CATALOG_HEADER.size:
+            raise ValueError(f'Track catalog is truncated: {path}')
+
+        magic, version, header_size = CATALOG_HEADER.unpack_from(buffer)
+        if magic != CATALOG_MAGIC or version != CATALOG_VERSION:
+            raise ValueError(f'Unsupported track catalog: {magic} v{version}')
+
+        header = json.loads(
+            buffer[CATALOG_HEADER.size:CATALOG_HEADER.size + header_size]
+        )
+        arrays = {
+            name: _map_array(buffer, dtype, offset, count)
+            for name, (dtype, offset, count) in header.items()
+        }
+
+        logger.info(f'Track catalog mapped from {path}.')
+        return cls._from_arrays(arrays)
+
+    def save(self, path):
+        """
+        Writes the catalog to a single file that `open` can memory map.
+
+        The file starts with a versioned header listing the dtype, offset and
+        length of every array, followed by the arrays themselves, each
+        aligned to CATALOG_ALIGNMENT bytes.
+        """
+        arrays = self._to_arrays()
+
+        header = {}
+        offset = _align(
+            CATALOG_HEADER.size + len(json.dumps(_placeholder_header(arrays)))
+        )
+        for name, array in arrays.items():
+            header[name] = (array.dtype.str, offset, len(array))
+            offset = _align(offset + array.nbytes)
+        encoded_header = json.dumps(header).encode('utf-8')
+
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as file:
+            file.write(CATALOG_HEADER.pack(
+                CATALOG_MAGIC, CATALOG_VERSION, len(encoded_header)
+            ))
+            file.write(encoded_header)
+            for name, array in arrays.items():
+                file.seek(header[name][1])
+                file.write(np.ascontiguousarray(array).tobytes())
+
+        os.replace(tmp_path, path)
+
+    def index_of(self, uuid):
+        index = self.uuids.find(uuid)
+        if index == -1:
+            raise KeyError(uuid)
+
+        return index
+
+    def artist_id(self, name):
+        """
+        Returns the dictionary id of an artist name, NULL_ID for None, or -1
+        if the artist is unknown.
+        """
+        if name is None:
+            return NULL_ID
+
+        return self.artist_names.find(name)
+
+    def neighbors(
+        self, index, candidate_budget=None, rng=random, exclude=None
+    ):
+        """
+        Returns the catalog indices of every track sharing a link node with
+        the given track, including the track itself unless excluded.
+
+        Tracks set in the exclude mask, such as those already played, are
+        left out before a candidate budget is applied, so they never use up
+        its quota. Link nodes larger than their share of the budget are then
+        sampled, as described in sample_link_nodes.
+        """
+        members = [
+            link_index.members_of(link)
+            for link_index in self.link_indexes.values()
+            for link in link_index.links_of(index)
+        ]
+        if exclude is not None:
+            members = [
+                link_members[~exclude[link_members]]
+                for link_members in members
+            ]
+        if candidate_budget:
+            members = sample_link_nodes(members, candidate_budget, rng)
+        if not members:
+            return np.empty(0, dtype=np.int32)
+
+        return np.unique(np.concatenate(members))
+
+    def get_link_nodes_of_track(self, uuid):
+        """
+        Returns the (relationship type, link node uuid) pairs of a track.
+
+        Raises:
+            KeyError: If the track is not in the catalog.
+        """
+        index = self.index_of(uuid)
+
+        return tuple(
+            (LINK_NODE_RELATIONSHIPS[rel][1], link_index.link_uuids[link])
+            for rel, link_index in self.link_indexes.items()
+            for link in link_index.links_of(index)
+        )
+
+    def get_tracks_from_link_node(self, uuid):
+        """
+        Returns an unsaved Track for every member of a link node.
+
+        Raises:
+            KeyError: If the link node is not in the catalog.
+        """
+        for link_index in self.link_indexes.values():
+            link = link_index.link_uuids.find(uuid)
+            if link != -1:
+                return [
+                    self.track(index)
+                    for index in link_index.members_of(link).tolist()
+                ]
+
+        raise KeyError(uuid)
+
+    def serialize(self, index):
+        return {
+            'uuid': self.uuids[index],
+            'title': _decode(self.title_names, self.title_ids[index]),
+            'artist': _decode(self.artist_names, self.artist_ids[index]),
+            'album': _decode(self.album_names, self.album_ids[index]),
+            'year': int(self.years[index]),
+            'position': int(self.positions[index]),
+            'duration': int(self.durations[index]),
+            'original_artist': _decode(
+                self.artist_names, self.original_artist_ids[index]
+            ),
+        }
+
+    def track(self, index):
+        """
+        Returns an unsaved Track holding the catalog row. No query is made.
+        """
+        track = Track(**self.serialize(index))
+        track.catalog_index = index
+        track.keyword_mask = int(self.keyword_masks[index])
+        return track
+
+    def _to_arrays(self):
+        arrays = {}
+        for name in STRING_TABLES:
+            _add_table_arrays(arrays, name, getattr(self, name))
+        for name in COLUMNS:
+            arrays[name] = getattr(self, name)
+        for rel, link_index in self.link_indexes.items():
+            _add_table_arrays(
+                arrays, f'{rel}.link_uuids', link_index.link_uuids
+            )
+            for name in LINK_NODE_COLUMNS:
+                arrays[f'{rel}.{name}'] = getattr(link_index, name)
+
+        return arrays
+
+    @classmethod
+    def _from_arrays(cls, arrays):
+        kwargs = {name: _get_table(arrays, name) for name in STRING_TABLES}
+        kwargs.update({name: arrays[name] for name in COLUMNS})
+        kwargs['link_indexes'] = {
+            rel: LinkNodeIndex(
+                _get_table(arrays, f'{rel}.link_uuids'),
+                *[arrays[f'{rel}.{name}'] for name in LINK_NODE_COLUMNS]
+            )
+            for rel in LINK_NODE_RELATIONSHIPS
+        }
+
+        return cls(**kwargs)
+
+
+STRING_TABLES = ('uuids', 'title_names', 'album_names', 'artist_names')
+
+COLUMNS = (
+    'title_ids', 'album_ids', 'artist_ids', 'original_artist_ids',
+    'keyword_masks', 'years', 'positions', 'durations',
+)
+
+LINK_NODE_COLUMNS = (
+    'link_offsets', 'link_members', 'track_offsets', 'track_links',
+)
+
+STRING_TABLE_ARRAYS = ('blob', 'offsets', 'order')
+
+
+def load_graph_rows():
+    """
+    Loads every track and link node membership from Neo4j.
+
+    This costs one query for the tracks, and one per link node type.
+
+    Returns:
+        tuple(list(tuple), dict()): Rows of (uuid, title, artist, album,
+            year, position, duration, original_artist), and a dict mapping
+            each Track relationship name to a list of
+            (link node uuid, [track uuid]) pairs.
+    """
+    track_rows, _ = neomodel.db.cypher_query(GET_ALL_TRACKS_QUERY)
+
+    memberships = {}
+    for rel, (label, rel_type) in LINK_NODE_RELATIONSHIPS.items():
+        query = GET_LINK_NODE_MEMBERS_QUERY.format(
+            label=label, rel_type=rel_type
+        )
+        memberships[rel], _ = neomodel.db.cypher_query(query)
+
+    return track_rows, memberships
+
+
+def _encode(dictionary, value):
+    if value is None:
+        return NULL_ID
+
+    try:
+        return dictionary[value]
+    except KeyError:
+        dictionary[value] = len(dictionary)
+        return dictionary[value]
+
+
+def _decode(string_table, string_id):
+    if string_id == NULL_ID:
+        return None
+
+    return string_table[string_id]
+
+
+def _id_column(dictionary, track_rows, column):
+    return np.array(
+        [_encode(dictionary, row[column]) for row in track_rows],
+        dtype=np.int32
+    )
+
+
+def _int_column(track_rows, column, dtype):
+    return np.array([row[column] or 0 for row in track_rows], dtype=dtype)
+
+
+def _map_array(buffer, dtype, offset, count):
+    if count == 0:
+        return np.empty(0, dtype=dtype)
+
+    return np.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+
+
+def _add_table_arrays(arrays, name, string_table):
+    for array_name in STRING_TABLE_ARRAYS:
+        arrays[f'{name}.{array_name}'] = getattr(string_table, array_name)
+
+
+def _get_table(arrays, name):
+    return StringTable(
+        *[arrays[f'{name}.{array_name}'] for array_name in STRING_TABLE_ARRAYS]
+    )
+
+
+def _placeholder_header(arrays):
+    # Offsets are not known until the header size is, so size the header
+    # with the largest offset any array could have.
+    return {
+        name: (array.dtype.str, 2 ** 63 - 1, len(array))
+        for name, array in arrays.items()
+    }
+
+
+def _align(offset):
+    return -(-offset // CATALOG_ALIGNMENT) * CATALOG_ALIGNMENT
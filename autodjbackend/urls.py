@@ -21,9 +21,16 @@ from rest_framework import routers
 from autodjbackend import views
 
 router = routers.DefaultRouter()
+# Before generate, whose detail route would also match this prefix.
+router.register(
+    r'generate/batch', views.BatchPlaylistViewSet, basename='GenerateBatch'
+)
 router.register(r'generate', views.CreatePlaylistViewSet, basename='Generate')
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    # Before the router, whose detail route would also match this path.
+    path('api/generate/async/', views.generate_playlist),
     path('api/', include(router.urls)),
+    path('metrics', views.export_metrics),
 ]
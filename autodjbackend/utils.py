@@ -1,4 +1,7 @@
 import logging
+import random
+
+import neomodel
 
 from autodjbackend import models
 
@@ -12,15 +15,41 @@ VALID_CRITERIA = [
     'keyword_in_title',
 ]
 
-CRITERA_TO_NODE_MODEL = {
-    'track_number': models.SameTrackNumber.nodes,
-    'year': models.SameYear.nodes,
-    'original_artist': models.SameOriginalArtist.nodes,
-    'keyword_in_title': models.KeywordInTitle.nodes,
-}
-
 MINUTES_TO_MILLISECONDS = 60000
 
+# One row per requested track, with the first match or null.
+RESOLVE_USER_TRACKS_QUERY = (
+    'UNWIND $entries AS entry '
+    'OPTIONAL MATCH (track:Track) WHERE {conditions} '
+    'WITH entry, head(collect(track)) AS track '
+    'RETURN entry.index, track'
+)
+
+KEYWORDS = [
+    'river',
+    'love',
+    'blues',
+    'party',
+    'time',
+    'tonight',
+    'rain',
+    'morning',
+    'breathe',
+    'fire',
+    'woman',
+    'disco',
+    'rock',
+    'music',
+    'dancin',
+    'baby',
+    'twist',
+    'lonely',
+    'stop',
+    'boogie',
+    'christmas',
+    'moon',
+]
+
 
 def get_criteria_to_search(track_criteria):
     criteria_to_search = {}
@@ -33,8 +62,136 @@ def get_criteria_to_search(track_criteria):
     return criteria_to_search
 
 
-def get_seed_nodes_from_criteria(criteria_to_search):
-    return models.Track.nodes.filter(**criteria_to_search).all()
+def get_random_seed_node(criteria_to_search, rng=random):
+    """
+    Picks one track matching the criteria uniformly at random.
+
+    The matching tracks are counted, and a random number of them skipped,
+    so only the picked track is returned from the database however many
+    tracks match.
+
+    Returns:
+        list(Track): The picked track, or an empty list if none match.
+    """
+    # Ordered, so that a seeded generator skips to the same track each time.
+    tracks = models.Track.nodes.filter(**criteria_to_search).order_by('uuid')
+    track_count = len(tracks)
+    if not track_count:
+        return []
+
+    return [tracks[rng.randrange(track_count)]]
+
+
+def resolve_user_tracks(user_tracks_list):
+    """
+    Looks up every user-requested track in a single batched query.
+
+    Requests are grouped by the properties they search on, so the usual
+    requests of a title and artist are resolved in one query, returning at
+    most one track for each.
+
+    Args:
+        user_tracks_list (list(dict())): Properties of each requested track.
+
+    Returns:
+        list(Track): The first match for each request in order, or None
+            where nothing matched.
+
+    Raises:
+        ValueError: If a request searches on a property tracks don't have.
+    """
+    track_properties = models.Track.defined_properties(
+        aliases=False, rels=False
+    )
+    entries_by_keys = {}
+    for index, track_criteria in enumerate(user_tracks_list):
+        keys = tuple(sorted(track_criteria))
+        unknown_keys = set(keys) - set(track_properties)
+        if not keys or unknown_keys:
+            raise ValueError(
+                f'Invalid track to include: {track_criteria}'
+            )
+        entries_by_keys.setdefault(keys, []).append(
+            {'index': index, 'criteria': track_criteria}
+        )
+
+    user_tracks = [None] * len(user_tracks_list)
+    for keys, entries in entries_by_keys.items():
+        conditions = ' AND '.join(
+            f'track.{key} = entry.criteria.{key}' for key in keys
+        )
+        results, _ = neomodel.db.cypher_query(
+            RESOLVE_USER_TRACKS_QUERY.format(conditions=conditions),
+            {'entries': entries},
+            resolve_objects=True
+        )
+        for index, track in results:
+            user_tracks[index] = track
+
+    return user_tracks
+
+
+def get_keyword_mask(title):
+    """
+    Returns a bitmask of the KEYWORDS contained in a title.
+
+    Bit i is set if KEYWORDS[i] is a substring of the title, so the number of
+    keywords two titles share is the popcount of their masks ANDed together.
+    """
+    mask = 0
+    for bit, keyword in enumerate(KEYWORDS):
+        if keyword in title:
+            mask |= 1 << bit
+
+    return mask
+
+
+def get_track_keyword_mask(track):
+    """
+    Returns the keyword mask of a track's title.
+
+    Tracks read from the TrackCache or the catalog carry their mask as
+    `keyword_mask`. Any other track gets it computed once and kept there.
+    """
+    try:
+        return track.keyword_mask
+    except AttributeError:
+        track.keyword_mask = get_keyword_mask(track.title or '')
+
+    return track.keyword_mask
+
+
+def strip_newlines(attr):
+    return attr.replace('\n', '')
+
+
+def split_line_to_dict(split_line):
+    """
+    Returns the track properties of a line of the mbdump, split on commas.
+    """
+    return {
+        'title': strip_newlines(split_line[0]),
+        'duration': int(split_line[1]),
+        'artist': strip_newlines(split_line[2]),
+        'album': strip_newlines(split_line[3]),
+        'year': int(split_line[4]),
+        'position': int(split_line[5]),
+        'original_artist': strip_newlines(split_line[6]),
+    }
+
+
+def should_convert(track_params):
+    """
+    Returns whether a track read from the mbdump is imported.
+    """
+    return (
+        track_params['title'].isascii() and
+        track_params['duration'] > 0 and
+        track_params['artist'].isascii() and
+        track_params['year'] > 1960 and
+        track_params['position'] > 0 and
+        track_params['original_artist'].isascii()
+    )
 
 
 def minutes_to_milliseconds(minutes):
@@ -43,3 +200,80 @@ def minutes_to_milliseconds(minutes):
 
 def milliseconds_to_minutes(milliseconds):
     return milliseconds / MINUTES_TO_MILLISECONDS
+
+
+def allocate_candidate_budget(sizes, budget):
+    """
+    Splits a per-step candidate budget between link nodes.
+
+    Each link node is offered an equal share of the budget. A link node
+    smaller than its share is taken in full, and what it leaves unused is
+    split between the larger ones, so only the largest link nodes are ever
+    sampled.
+
+    Args:
+        sizes (list(int)): The number of tracks in each link node.
+        budget (int): The most candidates to take across all link nodes.
+
+    Returns:
+        list(int): The number of tracks to take from each link node, in the
+            same order as sizes.
+    """
+    quotas = [0] * len(sizes)
+    remaining = budget
+    order = sorted(range(len(sizes)), key=sizes.__getitem__)
+    for position, link in enumerate(order):
+        share = remaining // (len(sizes) - position)
+        quotas[link] = min(sizes[link], share)
+        remaining -= quotas[link]
+
+    return quotas
+
+
+def sample_link_nodes(member_lists, budget, rng=random):
+    """
+    Samples the members of each link node, within a candidate budget split
+    by allocate_candidate_budget.
+
+    A budget smaller than the number of link nodes leaves some of them with
+    no quota, so if nothing is sampled while the link nodes still have
+    members, they are returned unsampled rather than leaving no candidates.
+
+    Args:
+        member_lists (list): The members of each link node, as lists or
+            numpy arrays, without any tracks already played.
+        budget (int): The most candidates to take across all link nodes.
+        rng (random.Random): Source of the samples taken.
+
+    Returns:
+        list: The sampled members of each link node, in the same order.
+    """
+    quotas = allocate_candidate_budget(
+        [len(members) for members in member_lists], budget
+    )
+    sampled = [
+        sample_candidates(members, quota, rng)
+        for members, quota in zip(member_lists, quotas)
+    ]
+    if any(len(members) for members in sampled):
+        return sampled
+
+    return member_lists
+
+
+def sample_candidates(candidates, quota, rng=random):
+    """
+    Returns a uniform sample of quota candidates, without replacement.
+
+    The sample keeps the order of candidates, which are returned unchanged
+    if there are no more of them than the quota. Numpy arrays are sampled
+    by index, so they are not copied into a list first.
+    """
+    if quota >= len(candidates):
+        return candidates
+
+    indices = sorted(rng.sample(range(len(candidates)), quota))
+    if isinstance(candidates, (list, tuple)):
+        return [candidates[index] for index in indices]
+
+    return candidates[indices]
@@ -1,14 +1,44 @@
+import collections
+import contextlib
+import hashlib
+import json
 import logging
+import random
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.handlers.asgi import ASGIRequest
+from django.http import (
+    HttpResponse, HttpResponseNotAllowed, HttpResponseNotModified,
+    JsonResponse, StreamingHttpResponse
+)
 
 from rest_framework.viewsets import ViewSet
 from rest_framework.response import Response
 from rest_framework.exceptions import ParseError, UnsupportedMediaType
 
-from autodjbackend import playlist_generator, utils
+from autodjbackend import (
+    batch_generator, generation_trace, metrics, playlist_generator,
+    query_tracing, timing, utils
+)
+from autodjbackend.graph_storage import GraphStorage
 
 
 logger = logging.getLogger(__name__)
 
+STREAM_CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'sse': 'text/event-stream',
+}
+
+PlaylistRequest = collections.namedtuple(
+    'PlaylistRequest', [
+        'criteria_to_search', 'total_duration', 'user_time_window',
+        'user_tracks_list', 'seed', 'rng',
+    ]
+)
+
 
 class CreatePlaylistViewSet(ViewSet):
 
@@ -44,14 +74,69 @@ class CreatePlaylistViewSet(ViewSet):
                         artist : [string]
                     ]]
                     total_duration : [integer],
-                    tolerance_window : [integer]
+                    tolerance_window : [integer],
+                    seed : [integer or string]
                 }
             Successful Repsonse:
                 Code: 200
                 Content:
                     {
                         tracks : [[autodjbackend.models.Track]],
-                        total_duration : [integer]
+                        total_duration : [integer],
+                        tracks_to_include : [[
+                            matched : [boolean],
+                            uuid : [string]
+                        ]]
+                    }
+            Seeded Requests:
+                Every random choice is drawn from a generator seeded with
+                seed, so the same request generates the same playlist from
+                the same catalog. Seeded responses are cached, and have an
+                ETag, so a request with a matching If-None-Match header gets
+                a 304 Not Modified response while it is cached.
+            Timings:
+                Generated playlists have a Server-Timing header with the
+                time spent in each phase of the request, in milliseconds.
+                With ?debug=timing, they are also in the response content,
+                as debug : { timings : { [phase] : [float] } }. With
+                ?debug=queries, the Neo4j queries made are in the response
+                content, as debug : { queries : {
+                    count : [integer],
+                    total_ms : [float],
+                    slowest : [[ statement : [string], ms : [float] ]]
+                } }. With ?debug=trace, each step of the generation is in
+                the response content, as debug : { trace : {
+                    step_count : [integer],
+                    dropped : [integer],
+                    steps : [[
+                        step : [integer],
+                        source : [seed, user or graph],
+                        uuid : [string],
+                        candidates : [integer],
+                        best_h_value : [integer],
+                        bucket_size : [integer]
+                    ]]
+                } }, where only the last GENERATION_TRACE_CAPACITY steps
+                are kept. Any of these can be combined, as
+                ?debug=timing,queries,trace.
+            Streaming Response:
+                With ?stream=ndjson, each record below is sent as a line of
+                JSON as soon as it is ready. With ?stream=sse, each is sent
+                as a server-sent event named track or summary. Streams are
+                only served over WSGI, and rejected with a 400 over ASGI,
+                where Django iterates a streamed response on the event loop,
+                so every query and scoring step of the playlist would block
+                every other request of the process.
+                Code: 200
+                Content:
+                    { track : [autodjbackend.models.Track] }
+                    ...
+                    {
+                        total_duration : [integer],
+                        tracks_to_include : [[
+                            matched : [boolean],
+                            uuid : [string]
+                        ]]
                     }
             Error Response:
                 Code: 422 Unprocessable Entry
@@ -66,49 +151,462 @@ class CreatePlaylistViewSet(ViewSet):
                     /api/generate/
         """
         self._raise_if_not_json(request.content_type)
+        stream_format = request.query_params.get('stream')
+        if stream_format and stream_format not in STREAM_CONTENT_TYPES:
+            raise ParseError(detail=f'Unknown stream format: {stream_format}')
+        if stream_format and isinstance(request._request, ASGIRequest):
+            raise ParseError(
+                detail='Streaming is only supported over WSGI.'
+            )
 
-        request_data = request.data
+        playlist_request = _parse_request_data(request.data)
+        debug = _parse_debug(request.query_params.get('debug'))
+        cache_key = _get_cache_key(playlist_request)
+        cached_playlist = None
+        if not stream_format:
+            cached_playlist = _get_cached_playlist(cache_key)
+        if cached_playlist is not None:
+            return _cached_response(request, Response, *cached_playlist)
 
-        try:
-            total_duration = (
-                playlist_generator.minutes_to_milliseconds(
-                    request_data['total_duration']
-                )
+        with _record_request(debug) as (timer, trace, recorder):
+            storage = GraphStorage.get_instance()
+            seed_nodes, user_tracks, resolved_tracks = _get_starting_tracks(
+                playlist_request, storage
             )
-
-            criteria_to_search = utils.get_criteria_to_search(
-                request_data['track_criteria']
+            generator_args = _get_generator_args(
+                playlist_request, seed_nodes, user_tracks, storage
             )
-        except KeyError as err:
+
+            if stream_format:
+                # Tracks are generated after the headers are sent, so
+                # streamed responses aren't timed, and their queries and
+                # steps are traced while the stream is consumed.
+                records = _record_stream(
+                    playlist_generator.iter_generate(*generator_args)
+                )
+                return _stream_response(
+                    records, stream_format, resolved_tracks
+                )
+
+            resp_data = playlist_generator.generate(*generator_args)
+            _add_tracks_to_include(resp_data, resolved_tracks)
+        etag = _cache_playlist(cache_key, resp_data)
+        _add_debug(resp_data, debug, timer, trace, recorder)
+        response = _with_etag(Response(resp_data), etag)
+
+        return _with_server_timing(response, timer)
+
+    def _raise_if_not_json(self, content_type):
+        if content_type != 'application/json':
+            raise UnsupportedMediaType(content_type)
+
+
+class BatchPlaylistViewSet(CreatePlaylistViewSet):
+
+    def create(self, request):
+        """
+        Generates many playlists at once, in parallel worker processes.
+
+        Args:
+            request (rest_framework.request.Request:
+                Request sent by the client.
+
+        Returns:
+            rest_framework.response.Response: A HTTP response with the result
+                for each requested playlist, in order.
+
+        Request format:
+            URL: /api/generate/batch/
+            Method: POST
+            Data:
+                {
+                    requests : [[Data of a request to /api/generate/]]
+                }
+            Successful Repsonse:
+                Code: 200
+                Content:
+                    {
+                        results : [[
+                            status : [integer],
+                            playlist : [Content of a /api/generate/ response],
+                            detail : [string]
+                        ]]
+                    }
+                Each result has a playlist if its status is 200, and the
+                detail of the error otherwise, with a status of 504 if it
+                wasn't generated within PLAYLIST_BATCH_TIMEOUT seconds.
+        """
+        self._raise_if_not_json(request.content_type)
+
+        try:
+            batch = request.data['requests']
+        except (KeyError, TypeError) as err:
             err_string = f'Request missing data: {err}'
             logger.debug(err_string)
             raise ParseError(detail=err_string)
+        if not isinstance(batch, list):
+            raise ParseError(detail='Requests must be a list.')
+        if len(batch) > settings.PLAYLIST_BATCH_MAX_SIZE:
+            raise ParseError(
+                detail=(
+                    'Too many requests in batch, the most allowed is '
+                    f'{settings.PLAYLIST_BATCH_MAX_SIZE}.'
+                )
+            )
+
+        results = batch_generator.run_batch(_generate_batch_item, batch)
+
+        return Response({'results': results})
+
 
-        user_time_window = request_data.get('tolerance_window', 1)
+async def generate_playlist(request):
+    """
+    Generates a new playlist without holding a worker thread throughout.
 
+    This is the async form of CreatePlaylistViewSet.create, with the same
+    request and response formats, served at /api/generate/async/. Queries
+    and scoring are awaited in threads of the default executor, so when
+    served over ASGI one process can generate many playlists at once, up
+    to the executor's min(32, cpu_count + 4) threads doing work at a time.
+
+    Args:
+        request (django.http.HttpRequest): Request sent by the client.
+
+    Returns:
+        django.http.JsonResponse: A HTTP response with the generated
+            playlist, or with the error detail.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    if request.content_type != 'application/json':
+        return JsonResponse(
+            {
+                'detail': UnsupportedMediaType(
+                    request.content_type
+                ).detail
+            },
+            status=UnsupportedMediaType.status_code
+        )
+
+    try:
+        request_data = json.loads(request.body)
+    except ValueError as err:
+        return JsonResponse(
+            {'detail': f'JSON parse error - {err}'},
+            status=ParseError.status_code
+        )
+
+    try:
+        playlist_request = _parse_request_data(request_data)
+    except ParseError as err:
+        return JsonResponse({'detail': err.detail}, status=err.status_code)
+
+    cache_key = _get_cache_key(playlist_request)
+    cached_playlist = await sync_to_async(
+        _get_cached_playlist, thread_sensitive=False
+    )(cache_key)
+    if cached_playlist is not None:
+        return _cached_response(request, JsonResponse, *cached_playlist)
+
+    debug = _parse_debug(request.GET.get('debug'))
+    with _record_request(debug) as (timer, trace, recorder):
+        storage = await sync_to_async(
+            GraphStorage.get_instance, thread_sensitive=False
+        )()
         try:
-            user_tracks_list = request_data['tracks_to_include']
-        except KeyError:
-            logger.info('No user-specified tracks.')
-            seed_nodes = utils.get_seed_nodes_from_criteria(criteria_to_search)
-            user_tracks = None
-        else:
-            user_tracks = [
-                utils.get_seed_nodes_from_criteria(track)
-                for track in user_tracks_list
-            ]
-            user_tracks = [
-                track[0] for track in user_tracks if track != []
-            ]
-            seed_nodes = None
-
-        resp_data = playlist_generator.generate(
-            seed_nodes, criteria_to_search, total_duration,
-            user_tracks, user_time_window
+            seed_nodes, user_tracks, resolved_tracks = await sync_to_async(
+                _get_starting_tracks, thread_sensitive=False
+            )(playlist_request, storage)
+        except ParseError as err:
+            return JsonResponse(
+                {'detail': err.detail}, status=err.status_code
+            )
+
+        generator_args = await sync_to_async(
+            _get_generator_args, thread_sensitive=False
+        )(playlist_request, seed_nodes, user_tracks, storage)
+        resp_data = await playlist_generator.agenerate(*generator_args)
+        _add_tracks_to_include(resp_data, resolved_tracks)
+    etag = await sync_to_async(
+        _cache_playlist, thread_sensitive=False
+    )(cache_key, resp_data)
+    _add_debug(resp_data, debug, timer, trace, recorder)
+    response = _with_etag(JsonResponse(resp_data), etag)
+
+    return _with_server_timing(response, timer)
+
+
+# CsrfViewMiddleware only checks this attribute, and csrf_exempt would wrap
+# the view in a synchronous function.
+generate_playlist.csrf_exempt = True
+
+
+def export_metrics(request):
+    """
+    Returns the metrics of this process in the Prometheus text format.
+
+    Metrics are process-local, so with several workers each has to be
+    scraped, and playlists generated by the batch worker processes aren't
+    included.
+
+    Args:
+        request (django.http.HttpRequest): Request sent by the scraper.
+
+    Returns:
+        django.http.HttpResponse: A HTTP response with the metrics.
+
+    Request format:
+        URL: /metrics
+        Method: GET
+    """
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+
+    return HttpResponse(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def _generate_batch_item(request_data):
+    try:
+        playlist_request = _parse_request_data(request_data)
+        storage = GraphStorage.get_instance()
+        seed_nodes, user_tracks, resolved_tracks = _get_starting_tracks(
+            playlist_request, storage
         )
+    except ParseError as err:
+        return {'status': err.status_code, 'detail': str(err.detail)}
 
-        return Response(resp_data)
+    resp_data = playlist_generator.generate(*_get_generator_args(
+        playlist_request, seed_nodes, user_tracks, storage
+    ))
+    _add_tracks_to_include(resp_data, resolved_tracks)
 
-    def _raise_if_not_json(self, content_type):
-        if content_type != 'application/json':
-            raise UnsupportedMediaType(content_type)
+    return {'status': 200, 'playlist': resp_data}
+
+
+def _parse_request_data(request_data):
+    try:
+        total_duration = (
+            playlist_generator.minutes_to_milliseconds(
+                request_data['total_duration']
+            )
+        )
+
+        criteria_to_search = utils.get_criteria_to_search(
+            request_data['track_criteria']
+        )
+    except (KeyError, TypeError) as err:
+        err_string = f'Request missing data: {err}'
+        logger.debug(err_string)
+        raise ParseError(detail=err_string)
+
+    user_time_window = request_data.get('tolerance_window', 1)
+
+    try:
+        user_tracks_list = request_data['tracks_to_include']
+    except KeyError:
+        logger.info('No user-specified tracks.')
+        user_tracks_list = None
+
+    seed = request_data.get('seed')
+    if seed is None:
+        rng = random
+    elif isinstance(seed, (int, str)):
+        rng = random.Random(seed)
+    else:
+        raise ParseError(detail=f'Invalid seed: {seed}')
+
+    return PlaylistRequest(
+        criteria_to_search, total_duration, user_time_window,
+        user_tracks_list, seed, rng
+    )
+
+
+def _get_starting_tracks(playlist_request, storage):
+    if playlist_request.user_tracks_list is None:
+        with timing.phase(timing.SEED_LOOKUP):
+            seed_nodes = storage.get_random_seed_node(
+                playlist_request.criteria_to_search, playlist_request.rng
+            )
+        return seed_nodes, None, None
+
+    try:
+        with timing.phase(timing.USER_TRACKS):
+            resolved_tracks = storage.resolve_user_tracks(
+                playlist_request.user_tracks_list
+            )
+    except (TypeError, ValueError) as err:
+        err_string = f'Invalid tracks to include: {err}'
+        logger.debug(err_string)
+        raise ParseError(detail=err_string)
+    user_tracks = [
+        track for track in resolved_tracks if track is not None
+    ]
+    fallbacks = len(resolved_tracks) - len(user_tracks)
+    if fallbacks:
+        metrics.USER_TRACK_FALLBACKS.inc(fallbacks)
+
+    return None, user_tracks, resolved_tracks
+
+
+def _get_generator_args(playlist_request, seed_nodes, user_tracks, storage):
+    return (
+        seed_nodes, playlist_request.criteria_to_search,
+        playlist_request.total_duration, user_tracks,
+        playlist_request.user_time_window, storage.catalog,
+        settings.PLAYLIST_CANDIDATE_BUDGET, playlist_request.rng, storage
+    )
+
+
+def _get_cache_key(playlist_request):
+    """
+    Returns the playlist cache key of a seeded request, or None if the
+    request isn't seeded, as it would then generate a different playlist
+    each time.
+
+    The key is a hash of the request as JSON with sorted keys, so requests
+    which differ only in key order or unused criteria share a key.
+    """
+    if playlist_request.seed is None:
+        return None
+
+    payload = json.dumps(
+        {
+            'criteria': playlist_request.criteria_to_search,
+            'total_duration': playlist_request.total_duration,
+            'tolerance_window': playlist_request.user_time_window,
+            'tracks_to_include': playlist_request.user_tracks_list,
+            'seed': playlist_request.seed,
+            'candidate_budget': settings.PLAYLIST_CANDIDATE_BUDGET,
+        },
+        sort_keys=True, separators=(',', ':')
+    )
+
+    return f'playlist:{hashlib.sha256(payload.encode()).hexdigest()}'
+
+
+def _get_cached_playlist(cache_key):
+    if cache_key is None:
+        return None
+
+    return caches[settings.PLAYLIST_CACHE_ALIAS].get(cache_key)
+
+
+def _cache_playlist(cache_key, resp_data):
+    """
+    Caches a generated playlist with its ETag, which is returned, or returns
+    None if there is no cache key.
+    """
+    if cache_key is None:
+        return None
+
+    content = json.dumps(resp_data, sort_keys=True)
+    etag = f'"{hashlib.sha256(content.encode()).hexdigest()}"'
+    caches[settings.PLAYLIST_CACHE_ALIAS].set(
+        cache_key, (etag, resp_data), settings.PLAYLIST_CACHE_TTL
+    )
+
+    return etag
+
+
+def _cached_response(request, response_class, etag, resp_data):
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH', '')
+    if etag in [value.strip() for value in if_none_match.split(',')]:
+        return _with_etag(HttpResponseNotModified(), etag)
+
+    return _with_etag(response_class(resp_data), etag)
+
+
+def _with_etag(response, etag):
+    if etag is not None:
+        response['ETag'] = etag
+
+    return response
+
+
+def _parse_debug(debug):
+    if not debug:
+        return set()
+
+    return set(debug.split(','))
+
+
+@contextlib.contextmanager
+def _record_request(debug):
+    with timing.record_phases() as timer:
+        with query_tracing.trace_queries() as trace:
+            with generation_trace.record_steps('trace' in debug) as recorder:
+                yield timer, trace, recorder
+
+
+def _record_stream(records):
+    """
+    Yields the records of a streamed playlist, tracing the queries made and
+    the steps taken while they are generated. There is no debug output in a
+    stream, so its steps are only traced when sampled, and logged.
+    """
+    with query_tracing.trace_queries():
+        with generation_trace.record_steps():
+            yield from records
+
+
+def _add_debug(resp_data, debug, timer, trace, recorder):
+    """
+    Adds the debug output requested with ?debug to the response content.
+    This is done after the playlist is cached, so that cached responses
+    don't carry the debug output of the request that generated them.
+    """
+    debug_data = {}
+    if 'timing' in debug:
+        debug_data['timings'] = timer.as_dict()
+    if 'queries' in debug:
+        debug_data['queries'] = trace.as_dict()
+    if 'trace' in debug:
+        debug_data['trace'] = recorder.as_dict()
+    if debug_data:
+        resp_data['debug'] = debug_data
+
+
+def _with_server_timing(response, timer):
+    response['Server-Timing'] = timer.server_timing()
+
+    return response
+
+
+def _add_tracks_to_include(resp_data, resolved_tracks):
+    if resolved_tracks is None:
+        return
+
+    resp_data['tracks_to_include'] = [
+        {
+            'matched': track is not None,
+            'uuid': track.uuid if track is not None else None,
+        }
+        for track in resolved_tracks
+    ]
+
+
+def _stream_response(records, stream_format, resolved_tracks):
+    response = StreamingHttpResponse(
+        _format_records(records, stream_format, resolved_tracks),
+        content_type=STREAM_CONTENT_TYPES[stream_format]
+    )
+    # Stop caches and proxies from holding tracks back until the end.
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+
+    return response
+
+
+def _format_records(records, stream_format, resolved_tracks):
+    for record in records:
+        if 'track' in record:
+            event = 'track'
+        else:
+            event = 'summary'
+            _add_tracks_to_include(record, resolved_tracks)
+
+        data = json.dumps(record)
+        if stream_format == 'sse':
+            yield f'event: {event}\ndata: {data}\n\n'
+        else:
+            yield f'{data}\n'
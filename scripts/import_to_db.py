@@ -1,41 +1,113 @@
+import argparse
+import concurrent.futures
 import os
+import time
+import uuid
+
 import neomodel
 
-from autodjbackend.models import Track
+from autodjbackend.utils import should_convert, split_line_to_dict
 
 
 INPUT_PATH = './mbdump/scrubbed_data.csv'
-CHUNK_SIZE = 10000
+BATCH_SIZE = 10000
+WRITERS = 4
+
+# One statement per batch, rather than one per track.
+CREATE_TRACKS_QUERY = (
+    'UNWIND $rows AS row '
+    'CREATE (:Track {'
+    'uuid: row.uuid, title: row.title, artist: row.artist, '
+    'album: row.album, year: row.year, position: row.position, '
+    'duration: row.duration, original_artist: row.original_artist'
+    '})'
+)
+
+
+def read_rows(path):
+    """
+    Reads the track properties of each unique, valid line of the dump, with
+    a new uuid as Track.save() would have given it.
+    """
+    with open(path, 'r') as file:
+        imported_data = set(file.readlines())
+
+    rows = []
+    for line in imported_data:
+        split_line = line.split(',')
+        if len(split_line) != 7:
+            continue
+        track_params = split_line_to_dict(split_line)
+        if not should_convert(track_params):
+            continue
+        track_params['uuid'] = uuid.uuid4().hex
+        rows.append(track_params)
+
+    return rows
 
 
-def strip_newlines(attr):
-    return attr.replace('\n', '')
+def write_batch(driver, rows):
+    # Each batch gets its own session, so batches are written concurrently.
+    # Transient errors, such as lock timeouts, are retried by the driver.
+    with driver.session() as session:
+        session.write_transaction(_create_tracks, rows)
 
+    return len(rows)
 
-def split_line_to_dict(split_line):
-    return {
-        'title': strip_newlines(split_line[0]),
-        'duration': int(split_line[1]),
-        'artist': strip_newlines(split_line[2]),
-        'album': strip_newlines(split_line[3]),
-        'year': int(split_line[4]),
-        'position': int(split_line[5]),
-        'original_artist': strip_newlines(split_line[6]),
-    }
 
+def bulk_load(driver, rows, batch_size, writers):
+    """
+    Creates a Track for each row, in batches written by concurrent sessions,
+    printing the throughput as each batch completes.
 
-def should_convert(track_params):
-    return (
-        track_params['title'].isascii() and
-        track_params['duration'] > 0 and
-        track_params['artist'].isascii() and
-        track_params['year'] > 1960 and
-        track_params['position'] > 0 and
-        track_params['original_artist'].isascii()
+    Returns:
+        int: The number of tracks written.
+    """
+    batches = [
+        rows[i:i + batch_size] for i in range(0, len(rows), batch_size)
+    ]
+    written = 0
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(writers) as executor:
+        futures = [
+            executor.submit(write_batch, driver, batch) for batch in batches
+        ]
+        for i, future in enumerate(
+            concurrent.futures.as_completed(futures), 1
+        ):
+            written += future.result()
+            elapsed = time.perf_counter() - start
+            print(
+                f'Batch {i}/{len(batches)} completed. {written} tracks '
+                f'written, {written / elapsed:.0f} tracks/s.'
+            )
+
+    return written
+
+
+def _create_tracks(tx, rows):
+    tx.run(CREATE_TRACKS_QUERY, rows=rows).consume()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Imports the scrubbed MusicBrainz dump into Neo4j.'
+    )
+    parser.add_argument('--input', default=INPUT_PATH)
+    parser.add_argument(
+        '--batch-size', type=int, default=BATCH_SIZE,
+        help='Tracks created by each statement.'
     )
+    parser.add_argument(
+        '--writers', type=int, default=WRITERS,
+        help='Sessions writing batches at once.'
+    )
+
+    return parser.parse_args()
 
 
 if __name__ == '__main__':
+    args = parse_args()
 
     bolt_url = os.environ.get(
         'NEO4J_BOLT_URL', 'bolt://neo4j:password@db:7687'
@@ -48,43 +120,18 @@ if __name__ == '__main__':
     print('Clearing db.')
     neomodel.clear_neo4j_database(neomodel.db)
 
-    imported_data = []
-
     print('Starting file-read.')
-    with open(INPUT_PATH, 'r') as file:
-        imported_data.extend(file.readlines())
-    print('File read complete.')
-    imported_data = set(imported_data)
-
-    tracks = []
-    print('Converting to models.')
-    for line in imported_data:
-        split_line = line.split(',')
-        if len(split_line) != 7:
-            continue
-        track_params = split_line_to_dict(split_line)
-        if not should_convert(track_params):
-            continue
-        track = Track(**track_params)
-        tracks.append(track)
-        if len(tracks) % 10000 == 0:
-            print(f'{len(tracks)} converted.')
-
-    del imported_data
-
-    print('Splitting data')
-    chunked_data = [
-        tracks[i:i+CHUNK_SIZE] for i in range(0, len(tracks), CHUNK_SIZE)
-    ]
+    rows = read_rows(args.input)
+    print(f'File read complete. {len(rows)} tracks to write.')
 
     print('Starting db commit.')
-    i = 0
-    for chunk in chunked_data:
-        with neomodel.db.write_transaction:
-            for track in chunk:
-                track.save()
-        i += 1
-        total_written = i * CHUNK_SIZE
-        print(f'Chunk {i} completed. {total_written} tracks written.')
-
-    print('Process complete. If script does not finish execution press Ctrl+C')
+    start = time.perf_counter()
+    written = bulk_load(
+        neomodel.db.driver, rows, args.batch_size, args.writers
+    )
+    elapsed = time.perf_counter() - start
+
+    print(
+        f'Process complete. {written} tracks written in {elapsed:.1f}s, '
+        f'{written / elapsed:.0f} tracks/s.'
+    )
@@ -3,7 +3,7 @@ import os
 import neomodel
 
 from autodjbackend.models import Track, KeywordInTitle
-from autodjbackend.playlist_generator import KEYWORDS
+from autodjbackend.utils import KEYWORDS
 
 if __name__ == '__main__':
     bolt_url = os.environ.get(